@@ -9,7 +9,6 @@ os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
 os.environ["CUDA_VISIBLE_DEVICES"] = "1"
 
 import json
-import wandb
 import random
 import argparse
 import numpy as np
@@ -28,6 +27,13 @@ from transformers.modeling_auto import AutoConfig, AutoModel
 from transformers.modeling_bert import BertConfig, BertModel, BertPreTrainedModel
 
 from data.helper import get_transforms
+from data.jsonl_columns import load_jsonl
+from data.token_store import load_token_store
+from data.jpeg_draft import open_image
+from data.length_bucket import get_text_lengths
+from models.gray_input import fold_gray_input
+from models.conv_bn_fold import FoldedBackbone, FoldedEncoder, use_folded
+from utils.amp import compute_dtype
 
 def set_seed(seed):
     random.seed(seed)
@@ -49,7 +55,7 @@ class CNN_BERT_Dataset(Dataset):
     def __init__(self, data_path, tokenizer, transforms, args):
         self.args = args
         self.data_dir = os.path.dirname(data_path)
-        self.data = [json.loads(line) for line in open(data_path)]
+        self.data = load_jsonl(data_path)  # columnar, memory-mapped rows shared by the workers
 
         self.num_image_embeds = args.num_image_embeds
         self.seq_len = args.seq_len
@@ -82,20 +88,32 @@ class CNN_BERT_Dataset(Dataset):
             self.vocab_stoi = self.BertTokenizer.vocab
             self.vocab_len = len(self.vocab_stoi)  # 30522
 
+        # pre-tokenized reports, built by data/token_store.py
+        self.token_store = load_token_store(data_path, len(self.data), args.bert_model) if args.token_store else None
+        # jpgs decoded near 224 in the DCT domain, Resize(224) of the transforms is done afterwards
+        self.draft_size = 224 if args.jpeg_draft and args.img_size == 224 else None
+
     def __len__(self):
         return len(self.data)
 
+    def text_lengths(self):
+        # for data.length_bucket.LengthBucketBatchSampler, with cnn_bert_collate_fn
+        return get_text_lengths(self.data, self.token_store)
+
     def __getitem__(self, idx):
         _, _, label, txt, img = self.data[idx].keys()
         origin_txt = self.data[idx][txt]
         img_path = self.data[idx][img]
 
-        tokenized_sentence = self.tokenizer(origin_txt)  # ['i','ate','an','apple'], no special token
+        if self.token_store is not None:
+            encoded_sentence = self.token_store.get(idx, self.seq_len)
+        else:
+            tokenized_sentence = self.tokenizer(origin_txt)  # ['i','ate','an','apple'], no special token
 
-        truncate_txt(tokenized_sentence, self.seq_len)
+            truncate_txt(tokenized_sentence, self.seq_len)
 
-        encoded_sentence = [self.vocab_stoi[w] if w in self.vocab_stoi else self.vocab_stoi["[UNK]"]
-                            for w in tokenized_sentence]  # [178, 8756, 1126, 12075]
+            encoded_sentence = [self.vocab_stoi[w] if w in self.vocab_stoi else self.vocab_stoi["[UNK]"]
+                                for w in tokenized_sentence]  # [178, 8756, 1126, 12075]
 
         input_ids = [self.vocab_stoi["[CLS]"]] + encoded_sentence + [self.vocab_stoi["[SEP]"]]
 
@@ -112,25 +130,30 @@ class CNN_BERT_Dataset(Dataset):
         attn_masks = torch.tensor(attn_masks)
         segment = torch.tensor(segment)
 
-        if self.args.img_channel == 3:
-            image = Image.open(os.path.join(self.data_dir, img_path))
+        if self.args.gray_input:
+            image = open_image(os.path.join(self.data_dir, img_path), "L", self.draft_size)
+        elif self.args.img_channel == 3:
+            image = open_image(os.path.join(self.data_dir, img_path), size=self.draft_size)
         elif self.args.img_channel == 1:
-            image = Image.open(os.path.join(self.data_dir, img_path)).convert("RGB")
+            image = open_image(os.path.join(self.data_dir, img_path), "RGB", self.draft_size)
 
         image = self.transforms(image)
 
         return input_ids, attn_masks, segment, image
 
-class IMG_Encoder(nn.Module):
-    def __init__(self):
+class IMG_Encoder(FoldedEncoder):
+    def __init__(self, gray_input=False):
         super().__init__()
         model = torchvision.models.resnet50(pretrained=True)
         modules = list(model.children())[:-2]
         self.model = nn.Sequential(*modules)
+        if gray_input:
+            fold_gray_input(self.model)  # B x 1 x W x H inputs
+        self.folded = FoldedBackbone()  # eval without grad: BN folded into the convs, channels_last
         self.pool = F.adaptive_avg_pool2d
 
     def forward(self, x):
-        out = self.model(x)  # 224x224: torch.Size([16, 2048, 7, 7])
+        out = self.folded(self.model, x) if use_folded(self) else self.model(x)  # 224x224: torch.Size([16, 2048, 7, 7])
         # out = self.pool(out, (1, 1))  # torch.Size([16, 2048, 1, 1])
         out = torch.mean(out.view(out.size(0), out.size(1), -1), dim=2)
         return out
@@ -165,7 +188,7 @@ class TXT_Encoder(BertPreTrainedModel):
             extended_attn_mask = attn_mask.unsqueeze(1)
         else:
             raise NotImplementedError
-        extended_attn_mask = extended_attn_mask.to(dtype=torch.float16)
+        extended_attn_mask = extended_attn_mask.to(dtype=compute_dtype(self))
         extended_attn_mask = (1.0 - extended_attn_mask) * - 10000.0
 
         return extended_attn_mask
@@ -183,7 +206,7 @@ class CNN_BERT(BertPreTrainedModel):
         img_txt_hiddens = args.img_hidden_sz + args.hidden_size
 
         self.txt_enc = TXT_Encoder(config, args)
-        self.img_enc = IMG_Encoder()
+        self.img_enc = IMG_Encoder(args.gray_input)
         self.linear = nn.Linear(img_txt_hiddens, 2)
 
     def forward(self, input_txt, attn_mask, segment, input_img):
@@ -6,6 +6,9 @@ from PIL import Image
 import torch
 from torch.utils.data import Dataset
 
+from data.token_store import load_token_store
+from data.image_store import load_image_store, to_uint8_tensor
+from data.feature_store import load_feature_store
 from utils.utils import truncate_seq_pair, numpy_seed
 
 
@@ -30,29 +33,43 @@ class JsonlDataset(Dataset):
 
         self.transforms = transforms
 
+        # pre-tokenized reports, built by data/token_store.py at the repository root
+        self.token_store = load_token_store(data_path, len(self.data), args.bert_model) if args.token_store else None
+        # decoded uint8 pixels, built by data/image_store.py at the repository root
+        self.image_store = load_image_store(data_path, len(self.data), args.img_size) if args.image_store else None
+        # ResNet-50 grids, built by data/feature_store.py at the repository root
+        self.feature_store = load_feature_store(data_path, len(self.data), args.img_size) if args.feature_store else None
+
     def __len__(self):
         return len(self.data)
 
     def __getitem__(self, index):
         # print('self.max_seq_len:', self.max_seq_len)
         # print('args.num_image_embeds:', self.args.num_image_embeds)
-        sentence = (
-            self.text_start_token
-            + self.tokenizer(self.data[index]["text"])[
-                : (self.max_seq_len - 1)
-            ] + self.text_start_token
-        )
-        segment = torch.zeros(len(sentence))
-        # print('sentence:', sentence)
-        # print('len_seq:', len(sentence))
-        # print('**************************************')
+        if self.token_store is not None:
+            start_id = [self.vocab.stoi[w] for w in self.text_start_token]
+            sentence = torch.LongTensor(
+                start_id + self.token_store.get(index, self.max_seq_len - 1) + start_id
+            )
+            segment = torch.zeros(len(sentence))
+        else:
+            sentence = (
+                self.text_start_token
+                + self.tokenizer(self.data[index]["text"])[
+                    : (self.max_seq_len - 1)
+                ] + self.text_start_token
+            )
+            segment = torch.zeros(len(sentence))
+            # print('sentence:', sentence)
+            # print('len_seq:', len(sentence))
+            # print('**************************************')
 
-        sentence = torch.LongTensor(
-            [
-                self.vocab.stoi[w] if w in self.vocab.stoi else self.vocab.stoi["[UNK]"]
-                for w in sentence
-            ]
-        )
+            sentence = torch.LongTensor(
+                [
+                    self.vocab.stoi[w] if w in self.vocab.stoi else self.vocab.stoi["[UNK]"]
+                    for w in sentence
+                ]
+            )
         if self.args.task_type == "multilabel":
             label = torch.zeros(self.n_classes)
             if self.data[index]["label"] == '':
@@ -67,13 +84,27 @@ class JsonlDataset(Dataset):
             pass
 
         image = None
-        if self.args.model in ["img", "concatbow", "concatbert", "mmbt"]:
+        if self.args.model in ["img", "concatbow", "concatbert", "mmbt"] and self.feature_store is not None:
+            if self.data[index]["img"]:
+                image = self.feature_store[index]
+            else:
+                image = self.feature_store.gray()
+        elif self.args.model in ["img", "concatbow", "concatbert", "mmbt"] and self.image_store is not None:
+            if self.data[index]["img"]:
+                image = self.image_store[index]
+            else:
+                image = self.image_store.gray()
+        elif self.args.model in ["img", "concatbow", "concatbert", "mmbt"]:
             if self.data[index]["img"]:
                 image = Image.open(
                     os.path.join(self.data_dir, self.data[index]["img"]))
             else:
                 image = Image.fromarray(128 * np.ones((256, 256, 3), dtype=np.uint8))
-            image = self.transforms(image)
+            if self.args.batch_transforms:
+                # uint8, Grayscale(3) / ToTensor / Normalize run on the batch by normalize_batch
+                image = to_uint8_tensor(image.convert("L" if self.args.openi or self.args.gray_input else "RGB"))
+            else:
+                image = self.transforms(image)
 
         if self.args.model == "mmbt":
             # The first SEP is part of Image Token.
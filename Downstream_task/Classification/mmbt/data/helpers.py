@@ -10,10 +10,18 @@ from torch.utils.data import DataLoader
 
 from data.dataset import JsonlDataset
 from data.vocab import Vocab
+from utils.distributed import get_train_sampler
 
 
 def get_transforms(args):
-    if args.openi:
+    if args.gray_input:
+        # 1-channel image, Normalize is folded into the first conv of the ImageEncoder
+        return transforms.Compose(
+            [
+                transforms.Grayscale(num_output_channels=1),
+                transforms.ToTensor()
+            ])
+    elif args.openi:
         return transforms.Compose(
             [
                 transforms.Grayscale(num_output_channels=3),
@@ -136,10 +144,13 @@ def get_data_loaders(args):
 
     collate = functools.partial(collate_fn, args=args)
 
+    # torchrun: shard of this rank, the validation runs on rank 0 over the whole set
+    train_sampler = get_train_sampler(train, seed=args.seed)
     train_loader = DataLoader(
         train,
         batch_size=args.batch_sz,
-        shuffle=True,
+        sampler=train_sampler,
+        shuffle=train_sampler is None,
         num_workers=args.n_workers,
         collate_fn=collate,
     )
@@ -4,6 +4,7 @@ os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
 os.environ["CUDA_VISIBLE_DEVICES"] = "6,7"
 
 import csv
+import logging
 import argparse
 from sklearn.metrics import f1_score, accuracy_score, roc_auc_score
 from tqdm import tqdm
@@ -14,16 +15,20 @@ import torch.optim as optim
 from pytorch_pretrained_bert import BertAdam
 
 from data.helpers import get_data_loaders
+from data.image_store import normalize_batch
 from models import get_model
 from utils.logger import create_logger
 from utils.utils import *
-import wandb
+from utils.amp import MixedPrecision
+from utils.telemetry import TELEMETRY_SINKS, StepTelemetry, init_wandb
+from utils.distributed import (DIST_BACKENDS, init_distributed, is_distributed, is_main_process, get_rank, wrap_ddp,
+                               unwrap_ddp, accumulate, set_epoch, broadcast_object, cleanup)
 
 
 def get_args(parser):
 
     parser.add_argument("--seed", type=int, default=123)
-    parser.add_argument("--batch_sz", type=int, default=56)
+    parser.add_argument("--batch_sz", type=int, default=56, help="per process with torchrun")
     parser.add_argument("--max_epochs", type=int, default=10)
 
     parser.add_argument("--model", type=str, default="mmbt")
@@ -36,7 +41,7 @@ def get_args(parser):
     now = now.strftime('%Y-%m-%d')
     output_path = "/home/hglee/cxr-bert/Classification/mmbt/output/" + str(now)
     if not os.path.exists(output_path):
-        os.mkdir(output_path)
+        os.makedirs(output_path, exist_ok=True)  # torchrun: every rank parses the arguments
         os.chmod(output_path, 0o777)
 
     parser.add_argument("--savedir", type=str, default=output_path)
@@ -74,16 +79,46 @@ def get_args(parser):
     parser.add_argument("--glove_path", type=str, default="/path/to/glove_embeds/glove.840B.300d.txt")
     parser.add_argument("--gradient_accumulation_steps", type=int, default=1)
     parser.add_argument("--hidden", nargs="*", type=int, default=[])
+    parser.add_argument("--grad_checkpoint", type=str, default="none", choices=["none", "layer", "attention"],
+                        help="activation checkpointing of the BERT encoder layers, models/grad_checkpoint.py at the repository root")
+    parser.add_argument("--grad_checkpoint_every", type=int, default=1,
+                        help="checkpoint every k-th layer (0, k, 2k, ...) with --grad_checkpoint")
 
     parser.add_argument("--img_embed_pool_type", type=str, default="avg", choices=["max", "avg"])
     parser.add_argument("--img_hidden_sz", type=int, default=2048)
+    parser.add_argument("--batch_transforms", type=bool, default=False,
+                        help="decoded uint8 images, ToTensor / Normalize run on the batch on the device")
+    parser.add_argument("--gray_input", type=bool, default=False,
+                        help="1-channel images, the RGB weights and normalization are folded into the first conv")
+    parser.add_argument("--img_size", type=int, default=512, help="image size of the --image_store")
+    parser.add_argument("--image_store", type=bool, default=False,
+                        help="read decoded pixels built by data/image_store.py at the repository root")
+    parser.add_argument("--feature_store", type=bool, default=False,
+                        help="read ResNet-50 grids built by data/feature_store.py at the repository root, "
+                             "the image encoder backbone is then neither run nor fine-tuned")
     parser.add_argument("--include_bn", type=int, default=True)
 
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu",
+                        help="cuda, cuda:<i> or cpu, the model follows it")
+    parser.add_argument("--dist_backend", type=str, default="auto", choices=DIST_BACKENDS,
+                        help="torchrun launch: DistributedDataParallel backend, auto: nccl on cuda, gloo on cpu")
+    parser.add_argument("--cpu_threads", type=int, default=0, help="--device cpu: intra-op threads, 0: torch default")
+    parser.add_argument("--cpu_interop_threads", type=int, default=0, help="--device cpu: inter-op threads")
+    parser.add_argument("--mixed_precision", type=str, default="none", choices=["none", "fp16", "bf16"],
+                        help="torch.autocast compute dtype, fp16 with loss scaling (cuda), bf16 (cuda / cpu)")
+    parser.add_argument("--telemetry", type=str, default="jsonl", choices=TELEMETRY_SINKS,
+                        help="time per step of data wait, h2d, forward, backward and optimizer, throughput and peak "
+                             "memory to savedir/telemetry.jsonl (.csv), epoch metrics to metrics.jsonl; wandb: "
+                             "also both to a wandb run, the only sink needing wandb")
+    parser.add_argument("--telemetry_every", type=int, default=50,
+                        help="steps buffered between two telemetry writes (one cuda synchronize each)")
     parser.add_argument("--lr", type=float, default=1e-4)
     parser.add_argument("--lr_factor", type=float, default=0.5)
     parser.add_argument("--lr_patience", type=int, default=2)
 
     parser.add_argument("--max_seq_len", type=int, default=512)
+    parser.add_argument("--token_store", type=bool, default=False,
+                        help="read pre-tokenized reports built by data/token_store.py at the repository root")
     parser.add_argument("--num_image_embeds", type=int, default=256)
 
     parser.add_argument("--warmup", type=float, default=0.1)
@@ -135,13 +170,13 @@ def get_scheduler(optimizer, args):
         optimizer, "max", patience=args.lr_patience, verbose=True, factor=args.lr_factor
     )
 
-def model_eval(data, model, args, criterion, device, store_preds=False):
+def model_eval(data, model, args, criterion, device, amp, store_preds=False):
     with torch.no_grad():
         losses, preds, preds_bool, tgts = [], [], [], []
         outAUROC = []
 
         for batch in data:
-            loss, out, tgt = model_forward(model, args, criterion, batch, device)
+            loss, out, tgt = model_forward(model, args, criterion, batch, device, amp)
             losses.append(loss.item())
 
             if args.task_type == "multilabel":
@@ -193,53 +228,68 @@ def model_eval(data, model, args, criterion, device, store_preds=False):
     return metrics, classACC, tgts, preds
 
 
-def model_forward(model, args, criterion, batch, device):
-    txt, segment, mask, img, tgt = batch
+def set_requires_grad(model, args):
+    enc = model.module.enc if hasattr(model, 'module') else model.enc
+    if args.num_image_embeds > 0:
+        for param in enc.img_encoder.parameters():
+            param.requires_grad = args.freeze_img_all
 
-    model.to(device)
+    for param in enc.encoder.parameters():
+        param.requires_grad = args.freeze_txt_all
+
+
+def model_forward(model, args, criterion, batch, device, amp):
+    txt, segment, mask, img, tgt = batch
 
     if args.model == 'mmbt':
         assert args.model == "mmbt"
 
-        if args.num_image_embeds > 0:
-            for param in model.module.enc.img_encoder.parameters():
-                param.requires_grad = args.freeze_img_all
-
-        for param in model.module.enc.encoder.parameters():
-            param.requires_grad = args.freeze_txt_all
+        set_requires_grad(model, args)
 
         txt, img = txt.to(device), img.to(device)
+        if args.image_store or args.batch_transforms:
+            img = normalize_batch(img, gray_input=args.gray_input)
         mask, segment = mask.to(device), segment.to(device)
-        out = model(txt, mask, segment, img)
+        with amp.autocast():
+            out = model(txt, mask, segment, img)
+        out = out.float()
 
     tgt = tgt.to(device)
     loss = criterion(out, tgt)
     return loss, out, tgt
 
 def train(args):
-    wandb.init(config=args, project="classification", entity="mimic-cxr")
+    init_wandb(args.telemetry, args, project="classification", entity="mimic-cxr")  # --telemetry wandb, rank 0
     print("Training start!!")
     print(" # PID :", os.getpid())
 
-    set_seed(args.seed)
+    set_seed(args.seed + get_rank())  # model weights are broadcast from rank 0, dropout differs per rank
     args.savedir = os.path.join(args.savedir, args.save_name)
     os.makedirs(args.savedir, exist_ok=True)
 
     train_loader, val_loader = get_data_loaders(args)
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    device = torch.device(args.device)
+    if device.type == "cpu":
+        set_cpu_threads(args.cpu_threads, args.cpu_interop_threads)
     model = get_model(args)
 
     criterion = get_criterion(args, device)
     optimizer = get_optimizer(model, args)
     scheduler = get_scheduler(optimizer, args)
+    amp = MixedPrecision(args.mixed_precision, device)
+    # data wait / h2d / forward / backward / optimizer time per step to savedir/telemetry.jsonl
+    telemetry = StepTelemetry(args.telemetry, args.savedir, device, every=args.telemetry_every)
 
-    logger = create_logger("%s/logfile.log" % args.savedir, args)
-    torch.save(args, os.path.join(args.savedir, "args.bin"))
+    if is_main_process():
+        logger = create_logger("%s/logfile.log" % args.savedir, args)
+        torch.save(args, os.path.join(args.savedir, "args.bin"))
+    else:
+        logger = logging.getLogger(__name__)
 
     start_epoch, global_step, n_no_improve, best_metric = 0, 0, 0, -np.inf
 
     if os.path.exists(os.path.join(args.loaddir, "pytorch_model.bin")):
-        model.load_state_dict(torch.load(args.loaddir + "/pytorch_model.bin"), strict=False)
+        model.load_state_dict(torch.load(args.loaddir + "/pytorch_model.bin", map_location="cpu"), strict=False)
 
         print("This would load the trained model, then fine-tune the model.")
 
@@ -256,32 +306,49 @@ def train(args):
     model.to(device)
     logger.info("Training..")
 
-    if torch.cuda.device_count() > 1:
+    if is_distributed():
+        if args.model == 'mmbt':
+            set_requires_grad(model, args)  # DDP reduces the parameters that require grad at construction
+        model = wrap_ddp(model, device)
+    elif device.type == "cuda" and torch.cuda.device_count() > 1:
         print("Let's use", torch.cuda.device_count(), "GPUs!")
         model = nn.DataParallel(model)
 
     for i_epoch in range(start_epoch, args.max_epochs):
         train_losses = []
-        model.module.train()
-        # model.train()
+        model.train()
         optimizer.zero_grad()
-
-        for batch in tqdm(train_loader, total=len(train_loader)):
-            loss, out, target = model_forward(model, args, criterion, batch, device)
-            if args.gradient_accumulation_steps > 1:
-                loss = loss / args.gradient_accumulation_steps
-
-            train_losses.append(loss.item())
-            loss.backward()
+        set_epoch(train_loader, i_epoch)
+
+        for batch in tqdm(telemetry.batches(train_loader), total=len(train_loader), disable=not is_main_process()):
+            with telemetry.phase('h2d'):
+                batch = [t if t is None else t.to(device) for t in batch]
+            with accumulate(model, sync=(global_step + 1) % args.gradient_accumulation_steps == 0):
+                with telemetry.phase('forward'):
+                    loss, out, target = model_forward(model, args, criterion, batch, device, amp)
+                    if args.gradient_accumulation_steps > 1:
+                        loss = loss / args.gradient_accumulation_steps
+
+                train_losses.append(loss.item())
+                with telemetry.phase('backward'):
+                    amp.backward(loss)
             global_step += 1
             if global_step % args.gradient_accumulation_steps == 0:
-                optimizer.step()
-                optimizer.zero_grad()
+                with telemetry.phase('optimizer'):
+                    amp.step(optimizer)
+                    optimizer.zero_grad()
+            telemetry.record(global_step, samples=batch[0].size(0), tokens=batch[0].numel(), epoch=i_epoch)
+        telemetry.end_epoch()
 
         model.eval()
-        metrics, classACC, tgts, preds = model_eval(val_loader, model, args, criterion, device)
-        logger.info("Train Loss: {:.4f}".format(np.mean(train_losses)))
-        log_metrics("Val", metrics, args, logger)
+        if is_main_process():
+            metrics, classACC, tgts, preds = model_eval(val_loader, unwrap_ddp(model), args, criterion, device, amp)
+            logger.info("Train Loss: {:.4f}".format(np.mean(train_losses)))
+            log_metrics("Val", metrics, args, logger)
+        else:
+            metrics, classACC = None, None
+        # torchrun: the lr schedule and the early stopping of every rank follow the validation of rank 0
+        metrics, classACC = broadcast_object((metrics, classACC))
 
         tuning_metric = (
             metrics["micro_f1"] if args.task_type == "multilabel" else metrics["acc"]
@@ -294,7 +361,8 @@ def train(args):
         else:
             n_no_improve += 1
 
-        wandb.log({
+        telemetry.log({
+            "epoch": i_epoch,
             "micro_roc_auc": metrics["micro_roc_auc"],
             "macro_roc_auc": metrics["macro_roc_auc"],
             "macro_f1 f1 scroe": metrics["macro_f1"],
@@ -304,34 +372,36 @@ def train(args):
         })
 
 
-        csv_save_name = args.save_name
-        save_path = args.savedir + '/' + csv_save_name + '.csv'
-        f = open(save_path, 'w', encoding='utf-8')
-        wr = csv.writer(f)
-        key = list(classACC.keys())
-        val = list(classACC.values())
-        title = ['micro_auc', 'macro_auc', 'micro_f1', 'macro_f1'] + key
-        result = [metrics["micro_roc_auc"], metrics["macro_roc_auc"], metrics["micro_f1"], metrics["macro_f1"]] + val
-        wr.writerow(title)
-        wr.writerow(result)
-        f.close()
-
-        save_checkpoint(
-            {
-                "epoch": i_epoch + 1,
-                "state_dict": model.state_dict(),
-                "optimizer": optimizer.state_dict(),
-                "scheduler": scheduler.state_dict(),
-                "n_no_improve": n_no_improve,
-                "best_metric": best_metric,
-            },
-            is_improvement,
-            args.savedir,
-        )
+        if is_main_process():
+            csv_save_name = args.save_name
+            save_path = args.savedir + '/' + csv_save_name + '.csv'
+            f = open(save_path, 'w', encoding='utf-8')
+            wr = csv.writer(f)
+            key = list(classACC.keys())
+            val = list(classACC.values())
+            title = ['micro_auc', 'macro_auc', 'micro_f1', 'macro_f1'] + key
+            result = [metrics["micro_roc_auc"], metrics["macro_roc_auc"], metrics["micro_f1"], metrics["macro_f1"]] + val
+            wr.writerow(title)
+            wr.writerow(result)
+            f.close()
+
+            save_checkpoint(
+                {
+                    "epoch": i_epoch + 1,
+                    "state_dict": unwrap_ddp(model).state_dict(),
+                    "optimizer": optimizer.state_dict(),
+                    "scheduler": scheduler.state_dict(),
+                    "n_no_improve": n_no_improve,
+                    "best_metric": best_metric,
+                },
+                is_improvement,
+                args.savedir,
+            )
 
         if n_no_improve >= args.patience:
             logger.info("No improvement. Breaking out of loop.")
             break
+    telemetry.close()
 
 
 def test(args):
@@ -344,16 +414,19 @@ def test(args):
     os.makedirs(args.savedir, exist_ok=True)
 
     train_loader, val_loader = get_data_loaders(args)
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    device = torch.device(args.device)
+    if device.type == "cpu":
+        set_cpu_threads(args.cpu_threads, args.cpu_interop_threads)
     model = get_model(args)
 
     criterion = get_criterion(args, device)
+    amp = MixedPrecision(args.mixed_precision, device)
 
     torch.save(args, os.path.join(args.savedir, "args.bin"))
 
 
     if os.path.exists(os.path.join(args.loaddir, "model_best.pt")):
-        model.load_state_dict(torch.load(args.loaddir + "/model_best.pt"), strict=False)
+        model.load_state_dict(torch.load(args.loaddir + "/model_best.pt", map_location="cpu"), strict=False)
 
     else:
         print("")
@@ -365,14 +438,14 @@ def test(args):
     print("freeze txt?", args.freeze_txt_all)
     model.to(device)
 
-    if torch.cuda.device_count() > 1:
+    if device.type == "cuda" and torch.cuda.device_count() > 1:
         print("Let's use", torch.cuda.device_count(), "GPUs!")
         model = nn.DataParallel(model)
 
     load_checkpoint(model, os.path.join(args.loaddir, "model_best.pt"))
 
     model.eval()
-    metrics, classACC, tgts, preds  = model_eval(val_loader, model, args, criterion, device, store_preds=True)
+    metrics, classACC, tgts, preds  = model_eval(val_loader, model, args, criterion, device, amp, store_preds=True)
 
     print('micro_roc_auc:', round(metrics["micro_roc_auc"], 3))
     print('macro_roc_auc:', round(metrics["macro_roc_auc"], 3))
@@ -388,6 +461,11 @@ def cli_main():
     args, remaining_args = parser.parse_known_args()
     assert remaining_args == [], remaining_args
 
+    # torchrun: one process per gpu, DistributedDataParallel (utils/distributed.py)
+    dist_device = init_distributed(args.dist_backend, args.device.startswith("cuda"))
+    if dist_device is not None:
+        args.device = str(dist_device)
+
     print('=========INFO==========')
     print('loaddir:', args.loaddir)
     print('openi:', args.openi)
@@ -395,6 +473,7 @@ def cli_main():
     print('========================')
 
     train(args)
+    cleanup()
 
 
 if __name__ == "__main__":
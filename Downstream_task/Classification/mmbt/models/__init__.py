@@ -1,3 +1,9 @@
+import os
+
+# models/ of the repository root comes after this directory: the code shared with the pre-training model
+# (gray_input, grad_checkpoint, conv_bn_fold, ...) is imported from there as models.<name> instead of being copied here
+__path__.append(os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), *[os.pardir] * 4, 'models')))
+
 from models.mmbt import MultimodalBertClf
 
 
@@ -2,6 +2,9 @@ import torch
 import torch.nn as nn
 import torchvision
 
+from models.gray_input import fold_gray_input
+from models.conv_bn_fold import FoldedBackbone, FoldedEncoder, use_folded
+
 
 
 import torch
@@ -13,13 +16,16 @@ import torch.nn.functional as F
 from einops import rearrange
 from glob import glob
 
-class ImageEncoder(nn.Module):
+class ImageEncoder(FoldedEncoder):
     def __init__(self, args):
         super(ImageEncoder, self).__init__()
         self.args = args
         model = torchvision.models.resnet50(pretrained=True)
         modules = list(model.children())[:-2]
         self.model = nn.Sequential(*modules)
+        if args.gray_input:
+            fold_gray_input(self.model)  # Bx1x224x224 inputs
+        self.folded = FoldedBackbone()  # eval without grad: BN folded into the convs, channels_last
 
         pool_func = (
             nn.AdaptiveAvgPool2d
@@ -45,7 +51,11 @@ class ImageEncoder(nn.Module):
         # out = torch.flatten(out, start_dim=2)
         # out = out.transpose(1, 2).contiguous()
         
-        out = self.model(x)
+        # --feature_store: x is already the Bx2048xMxM grid of self.model
+        if self.args.feature_store:
+            out = x.float()
+        else:
+            out = self.folded(self.model, x) if use_folded(self) else self.model(x)
         out = torch.flatten(out, start_dim=2) #out torch.Size([100, 2048, 3])
         out = out.transpose(1, 2).contiguous() #out torch.Size([100, 3, 2048])
 
@@ -131,7 +141,7 @@ class random_sample(nn.Module):
         # position_ids = torch.arange(seq_length, dtype=torch.long).cuda()
         # position_ids = position_ids.unsqueeze(0).expand(bsz, seq_length)
 
-        vis_pe = torch.arange(out.size()[1], dtype=torch.long).cuda()
+        vis_pe = torch.arange(out.size()[1], dtype=torch.long, device=out.device)
         vis_pe = vis_pe.unsqueeze(0).expand(out.size()[0], out.size()[1])
             
         # random pixel sampling
@@ -175,7 +185,7 @@ class fully_use_cnn(nn.Module):
         out = out.transpose(1, 2).contiguous() #out torch.Size([100, 3, 2048])
         # print("fully_use_cnn",out.size())
 
-        vis_pe = torch.arange(out.size()[1], dtype=torch.long).cuda()
+        vis_pe = torch.arange(out.size()[1], dtype=torch.long, device=out.device)
         vis_pe = vis_pe.unsqueeze(0).expand(out.size()[0], out.size()[1])
         
         return out, vis_pe  # BxNx2048  # torch.Size([1, 2048, 7, 7])
@@ -3,6 +3,8 @@ import torch.nn as nn
 from transformers import BertConfig, AlbertConfig, AutoTokenizer, AutoModel, BertModel, AutoConfig
 
 from models.image import ImageEncoder
+from models.grad_checkpoint import set_grad_checkpoint
+from utils.amp import compute_dtype
 
 class ImageBertEmbeddings(nn.Module):
     def __init__(self, args, embeddings):
@@ -19,11 +21,11 @@ class ImageBertEmbeddings(nn.Module):
         bsz = input_imgs.size(0)
         seq_length = self.args.num_image_embeds + 2  # +2 for CLS and SEP Token
 
-        cls_id = torch.LongTensor([self.args.vocab.stoi["[CLS]"]]).cuda()
+        cls_id = torch.tensor([self.args.vocab.stoi["[CLS]"]], dtype=torch.long, device=input_imgs.device)
         cls_id = cls_id.unsqueeze(0).expand(bsz, 1)
         cls_token_embeds = self.word_embeddings(cls_id)
 
-        sep_id = torch.LongTensor([self.args.vocab.stoi["[SEP]"]]).cuda()
+        sep_id = torch.tensor([self.args.vocab.stoi["[SEP]"]], dtype=torch.long, device=input_imgs.device)
         sep_id = sep_id.unsqueeze(0).expand(bsz, 1)
         sep_token_embeds = self.word_embeddings(sep_id)
 
@@ -32,7 +34,7 @@ class ImageBertEmbeddings(nn.Module):
             [cls_token_embeds, imgs_embeddings, sep_token_embeds], dim=1
         )
 
-        position_ids = torch.arange(seq_length, dtype=torch.long).cuda()
+        position_ids = torch.arange(seq_length, dtype=torch.long, device=input_imgs.device)
         position_ids = position_ids.unsqueeze(0).expand(bsz, seq_length)
         position_embeddings = self.position_embeddings(position_ids)
         token_type_embeddings = self.token_type_embeddings(token_type_ids)
@@ -62,13 +64,15 @@ class MultimodalBertEncoder(nn.Module):
 
         self.encoder = bert.encoder
         self.pooler = bert.pooler
+        if args.grad_checkpoint != 'none':
+            set_grad_checkpoint(self.encoder.layer, args.grad_checkpoint, args.grad_checkpoint_every)
         self.clf = nn.Linear(args.hidden_sz, args.n_classes)
 
     def forward(self, input_txt, attention_mask, segment, input_img):
         bsz = input_txt.size(0)
         attention_mask = torch.cat(
             [
-                torch.ones(bsz, self.args.num_image_embeds + 2).long().cuda(),
+                torch.ones(bsz, self.args.num_image_embeds + 2, dtype=torch.long, device=input_txt.device),
                 attention_mask,
             ],
             dim=1,
@@ -77,17 +81,13 @@ class MultimodalBertEncoder(nn.Module):
 
         try:
             extended_attention_mask = extended_attention_mask.to(
-                dtype=next(self.parameters()).dtype)  # fp16 compatibility
+                dtype=compute_dtype(self))  # fp16 / autocast compatibility
         except StopIteration:
             extended_attention_mask = extended_attention_mask.to(dtype=torch.float16)
 
         extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
 
-        img_tok = (
-            torch.LongTensor(input_txt.size(0), self.args.num_image_embeds + 2)
-            .fill_(0)
-            .cuda()
-        )
+        img_tok = input_txt.new_zeros(input_txt.size(0), self.args.num_image_embeds + 2)
         img = self.img_encoder(input_img)  # BxNx3x224x224 -> BxNx2048
 
         
@@ -17,6 +17,14 @@ def set_seed(seed):
     torch.backends.cudnn.benchmark = False
 
 
+def set_cpu_threads(num_threads=0, num_interop_threads=0):
+    """intra-op / inter-op thread pools of CPU inference, 0 keeps the torch default (one thread per core)"""
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads > 0:
+        torch.set_num_interop_threads(num_interop_threads)  # only before the first parallel op
+
+
 def save_checkpoint(state, is_best, checkpoint_path, filename="checkpoint.pt"):
     filename = os.path.join(checkpoint_path, filename)
     torch.save(state, filename)
@@ -25,7 +33,7 @@ def save_checkpoint(state, is_best, checkpoint_path, filename="checkpoint.pt"):
 
 
 def load_checkpoint(model, path):
-    best_checkpoint = torch.load(path)
+    best_checkpoint = torch.load(path, map_location='cpu')
     model.load_state_dict(best_checkpoint["state_dict"])
 
 
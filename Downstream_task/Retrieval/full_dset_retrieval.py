@@ -16,28 +16,43 @@ os.environ["CUDA_VISIBLE_DEVICES"] = "4,5,6,7"
 import json
 import random
 import argparse
+import functools
 import numpy as np
 from PIL import Image
 from tqdm import tqdm
-from fuzzywuzzy import fuzz
 from datetime import datetime
 from collections import OrderedDict
 
 import torch
 import torch.nn as nn
 import torchvision.transforms as transforms
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Subset
+from torch.utils.data.dataloader import default_collate
 
 from transformers.optimization import AdamW
 from transformers import BertTokenizer, AutoTokenizer
 from transformers.tokenization_albert import AlbertTokenizer
 from transformers import BertConfig, AlbertConfig, AutoConfig
 
-from data.helper import get_transforms
+from data.helper import get_transforms, get_batch_resize
+from data.jsonl_columns import load_jsonl
+from data.token_store import load_token_store
+from data.image_store import load_image_store, normalize_batch, to_uint8_tensor
+from data.feature_store import load_feature_store
+from data.jpeg_draft import open_image
+from data.label_index import LabelIndex
+from data.length_bucket import LengthBucketBatchSampler, get_text_lengths, get_text_len, trim_text_padding
+from utils.amp import MixedPrecision
+from utils.utils import set_cpu_threads
+from utils.checkpoint import CheckpointManager
+from utils.eval_worker import EvalWorker, subsample_indices
+from utils.telemetry import TELEMETRY_SINKS, StepTelemetry, init_wandb, watch_wandb
+from utils.distributed import (DIST_BACKENDS, init_distributed, is_distributed, is_main_process, get_rank,
+                               get_world_size, wrap_ddp, unwrap_ddp, get_train_sampler, set_epoch, barrier,
+                               broadcast_object, cleanup)
 from Downstream_task.Retrieval.retrieval import CXRBertForRetrieval
 from CNN_BERT.main_cnn_bert import CNN_BERT
 
-import wandb
 
 def set_seed(seed):
     random.seed(seed)
@@ -61,13 +76,15 @@ class CXR_Retrieval_Dataset(Dataset):
     def __init__(self, data_path, tokenizer, transforms, args, is_train=True):
         self.args = args
         self.data_dir = os.path.dirname(data_path)
-        self.data = [json.loads(line) for line in open(data_path)]
+        self.data = load_jsonl(data_path)  # columnar, memory-mapped rows shared by the workers
 
         self.num_image_embeds = args.num_image_embeds
         self.seq_len = args.seq_len
         self.transforms = transforms
 
         self.is_train = is_train
+        if is_train and args.label_conditioned:
+            self.label_index = LabelIndex([d['label'] for d in self.data])
 
         self.tokenizer = tokenizer  # tokenizer = BertTokenizer.from_pretrained('bert-based-uncased').tokenize
 
@@ -101,9 +118,21 @@ class CXR_Retrieval_Dataset(Dataset):
             self.vocab_stoi = self.BertTokenizer.vocab
             self.vocab_len = len(self.vocab_stoi)  # 30522
 
+        # pre-tokenized reports, built by data/token_store.py
+        self.token_store = load_token_store(data_path, len(self.data), args.bert_model) if args.token_store else None
+        # decoded uint8 pixels, built by data/image_store.py
+        self.image_store = load_image_store(data_path, len(self.data), args.img_size) if args.image_store else None
+        # ResNet-50 grids, built by data/feature_store.py
+        self.feature_store = load_feature_store(data_path, len(self.data), args.img_size) if args.feature_store else None
+        # jpgs decoded near 224 in the DCT domain, Resize(224) of the transforms is done afterwards
+        self.draft_size = 224 if args.jpeg_draft and args.img_size == 224 else None
+
     def __len__(self):
         return len(self.data)
 
+    def text_lengths(self):
+        return get_text_lengths(self.data, self.token_store)
+
     def __getitem__(self, idx):
         if self.is_train:
             if args.MIMIC_dset:
@@ -111,31 +140,26 @@ class CXR_Retrieval_Dataset(Dataset):
             else:
                 study_id, label, txt, img = self.data[idx].keys()
 
-            d_label = self.data[idx][label]
             d_txt = self.data[idx][txt]
             d_img = self.data[idx][img]
 
             if self.args.label_conditioned:
-                for itr in range(300):
-                    random_label, random_txt, random_img = self.get_random_line(idx)
-                    if fuzz.token_sort_ratio(d_label, random_label) != 100:
-                        if random.random() > 0.5:
-                            neg_img, neg_txt = random_img, d_txt
-                            break
-                        else:
-                            neg_img, neg_txt = d_img, random_txt
-                            break
-                    else:
-                        pass
+                # random row whose label set differs from the one of idx
+                rand_num = self.label_index.sample_negative(idx)
+                random_txt, random_img = self.data[rand_num]['text'], self.data[rand_num]['img']
+                if random.random() > 0.5:
+                    neg_img, neg_txt, neg_txt_idx = random_img, d_txt, idx
+                else:
+                    neg_img, neg_txt, neg_txt_idx = d_img, random_txt, rand_num
             else:
-                _, random_txt, random_img = self.get_random_line(idx)
+                _, random_txt, random_img, rand_num = self.get_random_line(idx)
                 if random.random() > 0.5:
-                    neg_img, neg_txt = random_img, d_txt
+                    neg_img, neg_txt, neg_txt_idx = random_img, d_txt, idx
                 else:
-                    neg_img, neg_txt = d_img, random_txt
+                    neg_img, neg_txt, neg_txt_idx = d_img, random_txt, rand_num
 
-            pair_pos = self.data_processing(d_txt, d_img)
-            pair_neg = self.data_processing(neg_txt, neg_img)
+            pair_pos = self.data_processing(d_txt, d_img, idx)
+            pair_neg = self.data_processing(neg_txt, neg_img, neg_txt_idx)
 
 
             example = tuple(list(pair_pos) + [1] + list(pair_neg) + [0])
@@ -157,7 +181,7 @@ class CXR_Retrieval_Dataset(Dataset):
             img = self.data[idx][img]
             label = self.data[idx][is_aligned]  # 1(Aligned), 0(Not aligned)
 
-            sample = self.data_processing(txt, img)
+            sample = self.data_processing(txt, img, idx)
             example = tuple(list(sample) + label + [idx])
             return example
 
@@ -167,26 +191,45 @@ class CXR_Retrieval_Dataset(Dataset):
         label = self.data[rand_num]['label']
         txt = self.data[rand_num]['text']
         img = self.data[rand_num]['img']
-        return label, txt, img
-
-    def data_processing(self, origin_txt, img_path):
-        if args.CXRBERT:
-            if self.args.img_channel == 3:
-                image = Image.open(os.path.join(self.data_dir, img_path))
-            elif self.args.img_channel == 1:
-                image = Image.open(os.path.join(self.data_dir, img_path))
+        return label, txt, img, rand_num
+
+    def encode_txt(self, txt_idx, origin_txt):
+        if self.token_store is not None:
+            return self.token_store.get(txt_idx, self.seq_len)
+
+        tokenized_sentence = self.tokenizer(origin_txt)  # ['i','ate','an','apple'], no special token
+        truncate_txt(tokenized_sentence, self.seq_len)
+
+        encoded_sentence = [self.vocab_stoi[w] if w in self.vocab_stoi else self.vocab_stoi["[UNK]"]
+                            for w in tokenized_sentence]  # [178, 8756, 1126, 12075]
+        return encoded_sentence
+
+    def load_image(self, img_path):
+        if self.feature_store is not None:
+            return self.feature_store[self.feature_store.row_of(img_path)]
+        if self.image_store is not None:
+            return self.image_store[self.image_store.row_of(img_path)]
+
+        if self.args.gray_input:
+            image = open_image(os.path.join(self.data_dir, img_path), "L", self.draft_size)
+        elif self.args.img_channel == 3:
+            image = open_image(os.path.join(self.data_dir, img_path), size=self.draft_size)
+        elif self.args.img_channel == 1:
+            if self.args.batch_transforms:  # 1 channel, expanded to 3 on the batch
+                image = open_image(os.path.join(self.data_dir, img_path), "L", self.draft_size)
+            else:
+                image = open_image(os.path.join(self.data_dir, img_path), size=self.draft_size)
                 image = transforms.Grayscale(num_output_channels=3)(image)
 
-            image = self.transforms(image)
-
-
-            tokenized_sentence = self.tokenizer(origin_txt)  # ['i','ate','an','apple'], no special token
-
-            truncate_txt(tokenized_sentence, self.seq_len)
+        if self.args.batch_transforms:
+            return to_uint8_tensor(image)  # resized and normalized per batch by normalize_batch
+        return self.transforms(image)
 
+    def data_processing(self, origin_txt, img_path, txt_idx):
+        if args.CXRBERT:
+            image = self.load_image(img_path)
 
-            encoded_sentence = [self.vocab_stoi[w] if w in self.vocab_stoi else self.vocab_stoi["[UNK]"]
-                                    for w in tokenized_sentence]  # [178, 8756, 1126, 12075]
+            encoded_sentence = self.encode_txt(txt_idx, origin_txt)
 
             input_ids = encoded_sentence + [self.vocab_stoi["[SEP]"]]
 
@@ -215,11 +258,7 @@ class CXR_Retrieval_Dataset(Dataset):
             return cls_tok, input_ids, attn_masks, image, segment, sep_tok
 
         else:
-            tokenized_sentence = self.tokenizer(origin_txt)  # ['i','ate','an','apple'], no special token
-            truncate_txt(tokenized_sentence, self.seq_len)
-
-            encoded_sentence = [self.vocab_stoi[w] if w in self.vocab_stoi else self.vocab_stoi["[UNK]"]
-                                for w in tokenized_sentence]  # [178, 8756, 1126, 12075]
+            encoded_sentence = self.encode_txt(txt_idx, origin_txt)
 
             input_ids = [self.vocab_stoi["[CLS]"]] + encoded_sentence + [self.vocab_stoi["[SEP]"]]
 
@@ -236,17 +275,28 @@ class CXR_Retrieval_Dataset(Dataset):
             attn_masks = torch.tensor(attn_masks)
             segment = torch.tensor(segment)
 
-            if self.args.img_channel == 3:
-                image = Image.open(os.path.join(self.data_dir, img_path))
-            elif self.args.img_channel == 1:
-                image = Image.open(os.path.join(self.data_dir, img_path))
-                image = transforms.Grayscale(num_output_channels=3)(image)
-
-            image = self.transforms(image)
+            image = self.load_image(img_path)
 
             return input_ids, attn_masks, segment, image
 
 
+def collate_fn(batch, args, pad_id):
+    """default collate + cut the text padding to the longest report of the batch (positive and negative pairs alike)"""
+    batch = default_collate(batch)
+    # field positions in data_processing outputs
+    ids_i, attn_i, seg_i, n_fields = (1, 2, 4, 7) if args.CXRBERT else (0, 1, 2, 5)
+    vis_len = args.num_image_embeds + 2 if args.CXRBERT else 0
+
+    idx, example = batch if isinstance(batch[1], list) else (None, batch)
+    example = list(example)
+    offsets = [0, n_fields] if idx is not None else [0]  # train: positive + negative pair
+    txt_len = max(get_text_len(example[o + ids_i], pad_id) for o in offsets)
+    for o in offsets:
+        example[o + ids_i], example[o + seg_i], example[o + attn_i] = trim_text_padding(
+            example[o + ids_i], example[o + seg_i], example[o + attn_i], vis_len=vis_len, txt_len=txt_len)
+    return (idx, example) if idx is not None else example
+
+
 def compute_ranks(args, results, labels, idx_lst):
     labels = np.array(labels)
     # print('len_ labels, result, idx_lst:', len(labels), len(results), len(idx_lst))
@@ -342,42 +392,66 @@ def train(args, train_dataset, val_dataset, model, tokenizer, dset):
 
     optimizer = AdamW(model.parameters(), lr=args.lr)
     criterion = nn.CrossEntropyLoss()
+    amp = MixedPrecision(args.mixed_precision, args.device)
     global_step, global_loss, global_acc = 0, 0.0, 0.0
     best_score = 0
+    # --async_eval: not pruned before the evaluation worker has scored them
+    checkpoints_dir = os.path.join(args.output_path, 'checkpoints')
+    checkpoints = CheckpointManager(checkpoints_dir, scored=EvalWorker(checkpoints_dir, args.eval_metrics_file).scored)
+    telemetry = StepTelemetry(args.telemetry, args.output_path, args.device, every=args.telemetry_every)
 
     for epoch in range(int(args.epochs)):
+        set_epoch(train_dataset, epoch)
         train_losses = []
         train_acc = []
 
-        train_data_iter = tqdm(enumerate(train_dataset),
+        train_data_iter = tqdm(enumerate(telemetry.batches(train_dataset)),
                                desc=f'EP_:{epoch}',
                                total=len(train_dataset),
-                               bar_format='{l_bar}{r_bar}')
+                               bar_format='{l_bar}{r_bar}',
+                               disable=not is_main_process())
 
         for step, (_, batch) in train_data_iter:
             model.train()
             if args.CXRBERT:
-                cls_tok = torch.cat((batch[0], batch[7]), dim=0).to(args.device)
-                input_txt = torch.cat((batch[1], batch[8]), dim=0).to(args.device)
-                attn_mask = torch.cat((batch[2], batch[9]), dim=0).to(args.device)
-                input_img = torch.cat((batch[3], batch[10]), dim=0).to(args.device)
-                segment = torch.cat((batch[4], batch[11]), dim=0).to(args.device)
-                sep_tok = torch.cat((batch[5], batch[12]), dim=0).to(args.device)
-                labels = torch.cat((batch[6], batch[13]), dim=0).to(args.device)
-                logits = model(cls_tok, input_txt, attn_mask, segment, input_img, sep_tok)
+                with telemetry.phase('h2d'):
+                    cls_tok = torch.cat((batch[0], batch[7]), dim=0).to(args.device)
+                    input_txt = torch.cat((batch[1], batch[8]), dim=0).to(args.device)
+                    attn_mask = torch.cat((batch[2], batch[9]), dim=0).to(args.device)
+                    input_img = torch.cat((batch[3], batch[10]), dim=0).to(args.device)
+                    if args.image_store or args.batch_transforms:
+                        input_img = normalize_batch(input_img, gray_input=args.gray_input, size=get_batch_resize(args))
+                    segment = torch.cat((batch[4], batch[11]), dim=0).to(args.device)
+                    sep_tok = torch.cat((batch[5], batch[12]), dim=0).to(args.device)
+                    labels = torch.cat((batch[6], batch[13]), dim=0).to(args.device)
+                with telemetry.phase('forward'):
+                    with amp.autocast():
+                        logits = model(cls_tok, input_txt, attn_mask, segment, input_img, sep_tok)
+                    logits = logits.float()
             else:
-                input_txt = torch.cat((batch[0], batch[5]), dim=0).to(args.device)
-                attn_mask = torch.cat((batch[1], batch[6]), dim=0).to(args.device)
-                segment = torch.cat((batch[2], batch[7]), dim=0).to(args.device)
-                input_img = torch.cat((batch[3], batch[8]), dim=0).to(args.device)
-                labels = torch.cat((batch[4], batch[9]), dim=0).to(args.device)
-                logits = model(input_txt, attn_mask, segment, input_img)
-
-            loss = criterion(logits.view(-1, 2), labels.view(-1))
-
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+                with telemetry.phase('h2d'):
+                    input_txt = torch.cat((batch[0], batch[5]), dim=0).to(args.device)
+                    attn_mask = torch.cat((batch[1], batch[6]), dim=0).to(args.device)
+                    segment = torch.cat((batch[2], batch[7]), dim=0).to(args.device)
+                    input_img = torch.cat((batch[3], batch[8]), dim=0).to(args.device)
+                    if args.image_store or args.batch_transforms:
+                        input_img = normalize_batch(input_img, gray_input=args.gray_input, size=get_batch_resize(args))
+                    labels = torch.cat((batch[4], batch[9]), dim=0).to(args.device)
+                with telemetry.phase('forward'):
+                    with amp.autocast():
+                        logits = model(input_txt, attn_mask, segment, input_img)
+                    logits = logits.float()
+
+            with telemetry.phase('forward'):
+                loss = criterion(logits.view(-1, 2), labels.view(-1))
+
+            with telemetry.phase('backward'):
+                optimizer.zero_grad()
+                amp.backward(loss)
+            with telemetry.phase('optimizer'):
+                amp.step(optimizer)
+            telemetry.record(epoch * len(train_dataset) + step + 1, samples=labels.size(0), tokens=input_txt.numel(),
+                             epoch=epoch)
 
             logits = torch.max(logits, 1)[1].data  # argmax
             scores = logits == labels
@@ -394,17 +468,32 @@ def train(args, train_dataset, val_dataset, model, tokenizer, dset):
                   f'loss : {round(loss.item(), 3)}({round(np.mean(train_losses), 3)}), '
                   f'score : {round(batch_acc, 3)}({round(np.mean(train_acc), 3)})')
 
-        wandb.log({
+        telemetry.end_epoch(wandb_step=epoch)
+        telemetry.log({
             "avg_loss": np.mean(train_losses),
             "retrieval_acc": np.mean(train_acc),
         }, step=epoch)
 
+        if args.eval_during_training and args.async_eval:
+            # scored by the evaluation worker (--eval_worker), training does not wait for it
+            checkpoints.save((epoch + 1) * len(train_dataset), {
+                'epoch': epoch,
+                'step': len(train_dataset),
+                'final': epoch == int(args.epochs) - 1,  # the evaluation worker stops after it
+                'model': (model.module if hasattr(model, 'module') else model).state_dict(),
+            })
+
+        if not is_main_process():
+            # rank 0 saves and evaluates the whole validation set, the others wait for it
+            barrier()
+            continue
+
         save_path_per_ep = os.path.join(args.output_path, str(epoch))
         if not os.path.exists(save_path_per_ep):
             os.mkdir(save_path_per_ep)
             os.chmod(save_path_per_ep, 0o777)
 
-        if args.n_gpu > 1:
+        if hasattr(model, 'module'):
             model.module.save_pretrained(save_path_per_ep)
             print(f'Multi_EP: {epoch} Model saved on {save_path_per_ep}')
         else:
@@ -412,8 +501,8 @@ def train(args, train_dataset, val_dataset, model, tokenizer, dset):
             print(f'Single_EP: {epoch} Model saved on {save_path_per_ep}')
 
         # Evaluate during training
-        if args.eval_during_training:  # and epoch > 4:
-            test_result, test_label, test_losses, idx_lst = test(args, model, val_dataset)
+        if args.eval_during_training and not args.async_eval:  # and epoch > 4:
+            test_result, test_label, test_losses, idx_lst = test(args, unwrap_ddp(model), val_dataset)
             eval_result, Aligned_lst, mrr_score, recall_precision_results = evaluate(args, test_result, test_label, idx_lst)
 
             file_data = OrderedDict()
@@ -450,12 +539,15 @@ def train(args, train_dataset, val_dataset, model, tokenizer, dset):
                   f'Hit@1:{H1}, Hit@5:{H5}, Hit@10:{H10}, best_Hit1:{best_score},'
                   f'Recall@1:{R1}, Recall@5:{R5}, Recall@10:{R10},'
                   f'Precision@1:{P1}, Precision@1:{P5}, Precision@1:{P10}')
-            wandb.log({
+            telemetry.log({
                 "Hit@1": H1, "Hit@5": H5, "Hit@10": H10,
                 "Recall@1": R1, "Recall@5": R5, "Recall@10": R10,
                 "Precision@1": P1, "Precision@5": P5, "Precision@10": P10,
                 "best_Hit1": best_score, "test_loss": np.mean(test_losses), "mrr_score": mrr_score,
             }, step=epoch)
+        barrier()
+    checkpoints.wait()
+    telemetry.close()
 
 
 def test(args, model, eval_dataset):
@@ -466,6 +558,7 @@ def test(args, model, eval_dataset):
     softmax = nn.Softmax(dim=1)
     criterion = nn.CrossEntropyLoss()
     eval_losses = []
+    amp = MixedPrecision(args.mixed_precision, args.device)
 
     eval_data_iter = tqdm(enumerate(eval_dataset),
                           total=len(eval_dataset),
@@ -479,22 +572,30 @@ def test(args, model, eval_dataset):
                 attn_mask = batch[2].to(args.device)
                 input_img = batch[3].to(args.device)
                 segment = batch[4].to(args.device)
+                if args.image_store or args.batch_transforms:
+                    input_img = normalize_batch(input_img, gray_input=args.gray_input, size=get_batch_resize(args))
                 sep_tok = batch[5].to(args.device)
 
                 label = batch[6].tolist()
                 idx = batch[7].tolist()
 
-                logits = model(cls_tok, input_txt, attn_mask, segment, input_img, sep_tok)
+                with amp.autocast():
+                    logits = model(cls_tok, input_txt, attn_mask, segment, input_img, sep_tok)
+                logits = logits.float()
             else:
                 input_txt = batch[0].to(args.device)
                 attn_mask = batch[1].to(args.device)
                 input_img = batch[2].to(args.device)
-                segment = batch[3].to(args.device)
+                segment = batch[3].to(args.device)  # image
+                if args.image_store or args.batch_transforms:
+                    segment = normalize_batch(segment, gray_input=args.gray_input, size=get_batch_resize(args))
 
                 label = batch[4].tolist()
                 idx = batch[5].tolist()
 
-                logits = model(input_txt, attn_mask, input_img, segment)
+                with amp.autocast():
+                    logits = model(input_txt, attn_mask, input_img, segment)
+                logits = logits.float()
 
             labels.extend(label)
             idx_lst.extend(idx)
@@ -509,15 +610,63 @@ def test(args, model, eval_dataset):
             results_lst.extend(result)
     return results_lst, labels, eval_losses, idx_lst  # results, labels
 
+def eval_worker(args, model, tokenizer, transforms):
+    """scores the checkpoints of a run with --async_eval on the validation set as they are written (utils/eval_worker.py)"""
+    if args.label_conditioned:
+        print('Load Valid dataset', args.label_conditioned_valid_dataset)
+        val_dataset = CXR_Retrieval_Dataset(args.label_conditioned_valid_dataset, tokenizer, transforms, args, is_train=False)
+    else:
+        print('Load Valid dataset', args.studyID_valid_dataset)
+        val_dataset = CXR_Retrieval_Dataset(args.studyID_valid_dataset, tokenizer, transforms, args, is_train=False)
+    # whole groups of eval_len_size candidates, the ranks are computed per group
+    groups = subsample_indices(len(val_dataset) // args.eval_len_size, args.eval_subsample, seed=args.seed)
+    rows = [g * args.eval_len_size + j for g in groups for j in range(args.eval_len_size)]
+    collate = functools.partial(collate_fn, args=args, pad_id=val_dataset.vocab_stoi["[PAD]"]) \
+        if args.length_bucket else None
+    eval_dataloader = DataLoader(Subset(val_dataset, rows), batch_size=args.batch_size, num_workers=args.num_workers,
+                                 collate_fn=collate)
+    direction = 'i2t' if args.i2t else 't2i'
+
+    def score(state):
+        model.load_state_dict(state['model'])
+        test_result, test_label, test_losses, idx_lst = test(args, model, eval_dataloader)
+        eval_result, _, mrr_score, recall_precision_results = evaluate(args, test_result, test_label, idx_lst)
+        rank_accs = eval_result[direction + '_retrieval']
+        recall = recall_precision_results[direction + '_recall']
+        precision = recall_precision_results[direction + '_precision']
+        result = {'eval_rows': len(rows), 'test_loss': float(np.mean(test_losses)), 'mrr_score': float(mrr_score)}
+        for k in ('R@1', 'R@5', 'R@10'):
+            n = k[2:]
+            result['Hit@' + n] = float(rank_accs[k])
+            result['Recall@' + n] = float(recall[k])
+            result['Precision@' + n] = float(precision[k])
+        return result
+
+    worker = EvalWorker(args.eval_worker, args.eval_metrics_file, args.eval_poll)
+    worker.run(score)
+
+
 def main(args):
 
-    wandb.init(config=args, project='Retrieval')
+    dist_device = init_distributed(args.dist_backend, args.with_cuda)
+    if args.output_path is None:
+        # the start time of rank 0 for every rank, each one would take its own otherwise
+        args.output_path = broadcast_object('output/' + str(datetime.now()))
+    if is_main_process() and not os.path.exists(args.output_path):
+        os.makedirs(args.output_path)
+        os.chmod(args.output_path, 0o777)
+    # --telemetry wandb only, rank 0 of the training run
+    init_wandb('none' if args.eval_worker else args.telemetry, args, project='Retrieval')
 
-    set_seed(args.seed)
+    set_seed(args.seed + get_rank())
 
     cuda_condition = torch.cuda.is_available() and args.with_cuda
-    args.device = torch.device("cuda" if cuda_condition else "cpu")
-    args.n_gpu = torch.cuda.device_count()
+    args.device = torch.device("cuda" if cuda_condition else "cpu") if dist_device is None else dist_device
+    args.n_gpu = torch.cuda.device_count() if cuda_condition else 0
+    if args.eval_worker and args.eval_device:
+        args.device = torch.device(args.eval_device)
+    if args.device.type == 'cpu':
+        set_cpu_threads(args.cpu_threads, args.cpu_interop_threads)
     print(f'Device: {args.device}, n_gpu: {args.n_gpu}')
 
     if args.bert_model == "albert-base-v2":
@@ -551,12 +700,19 @@ def main(args):
             model = CNN_BERT(config, args).to(args.device)
         elif args.do_test:
             config = AutoConfig.from_pretrained(args.load_pretrained_model)
-            model_state_dict = torch.load(os.path.join(args.load_pretrained_model, 'pytorch_model.bin'))
+            model_state_dict = torch.load(os.path.join(args.load_pretrained_model, 'pytorch_model.bin'), map_location='cpu')
             model = CNN_BERT.from_pretrained(args.load_pretrained_model, state_dict=model_state_dict, config=config, args=args).to(args.device)
 
-    wandb.watch(model)
+    if args.eval_worker:
+        eval_worker(args, model, tokenizer, transforms)
+        return
+
+    if args.wandb_watch:
+        watch_wandb(args.telemetry, model)  # gradient hooks on every parameter, off by default
 
-    if args.with_cuda and args.n_gpu > 1:
+    if is_distributed():
+        model = wrap_ddp(model, args.device)
+    elif args.with_cuda and args.n_gpu > 1:
         model = nn.DataParallel(model, device_ids=args.cuda_devices)
     if args.do_train:
         print("Load Train dataset", args.train_dataset)
@@ -569,12 +725,25 @@ def main(args):
             val_dataset = CXR_Retrieval_Dataset(args.studyID_valid_dataset, tokenizer, transforms, args,
                                                 is_train=False)
 
-        train_dataloader = DataLoader(train_dataset, batch_size=args.batch_size, num_workers=args.num_workers, shuffle=True)
-        eval_dataloader = DataLoader(val_dataset, batch_size=args.batch_size, num_workers=args.num_workers)
+        if args.length_bucket:
+            # batches of reports of similar length, text padded only to the longest report of the batch
+            collate = functools.partial(collate_fn, args=args, pad_id=train_dataset.vocab_stoi["[PAD]"])
+            train_sampler = LengthBucketBatchSampler(train_dataset.text_lengths(), args.batch_size, seed=args.seed,
+                                                     num_replicas=get_world_size(), rank=get_rank())
+            train_dataloader = DataLoader(train_dataset, batch_sampler=train_sampler, num_workers=args.num_workers,
+                                          collate_fn=collate)
+            eval_dataloader = DataLoader(val_dataset, batch_size=args.batch_size, num_workers=args.num_workers,
+                                         collate_fn=collate)
+        else:
+            train_sampler = get_train_sampler(train_dataset, seed=args.seed)
+            train_dataloader = DataLoader(train_dataset, batch_size=args.batch_size, num_workers=args.num_workers,
+                                          sampler=train_sampler, shuffle=train_sampler is None)
+            eval_dataloader = DataLoader(val_dataset, batch_size=args.batch_size, num_workers=args.num_workers)
 
         train(args, train_dataloader, eval_dataloader, model, tokenizer, val_dataset)
 
-    if args.do_test:
+    if args.do_test and is_main_process():
+        model = unwrap_ddp(model)
 
         if args.label_conditioned:
             print("Load Test dataset", args.label_conditioned_test_dataset)
@@ -635,12 +804,16 @@ def main(args):
               f'Recall@1:{R1}, Recall@5:{R5}, Recall@10:{R10},'
               f'Precision@1:{P1}, Precision@5:{P5}, Precision@10:{P10}')
 
-        wandb.log({
+        telemetry = StepTelemetry(args.telemetry, args.output_path, args.device)
+        telemetry.log({
             "F_Hit@1": H1, "F_Hit@5": H5, "F_Hit@10": H10,
             "F_Recall@1": R1, "F_Recall@5": R5, "F_Recall@10": R10,
             "F_Precision@1": P1, "F_Precision@5": P5, "F_Precision@10": P10,
             "F_best_Hit1": best_score, "F_test_loss": np.mean(test_losses), "F_mrr_score": mrr_score,
-        },)
+        })
+        telemetry.close()
+
+    cleanup()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -661,6 +834,24 @@ if __name__ == '__main__':
     # must be deleted! after validation dataset
     # TODO: only MIMIC, PAR, set to True if not set to False
     parser.add_argument("--eval_during_training", type=bool, default=False, help="eval_druing_training")
+    parser.add_argument("--async_eval", type=bool, default=False,
+                        help="eval_during_training: a checkpoint per epoch for --eval_worker instead of test() inline")
+    parser.add_argument("--eval_worker", type=str, default=None,
+                        help="checkpoints directory of a run: score its checkpoints on the valid set, no training")
+    parser.add_argument("--eval_device", type=str, default=None, help="device of --eval_worker, e.g. cuda:1 or cpu")
+    parser.add_argument("--eval_subsample", type=int, default=0,
+                        help="--eval_worker: fixed random subset of n groups of eval_len_size rows, 0: all")
+    parser.add_argument("--eval_poll", type=int, default=30, help="--eval_worker: seconds between two looks")
+    parser.add_argument("--eval_metrics_file", type=str, default=None,
+                        help="--eval_worker: jsonl the results are appended to, <checkpoints>/eval_metrics.jsonl")
+    parser.add_argument("--telemetry", type=str, default="jsonl", choices=TELEMETRY_SINKS,
+                        help="time per step of data wait, h2d, forward, backward and optimizer, throughput and peak "
+                             "memory to output_path/telemetry.jsonl (.csv), epoch metrics to metrics.jsonl; wandb: "
+                             "also both to a wandb run, the only sink needing wandb")
+    parser.add_argument("--telemetry_every", type=int, default=50,
+                        help="steps buffered between two telemetry writes (one cuda synchronize each)")
+    parser.add_argument("--wandb_watch", type=bool, default=False,
+                        help="--telemetry wandb: wandb.watch the model, gradient histograms, hooks on every parameter")
 
     # TODO: label_conditioned or just study_id matching !
     # TODO: Choose dataset, mimic or openI
@@ -710,18 +901,20 @@ if __name__ == '__main__':
                                  '/home/data_storage/mimic-cxr/dataset/retrieval/openi/T2I_ID_Test_openi.jsonl',
                                  '/home/data_storage/mimic-cxr/dataset/retrieval/openi/I2T_ID_Test_openi.jsonl',])
 
-    output_path = 'output/' + str(datetime.now())
-    if not os.path.exists(output_path):
-        os.mkdir(output_path)
-        os.chmod(output_path, 0o777)
-
-    parser.add_argument("--output_path", type=str, default=output_path, help="ex)path/to/save/model")
+    parser.add_argument("--output_path", type=str, default=None,
+                        help="ex)path/to/save/model, default output/<start time of the run>")
     parser.add_argument("--with_cuda", type=bool, default=True, help="training with CUDA: True or False")
     parser.add_argument("--cuda_devices", type=int, nargs='+', default=None, help="CUDA device ids")
+    parser.add_argument("--dist_backend", type=str, default="auto", choices=DIST_BACKENDS,
+                        help="torchrun launch: DistributedDataParallel backend, auto: nccl on cuda, gloo on cpu")
+    parser.add_argument("--cpu_threads", type=int, default=0, help="on cpu: intra-op threads, 0: torch default")
+    parser.add_argument("--cpu_interop_threads", type=int, default=0, help="on cpu: inter-op threads, 0: torch default")
 
     parser.add_argument("--epochs", type=int, default=10, help='number of epochs')
-    parser.add_argument("--batch_size", type=int, default=70, help="number of batch size")
+    parser.add_argument("--batch_size", type=int, default=70, help="number of batch size, per process with torchrun")
     parser.add_argument("--num_workers", type=int, default=0, help="dataloader worker size")
+    parser.add_argument("--length_bucket", type=bool, default=False,
+                        help="batch reports of similar length and pad the text to the longest one of the batch")
 
     # TODO: load pre-trained model or not
     parser.add_argument("--hidden_size", type=int, default=768, choices=[768, 512, 128])
@@ -766,18 +959,36 @@ if __name__ == '__main__':
     parser.add_argument("--img_postion", default=True, help='img_postion use!')
     parser.add_argument("--seq_len", type=int, default=128, help="maximum sequence len", choices=[253, 460])  # 253
     parser.add_argument("--max_seq_len", type=int, default=512, help="total sequence len")
+    parser.add_argument("--token_store", type=bool, default=False,
+                        help="read pre-tokenized reports built by data/token_store.py instead of tokenizing")
 
     parser.add_argument("--img_hidden_sz", type=int, default=2048)
     parser.add_argument("--img_encoder", type=str, default='full-fiber',
                         choices=['random-pixel', 'full-fiber', 'ViT'])
     # TODO: MIMIC OR OPENI, 3 or 1 channel
     parser.add_argument("--img_channel", type=int, default=1, choices=[1, 3])
+    parser.add_argument("--gray_input", type=bool, default=False,
+                        help="1-channel images, the RGB weights and normalization are folded into the first conv")
     parser.add_argument("--num_image_embeds", type=int, default=256, choices=[36, 49, 256])
     parser.add_argument("--img_size", type=int, default=512, choices=[224, 512])  # TODO: change helper.py, resize(224)
+    parser.add_argument("--image_store", type=bool, default=False,
+                        help="read decoded pixels built by data/image_store.py instead of decoding images")
+    parser.add_argument("--batch_transforms", type=bool, default=False,
+                        help="decoded uint8 images, Resize / Normalize run on the batch on the device")
+    parser.add_argument("--jpeg_draft", type=bool, default=False,
+                        help="img_size 224: decode jpgs near 224 in the DCT domain (data/jpeg_draft.py), then Resize")
+    parser.add_argument("--feature_store", type=bool, default=False,
+                        help="read ResNet-50 grids built by data/feature_store.py (CXRBERT only), the backbone is not run")
     parser.add_argument("--img_embed_pool_type", type=str, default="max", choices=["max", "avg"])
+    parser.add_argument("--grad_checkpoint", type=str, default="none", choices=["none", "layer", "attention"],
+                        help="activation checkpointing of the BERT encoder layers, see models/grad_checkpoint.py")
+    parser.add_argument("--grad_checkpoint_every", type=int, default=1,
+                        help="checkpoint every k-th layer (0, k, 2k, ...) with --grad_checkpoint")
 
     # -------------------------------------------------------------------------------------------
     # TODO: ...!
+    parser.add_argument("--mixed_precision", type=str, default="none", choices=["none", "fp16", "bf16"],
+                        help="torch.autocast compute dtype, fp16 with loss scaling (cuda), bf16 (cuda / cpu)")
     parser.add_argument("--lr", type=float, default=1e-5)
     parser.add_argument("--gradient_accumulation_steps", type=int, default=4)  # loss, optimizer.step() slowly
     parser.add_argument("--warmup", type=float, default=0.1)  # optimizer = BertAdam(warmup=args.warmup)
@@ -0,0 +1,5 @@
+import os
+
+# data/ of the repository root comes after this directory: the readers of the stores built there
+# (token_store, image_store, feature_store, jpeg_draft, ...) are imported as data.<name> instead of being copied here
+__path__.append(os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), *[os.pardir] * 4, 'data')))
@@ -9,6 +9,11 @@ import torch.nn as nn
 import torch.nn.functional as F
 import random
 from loader_utils import get_random_word, batch_list_to_batch_tensors, Pipeline
+from data.image_store import ImageStore, to_uint8_tensor
+from data.feature_store import FeatureStore
+from data.jpeg_draft import open_image
+from data.token_store import load_token_store
+from pytorch_pretrained_bert.attn_mask import attn_desc, FULL, S2S, BAR
 import torchvision.transforms as transforms
 from PIL import Image
 from PIL import ImageFile
@@ -155,6 +160,7 @@ def _create_entry(img, data, answer):
         'question'     : data['question'],
         'answer'       : answer,
         'answer_type'  : data['answer_type'],
+        'row'          : data['row'],
         'question_type': data['question_type'],
         'phrase_type'  : data['phrase_type'],
         'image_organ'  : data['image_organ']}
@@ -170,6 +176,8 @@ def _load_dataset(args, dataroot, name, img_id2val, label2ans):
     """
     data_path = os.path.join(dataroot, name + 'set.json')
     samples = json.load(open(data_path))
+    for row, sample in enumerate(samples):
+        sample['row'] = row  # row of the question in the token store
     samples = sorted(samples, key=lambda x: x['qid'])
     answer_path = os.path.join(dataroot, 'cache', '%s_target.pkl' % name)
     answers = cPickle.load(open(answer_path, 'rb'))
@@ -223,6 +231,12 @@ class Img2txtDataset(torch.utils.data.Dataset):
                 img_dat = [json.loads(l) for l in open(file_src)]
                 print('Loading {0} train JPG IDs!'.format(len(img_dat))) 
 
+            # reports pre-tokenized by data/token_store.py, word-pieces are looked back up from the ids
+            token_store = None
+            if args.token_store:
+                token_store = load_token_store(file_valid_jpgs if self.data_set == 'valid' else file_src,
+                                               len(img_dat), args.bert_model)
+
             for idx, src in enumerate(tqdm(img_dat)): # load each img path & txt
                 src_tk = src['img']
                 tgt_tk = src['text']
@@ -230,7 +244,8 @@ class Img2txtDataset(torch.utils.data.Dataset):
                 if tgt_label == []:
                     tgt_label = 'Others'
                 else: pass
-                self.ex_list.append((src_tk, tokenizer.tokenize(tgt_tk), 1, {'answer_type': ['dummy']}, {'image_organ': ['dummy']}))              
+                tgt_tokens = tokenizer.convert_ids_to_tokens(token_store.get(idx)) if token_store is not None else tokenizer.tokenize(tgt_tk)
+                self.ex_list.append((src_tk, tgt_tokens, 1, {'answer_type': ['dummy']}, {'image_organ': ['dummy']}))              
                 counter += 1        
 
         else:
@@ -244,8 +259,17 @@ class Img2txtDataset(torch.utils.data.Dataset):
 
             self.entries = _load_dataset(args, file_src, self.data_set, self.img_id2idx, self.label2ans) # dict을 원소로 갖는 리스트. train이라면 len(): 3064. test라면 len(): 451
 
+            token_store = None
+            if args.token_store:
+                question_path = os.path.join(file_src, self.data_set + 'set.json')
+                token_store = load_token_store(question_path, len(json.load(open(question_path))),
+                                               args.bert_model, preprocess='vqa_rad')
+
             for entry in self.entries:
-                tokens = pre_processing(self.tokenizer, entry['question'])
+                if token_store is not None:
+                    tokens = tokenizer.convert_ids_to_tokens(token_store.get(entry['row']))
+                else:
+                    tokens = pre_processing(self.tokenizer, entry['question'])
                 entry['q_token'] = tokens
                 answer = entry['answer']  
 
@@ -303,8 +327,6 @@ class Preprocess4Seq2seq(Pipeline):
         self.indexer = indexer  #tokenizer # function from token to token index
         self.max_len = max_len
         self.bar = bar
-        self._tril_matrix = torch.tril(torch.ones(
-            (max_len, max_len), dtype=torch.long))
         self.new_segment_ids = new_segment_ids
         self.always_truncate_tail = truncate_config.get(
             'always_truncate_tail', False)
@@ -326,6 +348,12 @@ class Preprocess4Seq2seq(Pipeline):
         self.res_Normalize = transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
         self.ans_proc = None
         self.load_vqa_set = load_vqa_set
+        self.image_store = ImageStore(args.image_store) if args.image_store else None
+        self.feature_store = FeatureStore(args.feature_store) if args.feature_store else None
+        self.gray_input = args.gray_input
+        self.batch_transforms = args.batch_transforms
+        # 224 inputs: jpgs decoded near 224 in the DCT domain, then Resize
+        self.draft_size = 224 if args.jpeg_draft and len_vis_input < 100 else None
 
     def __call__(self, instance):
         img_path, tokens_b, target, ans_type, organ = instance
@@ -348,37 +376,11 @@ class Preprocess4Seq2seq(Pipeline):
             segment_ids = [0] * (len(tokens_a)+2) + [1] * (len(tokens_b)+1)
 
         # For masked Language Models
-        # the number of prediction is sometimes less than max_pred when sequence is short
-        effective_length = len(tokens_b) # txt token length
-        n_pred = min(self.max_pred, max(1, int(round(effective_length * self.mask_prob)))) # masking 갯수
-        if self.tasks == 'report_generation':
-            # candidate positions of masked tokens
-            cand_pos = []
-            special_pos = set()
-            
-
-            for i, tk in enumerate(tokens):
-                if (i >= len(tokens_a)+2) and (tk != '[CLS]'):
-                    cand_pos.append(i)
-                else:
-                    special_pos.add(i)
-
-            
-            shuffle(cand_pos)
-            if random.random() > 0.5:   #Last SEP token 50% mask prob.
-                masked_pos = cand_pos[:n_pred-1]
-                masked_pos.append(len(tokens)-1)
-            else:
-                masked_pos = cand_pos[:n_pred]
-                
-            masked_tokens = [tokens[pos] for pos in masked_pos]
-
-            for pos in masked_pos:
-                tokens[pos] = '[MASK]'
-        else:
-            n_pred = 0
-            masked_pos = []
-            masked_tokens = []
+        # report_generation: masked per batch on the device by mlm_masking.Seq2seqMLMMasker (finetune.py),
+        # the zero masked_ids / masked_pos / masked_weights below are filled there
+        n_pred = 0
+        masked_pos = []
+        masked_tokens = []
         # when n_pred < max_pred, we only calculate loss within n_pred
         masked_weights = [1]*len(masked_tokens)
 
@@ -391,25 +393,18 @@ class Preprocess4Seq2seq(Pipeline):
         input_ids.extend([0] * n_pad)
         segment_ids.extend([0] * n_pad)
 
-        # self-attention mask
-        input_mask = torch.zeros(self.max_len, self.max_len, dtype=torch.long)
+        # self-attention mask descriptor, the max_len x max_len mask is built on the model side
         second_st, second_end = len(tokens_a)+2, len(tokens_a)+len(tokens_b)+3
 
         if self.bar:
-            input_mask[:, :len(tokens_a)+2].fill_(1)
-            input_mask[:len(tokens_a)+2, :].fill_(1)
-            input_mask[second_st:second_end, second_st:second_end].copy_(
-                self._tril_matrix[:second_end-second_st, :second_end-second_st])
+            input_mask = attn_desc(len(tokens_a)+2, second_st, second_end, BAR)
 
         elif self.bar == False:
             if self.mode == "s2s":
-                input_mask[:, :len(tokens_a)+2].fill_(1)
-                input_mask[second_st:second_end, second_st:second_end].copy_(
-                    self._tril_matrix[:second_end-second_st, :second_end-second_st])
+                input_mask = attn_desc(len(tokens_a)+2, second_st, second_end, S2S)
             
             elif self.mode == "bi":
-                input_mask = torch.tensor([1] * len(tokens) + [0] * n_pad, dtype=torch.long) \
-                    .unsqueeze(0).expand(self.max_len, self.max_len).clone()
+                input_mask = attn_desc(len(tokens_a)+2, second_st, len(tokens), FULL)
         
         # Zero Padding for masked target
         if self.max_pred > n_pred:
@@ -419,13 +414,26 @@ class Preprocess4Seq2seq(Pipeline):
             masked_weights.extend([0] * n_pad)
 
         # loading images
-        img = Image.open(img_path)
-        img = self.gray_scale_3ch(img)
-        if self.len_vis_input < 100:
-            img = self.Resize(img)
-        else: pass
-        img = self.ToTensor(img)
-        img = self.res_Normalize(img)
+        if self.feature_store is not None:
+            img = self.feature_store[self.feature_store.row_of(img_path)]  # fp16 ResNet-50 grid, the model skips its backbone
+        elif self.image_store is not None:
+            img = self.image_store[self.image_store.row_of(img_path)]  # uint8, normalized on the device by normalize_batch
+        elif self.batch_transforms:
+            # uint8 1 x H x W, Resize / Grayscale(3) / Normalize on the device by normalize_batch
+            img = to_uint8_tensor(open_image(img_path, "L", self.draft_size))
+        elif self.gray_input:
+            img = open_image(img_path, "L", self.draft_size)  # Normalize is folded into the first conv of the model
+            if self.len_vis_input < 100:
+                img = self.Resize(img)
+            img = self.ToTensor(img)
+        else:
+            img = open_image(img_path, size=self.draft_size)
+            img = self.gray_scale_3ch(img)
+            if self.len_vis_input < 100:
+                img = self.Resize(img)
+            else: pass
+            img = self.ToTensor(img)
+            img = self.res_Normalize(img)
         vis_pe = torch.arange(2048, dtype=torch.float)
         vis_pe = vis_pe.unsqueeze(0).expand(len(tokens_a), 2048)
 
@@ -454,12 +462,10 @@ class Preprocess4Seq2seq(Pipeline):
 
 class Preprocess4Seq2seqDecoder(Pipeline):
     """ Pre-processing steps for pretraining transformer """
-    def __init__(self, tokenizer, max_len, max_txt_length, new_segment_ids=False, mode="s2s", len_vis_input=None):
+    def __init__(self, tokenizer, max_len, max_txt_length, new_segment_ids=False, mode="s2s", len_vis_input=None, image_store=None, feature_store=None, gray_input=False, jpeg_draft=False, batch_transforms=False):
         super().__init__()
         self.tokenizer = tokenizer
         self.max_len = max_len
-        self._tril_matrix = torch.tril(torch.ones(
-            (max_len, max_len), dtype=torch.long))
         self.new_segment_ids = new_segment_ids
         self.task_idx = 3   # relax projection layer for different tasks
         self.mode = mode
@@ -472,6 +478,11 @@ class Preprocess4Seq2seqDecoder(Pipeline):
 
         self.ToTensor = transforms.ToTensor()
         self.res_Normalize = transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+        self.image_store = ImageStore(image_store) if image_store else None
+        self.feature_store = FeatureStore(feature_store) if feature_store else None
+        self.gray_input = gray_input
+        self.batch_transforms = batch_transforms
+        self.draft_size = 224 if jpeg_draft and len_vis_input < 100 else None
 
     def __call__(self, instance):
         img_path, max_a_len, original_text = instance[:3]        
@@ -505,8 +516,7 @@ class Preprocess4Seq2seqDecoder(Pipeline):
             position_ids.append(i - (max_a_len + 2) + len(tokens_a) + 2)
         # Token Indexing        
         input_ids = self.tokenizer.convert_tokens_to_ids(tokens)
-        gt_token = self.tokenizer.tokenize(original_text)
-        gt_token_id = self.tokenizer.convert_tokens_to_ids(gt_token)
+        gt_token_id = self.tokenizer.encode(original_text)
 
         while True:
             if len(gt_token_id)  <= self.max_txt_length:
@@ -518,22 +528,30 @@ class Preprocess4Seq2seqDecoder(Pipeline):
         gt_token_id.extend([0] * n_pad)        
         assert len(gt_token_id) == 128
         
-        input_mask = torch.zeros(
-            max_len_in_batch, max_len_in_batch, dtype=torch.long)
-
-        input_mask[:, :len(tokens_a)+2].fill_(1)
+        # max_len_in_batch x max_len_in_batch mask descriptor, built on the model side
         second_st, second_end = len(padded_tokens_a), max_len_in_batch
-
-        input_mask[second_st:second_end, second_st:second_end].copy_(
-            self._tril_matrix[:second_end-second_st, :second_end-second_st])
-
-        img = Image.open(img_path)
-        img = self.gray_scale_3ch(img)
-        if self.len_vis_input < 100:
-            img = self.Resize(img)
-        else: pass
-        img = self.ToTensor(img)
-        img = self.res_Normalize(img)
+        input_mask = attn_desc(len(tokens_a)+2, second_st, second_end, S2S)
+
+        if self.feature_store is not None:
+            img = self.feature_store[self.feature_store.row_of(img_path)]  # fp16 ResNet-50 grid, the model skips its backbone
+        elif self.image_store is not None:
+            img = self.image_store[self.image_store.row_of(img_path)]  # uint8, normalized on the device by normalize_batch
+        elif self.batch_transforms:
+            # uint8 1 x H x W, Resize / Grayscale(3) / Normalize on the device by normalize_batch
+            img = to_uint8_tensor(open_image(img_path, "L", self.draft_size))
+        elif self.gray_input:
+            img = open_image(img_path, "L", self.draft_size)  # Normalize is folded into the first conv of the model
+            if self.len_vis_input < 100:
+                img = self.Resize(img)
+            img = self.ToTensor(img)
+        else:
+            img = open_image(img_path, size=self.draft_size)
+            img = self.gray_scale_3ch(img)
+            if self.len_vis_input < 100:
+                img = self.Resize(img)
+            else: pass
+            img = self.ToTensor(img)
+            img = self.res_Normalize(img)
         
         vis_pe = torch.arange(2048, dtype=torch.float)
         vis_pe = vis_pe.unsqueeze(0).expand(len(tokens_a), 2048)
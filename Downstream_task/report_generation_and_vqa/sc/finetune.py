@@ -20,19 +20,23 @@ from tqdm import tqdm, trange
 from pathlib import Path
 import numpy as np
 import torch
-from torch.utils.data import DataLoader, RandomSampler
-from torch.utils.data.distributed import DistributedSampler
+from torch.utils.data import DataLoader, RandomSampler, BatchSampler
 import random
-import copy
 from transformers import AutoTokenizer, AutoModel, AutoModelForMaskedLM, AutoConfig
 from pytorch_pretrained_bert.tokenization import BertTokenizer
 from pytorch_pretrained_bert.model import BertForPreTrainingLossMask, BertForSeq2SeqDecoder
 from pytorch_pretrained_bert.optimization import BertAdam, warmup_linear
+from utils.amp import MixedPrecision
 from transformers import AutoTokenizer, AutoModel
 from loader_utils import batch_list_to_batch_tensors
+from data.image_store import normalize_batch
+from mlm_masking import Seq2seqMLMMasker
 import data_loader
 from data_parallel import DataParallelImbalance
-import wandb
+from utils.distributed import (DIST_BACKENDS, init_distributed, is_distributed, is_main_process, get_rank,
+                               get_world_size, wrap_ddp, accumulate, get_train_sampler, set_epoch, barrier, cleanup)
+from utils.checkpoint import CheckpointManager, ResumableBatchSampler, set_rng_state
+from utils.telemetry import TELEMETRY_SINKS, StepTelemetry, init_wandb, watch_wandb
 
 def _get_max_epoch_model(output_dir):
     fn_model_list = glob.glob(os.path.join(output_dir, "model.*.bin"))
@@ -75,6 +79,8 @@ def main():
 
     parser.add_argument('--max_pred', type=int, default=10,
                         help="Max tokens of prediction.")
+    parser.add_argument('--mlm_replay', action='store_true', default=False,
+                        help="reseed the MLM masking with (seed, step), same masks for the same step of every run")
     parser.add_argument('--s2s_prob', default=1, type=float,
                             help="Percentage of examples that are bi-uni-directional LM (seq2seq). This must be turned off!!!!!!! because this is not for seq2seq model!!!")
     parser.add_argument('--bi_prob', default=0, type=float,
@@ -91,6 +97,21 @@ def main():
                         type=str,
                         help="The output directory where the model predictions and checkpoints will be written.")
 
+    parser.add_argument('--checkpoint_every', default=0, type=int,
+                        help="full training state every n optimizer steps to output_dir/checkpoints, "
+                             "written in the background, 0: off")
+    parser.add_argument('--checkpoint_keep', default=2, type=int, help="newest checkpoints kept, 0: all")
+    parser.add_argument('--resume', default=None, type=str,
+                        help="checkpoint file, or a checkpoints directory for the newest one: continue at its step")
+    parser.add_argument('--telemetry', default='jsonl', type=str, choices=TELEMETRY_SINKS,
+                        help="time per step of data wait, h2d, forward, backward and optimizer, throughput and peak "
+                             "memory to output_dir/telemetry.jsonl (.csv), epoch metrics to metrics.jsonl; wandb: "
+                             "also both to a wandb run, the only sink needing wandb")
+    parser.add_argument('--telemetry_every', default=50, type=int,
+                        help="steps buffered between two telemetry writes (one cuda synchronize each)")
+    parser.add_argument('--wandb_watch', action='store_true',
+                        help="--telemetry wandb: wandb.watch the model, gradient histograms, hooks on every parameter")
+
     parser.add_argument("--log_file",
                         default="training.log",
                         type=str,
@@ -152,6 +173,15 @@ def main():
                             "Positive power of 2: static loss scaling value.\n")
     parser.add_argument('--amp', action='store_true', default = False,
                         help="Whether to use amp for fp16")
+    parser.add_argument('--mixed_precision', type=str, default='none', choices=['none', 'fp16', 'bf16'],
+                        help="torch.autocast compute dtype with fp32 weights, fp16 with loss scaling (cuda), bf16 (cuda / cpu). "
+                             "Replaces --fp16, which casts the model with half()")
+    parser.add_argument('--attn_impl', type=str, default='eager', choices=['eager', 'sdpa'],
+                        help="self-attention backend, sdpa: fused QKV + scaled_dot_product_attention (tests/test_attn_backend.py)")
+    parser.add_argument('--grad_checkpoint', type=str, default='none', choices=['none', 'layer', 'attention'],
+                        help="activation checkpointing of the encoder layers (models/grad_checkpoint.py at the repository root)")
+    parser.add_argument('--grad_checkpoint_every', type=int, default=1,
+                        help="checkpoint every k-th layer (0, k, 2k, ...) with --grad_checkpoint")
                         
     parser.add_argument('--new_segment_ids', default = False, action='store_true',
                         help="Use new segment ids for bi-uni-directional LM.")
@@ -166,12 +196,25 @@ def main():
                         help="max position embeddings")
 
     parser.add_argument('--image_root', type=str, default='/home/mimic-cxr/dataset/image_preprocessing/re_512_3ch/Train')
+    parser.add_argument('--image_store', type=str, default=None,
+                        help="prefix of a decoded-pixel store built by data/image_store.py for the training jsonl, e.g. Train_253.img512")
+    parser.add_argument('--feature_store', type=str, default=None,
+                        help="prefix of a ResNet-50 feature store built by data/feature_store.py for the training jsonl, "
+                             "e.g. Train_253.feat512, the image encoder backbone is not run")
+    parser.add_argument('--batch_transforms', action='store_true', default=False,
+                        help="decoded uint8 images, Resize / Normalize run on the batch on the device")
+    parser.add_argument('--jpeg_draft', action='store_true', default=False,
+                        help="len_vis_input < 100 (224 inputs): decode jpgs near 224 in the DCT domain, then Resize")
+    parser.add_argument('--gray_input', action='store_true', default=False,
+                        help="1-channel images, the RGB weights and normalization are folded into the first conv")
+    parser.add_argument('--token_store', action='store_true', default=False,
+                        help="read the reports / VQA-RAD questions pre-tokenized by data/token_store.py instead of tokenizing them")
     parser.add_argument('--split', type=str, nargs='+', default=['train', 'valid'])
 
     parser.add_argument('--world_size', default = 1, type = int,
                         help = 'number of distributed processes')
-    parser.add_argument('--dist_url', default='file://[PT_OUTPUT_DIR]/nonexistent_file', type = str,
-                        help = 'url used to set up distributed training')
+    parser.add_argument('--dist_backend', default='auto', type=str, choices=DIST_BACKENDS,
+                        help="torchrun launch: DistributedDataParallel backend, auto: nccl on cuda, gloo on cpu")
     parser.add_argument('--sche_mode', default='warmup_linear', type=str,
                         help="warmup_linear | warmup_constant | warmup_cosine")
     parser.add_argument('--drop_prob', default=0.1, type=float)
@@ -185,57 +228,58 @@ def main():
 
     args = parser.parse_args()
 
+    # launched by torchrun: one process per gpu (or cpu worker), ranks from its environment
+    dist_device = init_distributed(args.dist_backend, not args.no_cuda)
+    if dist_device is not None:
+        args.local_rank = int(os.environ.get('LOCAL_RANK', 0))
+        args.global_rank = get_rank()
+        args.world_size = get_world_size()
+
     print('global_rank: {}, local rank: {}'.format(args.global_rank, args.local_rank))
     args.max_seq_length = args.max_len_b + args.len_vis_input + 3 # +3 for 2x[SEP] and [CLS]
-    args.dist_url = args.dist_url.replace('[PT_OUTPUT_DIR]', args.output_dir)
     
     if args.tasks=='vqa':
-        wandb.init(config=args, project="VQA")
-        wandb.config["more"] = "custom"
+        init_wandb(args.telemetry, args, project="VQA")  # --telemetry wandb, rank 0
         args.src_file = '/home/mimic-cxr/dataset/data_RAD'
         args.file_valid_jpgs = '/home/mimic-cxr/dataset/vqa_rad_original_set.json'  
 
     else:
         if args.generation_dataset == 'mimic-cxr':
-            wandb.init(config=args, project="report_generation")
-            wandb.config["more"] = "custom"
+            init_wandb(args.telemetry, args, project="report_generation")
             args.src_file = '/home/mimic-cxr/new_dset/Train_253.jsonl'
             args.file_valid_jpgs = '/home/mimic-cxr/new_dset/Train_253.jsonl'
 
         else:
-            wandb.init(config=args, project="report_generation")
-            wandb.config["more"] = "custom"
+            init_wandb(args.telemetry, args, project="report_generation")
             args.src_file = '/home/mimic-cxr/dataset/open_i/Train_openi.jsonl'
             args.file_valid_jpgs = '/home/mimic-cxr/dataset/open_i/Valid_openi.jsonl'
 
     print(" # PID :", os.getpid())
     os.makedirs(args.output_dir, exist_ok=True)
-    json.dump(args.__dict__, open(os.path.join(
-        args.output_dir, 'opt.json'), 'w'), sort_keys=True, indent=2)
-
-    logging.basicConfig(
-        filename=os.path.join(args.output_dir, args.log_file),
-        filemode='w',
-        format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
-        datefmt='%m/%d/%Y %H:%M:%S',
-        level=logging.INFO)
+    if is_main_process():
+        json.dump(args.__dict__, open(os.path.join(
+            args.output_dir, 'opt.json'), 'w'), sort_keys=True, indent=2)
+
+        logging.basicConfig(
+            filename=os.path.join(args.output_dir, args.log_file),
+            filemode='w',
+            format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+            datefmt='%m/%d/%Y %H:%M:%S',
+            level=logging.INFO)
     logger = logging.getLogger(__name__)
 
-    if args.local_rank == -1 or args.no_cuda:
+    if dist_device is None:
         device = torch.device(
             "cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
         print("device",device)
         n_gpu = torch.cuda.device_count()
     else:
-        torch.cuda.set_device(args.local_rank)
-        device = torch.device("cuda", args.local_rank)
+        device = dist_device
         print("device",device)
-        n_gpu = 1
-        torch.distributed.init_process_group(backend='nccl', init_method = args.dist_url,
-            world_size=args.world_size, rank=args.global_rank)
+        n_gpu = 1 if device.type == 'cuda' else 0
             
     logger.info("device: {} n_gpu: {}, distributed training: {}, 16-bits training: {}".format(
-        device, n_gpu, bool(args.local_rank != -1), args.fp16))
+        device, n_gpu, is_distributed(), args.fp16))
 
     if args.gradient_accumulation_steps < 1:
         raise ValueError("Invalid gradient_accumulation_steps parameter: {}, should be >= 1".format(
@@ -244,15 +288,16 @@ def main():
     args.train_batch_size = int(
         args.train_batch_size / args.gradient_accumulation_steps)
 
-    # fix random seed
-    random.seed(args.seed)
-    np.random.seed(args.seed)
-    torch.manual_seed(args.seed)
-    torch.cuda.manual_seed(args.seed)
+    # fix random seed, per rank (DDP broadcasts the weights of rank 0)
+    seed = args.seed + get_rank()
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed(seed)
     torch.backends.cudnn.deterministic = True
     torch.backends.cudnn.benchmark = False
     if n_gpu > 0:
-        torch.cuda.manual_seed_all(args.seed)
+        torch.cuda.manual_seed_all(seed)
 
     tokenizer = BertTokenizer.from_pretrained(
         args.bert_model, do_lower_case=True)
@@ -282,18 +327,29 @@ def main():
             s2s_prob=args.s2s_prob, # this must be set to 1.
             bi_prob=args.bi_prob, tasks=args.tasks)
 
-        if args.world_size == 1:
-            train_sampler = RandomSampler(train_dataset, replacement=False)
+        # report_generation MLM masks are picked per batch on the device
+        mlm_masker = Seq2seqMLMMasker(tokenizer.vocab["[MASK]"], args.max_pred, args.mask_prob, args.len_vis_input + 2,
+                                      pad_id=tokenizer.vocab["[PAD]"], seed=seed, replay=args.mlm_replay)
+
+        if is_distributed():
+            train_sampler = get_train_sampler(train_dataset, seed=args.seed)
         else:
-            train_sampler = DistributedSampler(train_dataset)
+            train_sampler = RandomSampler(train_dataset, replacement=False)
 
+        # batch order from (seed, epoch), --resume skips the batches done (utils/checkpoint.py)
+        train_batch_sampler = ResumableBatchSampler(
+            BatchSampler(train_sampler, args.train_batch_size, drop_last=False), seed=args.seed)
         train_dataloader = torch.utils.data.DataLoader(train_dataset,
-            batch_size=args.train_batch_size, sampler=train_sampler, num_workers=args.num_workers,
+            batch_sampler=train_batch_sampler, num_workers=args.num_workers,
             collate_fn=batch_list_to_batch_tensors, pin_memory=True)
 
     t_total = int(len(train_dataloader) * args.num_train_epochs * 1. /
                 args.gradient_accumulation_steps)
 
+    if args.fp16 and args.mixed_precision != 'none':
+        raise ValueError("--fp16 and --mixed_precision are exclusive")
+    precision = MixedPrecision(args.mixed_precision, device)
+
     amp_handle = None
     if args.fp16 and args.amp:
         from apex import amp
@@ -319,7 +375,9 @@ def main():
             config_path=args.config_path, task_idx=task_idx_proj,
             max_position_embeddings=args.max_position_embeddings, label_smoothing=args.label_smoothing,
             fp32_embedding=args.fp32_embedding, cache_dir=args.output_dir+'/.pretrained_model_{}'.format(args.global_rank),
-            drop_prob=args.drop_prob, len_vis_input=args.len_vis_input, tasks=args.tasks)
+            drop_prob=args.drop_prob, len_vis_input=args.len_vis_input, tasks=args.tasks,
+            attn_impl=args.attn_impl, grad_checkpoint=args.grad_checkpoint,
+            grad_checkpoint_every=args.grad_checkpoint_every)
             
         print("scratch model's statedict : ")
         for param_tensor in model.state_dict():
@@ -352,7 +410,9 @@ def main():
             fp32_embedding=args.fp32_embedding, 
             cache_dir=args.output_dir+'/.pretrained_model_{}'.format(args.global_rank),
             drop_prob=args.drop_prob, 
-            len_vis_input=args.len_vis_input, tasks=args.tasks)
+            len_vis_input=args.len_vis_input, tasks=args.tasks,
+            attn_impl=args.attn_impl, grad_checkpoint=args.grad_checkpoint,
+            grad_checkpoint_every=args.grad_checkpoint_every)
 
         model.load_state_dict(model_recover, strict=False)
 
@@ -367,18 +427,15 @@ def main():
             model.bert.embeddings.position_embeddings.float()
             model.bert.embeddings.token_type_embeddings.float()
     model.to(device)
-    if args.local_rank != -1:
-        try:
-            from torch.nn.parallel import DistributedDataParallel as DDP
-        except ImportError:
-            raise ImportError(
-                "Please install apex from https://www.github.com/nvidia/apex to use distributed and fp16 training.")
-        model = DDP(model, device_ids = [args.local_rank], output_device = args.local_rank, find_unused_parameters=True)
+    if is_distributed():
+        # static_graph: the pooler output is dropped inside the forward, the same parameters every step
+        model = wrap_ddp(model, device)
 
     elif n_gpu > 1:
         model = DataParallelImbalance(model)
 
-    wandb.watch(model)
+    if args.wandb_watch:
+        watch_wandb(args.telemetry, model)  # gradient hooks on every parameter, off by default
     param_optimizer = list(model.named_parameters())
     no_decay = ['bias', 'LayerNorm.bias', 'LayerNorm.weight']
     optimizer_grouped_parameters = [
@@ -404,6 +461,18 @@ def main():
             logger.info("***** Recover optimizer: dynamic_loss_scale *****")
             optimizer.dynamic_loss_scale = True
 
+    # model, optimizer, loss scale, RNG and data position every checkpoint_every steps, written in the background
+    checkpoints = CheckpointManager(os.path.join(args.output_dir, 'checkpoints'),
+                                    every=args.checkpoint_every, keep=args.checkpoint_keep)
+    resume_state = checkpoints.load(args.resume) if args.resume else None
+    if resume_state is not None:
+        (model.module if hasattr(model, 'module') else model).load_state_dict(resume_state['model'])
+        optimizer.load_state_dict(resume_state['optimizer'])
+        precision.load_state_dict(resume_state['amp'])
+        mlm_masker.load_state_dict(resume_state['mlm_masker'])
+        global_step = resume_state['global_step']
+        resume_state = {k: resume_state[k] for k in ('epoch', 'step', 'rng')}  # the weights are not kept around
+
     logger.info("***** CUDA.empty_cache() *****")
     torch.cuda.empty_cache()
 
@@ -412,84 +481,125 @@ def main():
         model.train()
         print("Total Parameters:", sum([p.nelement() for p in model.parameters()]))
 
-        if recover_step:
+        if resume_state is not None:
+            start_epoch = resume_state['epoch']
+            print("start_epoch",start_epoch)
+        elif recover_step:
             start_epoch = recover_step+1
             print("start_epoch",start_epoch)
         else:
             start_epoch = 1
 
-        for i_epoch in trange(start_epoch, args.num_train_epochs+1, desc="Epoch"):
-            if args.local_rank >= 0:
-                train_sampler.set_epoch(i_epoch-1)
-            iter_bar = tqdm(train_dataloader, desc='Iter (loss=X.XXX)')
+        # data wait / h2d / forward / backward / optimizer time per step to output_dir/telemetry.jsonl
+        telemetry = StepTelemetry(args.telemetry, args.output_dir, device, every=args.telemetry_every)
+        for i_epoch in trange(start_epoch, args.num_train_epochs+1, desc="Epoch", disable=not is_main_process()):
+            set_epoch(train_dataloader, i_epoch-1)
+            # resumed mid-epoch: the batches done before the checkpoint are skipped, not loaded
+            start = resume_state['step'] if resume_state is not None and i_epoch == start_epoch else 0
+            if start:
+                train_batch_sampler.skip(start)
+            batches = iter(train_dataloader)
+            if resume_state is not None and i_epoch == start_epoch:
+                set_rng_state(resume_state['rng'])  # after iter(), which draws the worker seeds of the epoch
             nbatches = len(train_dataloader)
+            iter_bar = tqdm(telemetry.batches(batches), desc='Iter (loss=X.XXX)', total=nbatches, initial=start,
+                            disable=not is_main_process())
             train_loss = []
 
             avg_loss = 0.0
             batch_count = 0
-            for step, batch in enumerate(iter_bar):
-                batch = [t.to(device) for t in batch]
-                input_ids, segment_ids, input_mask, lm_label_ids, masked_pos, masked_weights, task_idx, img, vis_pe, ans_labels, ans_type, organ = batch
-                if args.fp16:
-                    img = img.half()
-                    vis_pe = vis_pe.half()
-
-                loss_tuple = model(img, vis_pe, input_ids, segment_ids,
-                    input_mask, lm_label_ids, ans_labels, masked_pos=masked_pos,
-                    masked_weights=masked_weights, task_idx=task_idx,
-                    drop_worst_ratio=args.max_drop_worst_ratio if i_epoch > args.drop_after else 0,
-                    ans_type=ans_type)
-
-                masked_lm_loss, vqa_loss = loss_tuple
-
-                batch_count += 1
-                if args.tasks == 'report_generation':
-                    masked_lm_loss = masked_lm_loss.mean()
-                    loss = masked_lm_loss
-                else:
-                    vqa_loss = vqa_loss.mean()
-                    loss = vqa_loss
-                    
-                iter_bar.set_description('Iter (loss=%5.3f)' %(loss.item()))
-                train_loss.append(loss.item())
-
-                if args.gradient_accumulation_steps > 1:
-                    loss = loss / args.gradient_accumulation_steps
-
-                loss.backward()
+            for step, batch in enumerate(iter_bar, start):
+                with telemetry.phase('h2d'):
+                    batch = [t.to(device) for t in batch]
+                    input_ids, segment_ids, input_mask, lm_label_ids, masked_pos, masked_weights, task_idx, img, vis_pe, ans_labels, ans_type, organ = batch
+                    if args.tasks == 'report_generation':
+                        input_ids, lm_label_ids, masked_pos, masked_weights = mlm_masker(
+                            input_ids, step=(i_epoch - 1) * nbatches + step)
+                    if args.image_store or args.batch_transforms:
+                        img = normalize_batch(img, gray_input=args.gray_input,
+                                              size=224 if args.len_vis_input < 100 else None)
+                    if args.fp16:
+                        img = img.half()
+                        vis_pe = vis_pe.half()
+
+                # DDP all-reduces only in the backward of the last micro-batch before the optimizer step
+                with accumulate(model, sync=(step + 1) % args.gradient_accumulation_steps == 0):
+                    with telemetry.phase('forward'):
+                        with precision.autocast():
+                            loss_tuple = model(img, vis_pe, input_ids, segment_ids,
+                                None, lm_label_ids, ans_labels, masked_pos=masked_pos,
+                                masked_weights=masked_weights, task_idx=task_idx,
+                                drop_worst_ratio=args.max_drop_worst_ratio if i_epoch > args.drop_after else 0,
+                                ans_type=ans_type, attn_desc=input_mask)
+
+                        masked_lm_loss, vqa_loss = loss_tuple
+
+                        batch_count += 1
+                        if args.tasks == 'report_generation':
+                            masked_lm_loss = masked_lm_loss.mean()
+                            loss = masked_lm_loss
+                        else:
+                            vqa_loss = vqa_loss.mean()
+                            loss = vqa_loss
+
+                    iter_bar.set_description('Iter (loss=%5.3f)' %(loss.item()))
+                    train_loss.append(loss.item())
+
+                    if args.gradient_accumulation_steps > 1:
+                        loss = loss / args.gradient_accumulation_steps
+
+                    with telemetry.phase('backward'):
+                        precision.backward(loss)
 
                 if (step + 1) % args.gradient_accumulation_steps == 0:
-                    lr_this_step = args.learning_rate * \
-                        warmup_linear(global_step/t_total,
-                                    args.warmup_proportion)
-                    if args.fp16:
-                        for param_group in optimizer.param_groups:
-                            param_group['lr'] = lr_this_step
-                    optimizer.step()
-                    optimizer.zero_grad()
+                    with telemetry.phase('optimizer'):
+                        lr_this_step = args.learning_rate * \
+                            warmup_linear(global_step/t_total,
+                                        args.warmup_proportion)
+                        if args.fp16:
+                            for param_group in optimizer.param_groups:
+                                param_group['lr'] = lr_this_step
+                        precision.step(optimizer)
+                        optimizer.zero_grad()
                     global_step += 1
-
-            wandb.log({"train_loss": np.mean(train_loss)})
+                    if checkpoints.should_save(global_step):
+                        checkpoints.save(global_step, {
+                            'epoch': i_epoch,
+                            'step': step + 1,
+                            'model': (model.module if hasattr(model, 'module') else model).state_dict(),
+                            'optimizer': optimizer.state_dict(),
+                            'amp': precision.state_dict(),
+                            'mlm_masker': mlm_masker.state_dict(),
+                        })
+                telemetry.record((i_epoch - 1) * nbatches + step + 1, samples=input_ids.size(0),
+                                 tokens=input_ids.numel(), epoch=i_epoch)
+
+            telemetry.end_epoch()
+            telemetry.log({"epoch": i_epoch, "train_loss": np.mean(train_loss)})
             logger.info(
                 "** ** * Saving fine-tuned model and optimizer ** ** * ")
             model_to_save = model.module if hasattr(
                 model, 'module') else model  # Only save the model it-self
             output_config_file = os.path.join(args.output_dir, 'config.json')
             
-            with open(output_config_file, 'w') as f:
-                f.write(model_to_save.config.to_json_string())
-            
             output_model_file = os.path.join(
                 args.output_dir, "model.{0}.bin".format(i_epoch))
             output_optim_file = os.path.join(
                 args.output_dir, "optim.{0}.bin".format(i_epoch))
-            if args.global_rank in (-1, 0): # save model if the first device or no dist
-                torch.save(copy.deepcopy(model_to_save).cpu().state_dict(), output_model_file)
+            if is_main_process(): # save model if the first device or no dist
+                with open(output_config_file, 'w') as f:
+                    f.write(model_to_save.config.to_json_string())
+                # cpu copy of the weights, torch.save in the background (no copy of the model on the gpu)
+                checkpoints.save_file(output_model_file, model_to_save.state_dict())
 
             logger.info("***** CUDA.empty_cache() *****")
             torch.cuda.empty_cache()
 
-            if args.world_size > 1:
-                torch.distributed.barrier()
+            barrier()
+        telemetry.close()
+
+    checkpoints.wait()
+    cleanup()
+
 if __name__ == "__main__":
     main()
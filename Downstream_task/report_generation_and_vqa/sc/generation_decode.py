@@ -462,7 +462,7 @@ def main():
                                 # input_ids, token_type_ids, position_ids, input_mask, task_idx, img, vis_pe = batch
 
                                 traces = model(img, vis_pe, input_ids,  token_type_ids, 
-                                        position_ids, input_mask, gt_token, device, task_idx=task_idx)
+                                        position_ids, None, gt_token, device, task_idx=task_idx, attn_desc=input_mask)
                                 
                                 if args.beam_size > 1:
                                     traces = {k: v.tolist() for k, v in traces.items()}
@@ -556,7 +556,7 @@ def main():
 
                                 
                                 traces = model(img, vis_pe, input_ids,  token_type_ids, 
-                                        position_ids, input_mask, gt_token, device, task_idx=task_idx)
+                                        position_ids, None, gt_token, device, task_idx=task_idx, attn_desc=input_mask)
                                 
                                 
                                 if args.beam_size > 1:
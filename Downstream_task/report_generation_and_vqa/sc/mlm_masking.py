@@ -0,0 +1,75 @@
+"""
+batched MLM masking for Preprocess4Seq2seq
+
+Picks the masked positions of a whole collated batch at once with a torch.Generator, after the batch is on the device,
+instead of shuffling candidate positions per sample in the DataLoader workers.
+
+Same semantics as the per-sample code it replaces:
+    candidates are the report tokens and the last [SEP] (positions >= len_vis_input + 2, not padding),
+    n_pred = min(max_pred, max(1, round(len(report) * mask_prob))) positions are replaced by [MASK],
+    with mask_last_sep, half of the reports always get the last [SEP] among their n_pred positions.
+    masked_ids / masked_pos / masked_weights are zero padded to max_pred.
+
+replay=True reseeds the generator with (seed, step) for every batch, so the masks of a step can be reproduced.
+"""
+import torch
+
+
+class Seq2seqMLMMasker(object):
+    def __init__(self, mask_id, max_pred, mask_prob, vis_len, pad_id=0, mask_last_sep=True, seed=0, replay=False):
+        self.mask_id = mask_id
+        self.max_pred = max_pred
+        self.mask_prob = mask_prob
+        self.vis_len = vis_len  # [CLS] + visual tokens + [SEP]
+        self.pad_id = pad_id
+        self.mask_last_sep = mask_last_sep
+        self.seed = seed
+        self.replay = replay
+        self.generators = {}
+
+    def get_generator(self, device, step=None):
+        if device not in self.generators:
+            self.generators[device] = torch.Generator(device=device)
+            self.generators[device].manual_seed(self.seed)
+        generator = self.generators[device]
+        if self.replay:
+            assert step is not None, 'replay mode needs the step of the batch'
+            generator.manual_seed(self.seed * 1000003 + step)
+        return generator
+
+    def state_dict(self):
+        # generator states of the devices, resumed checkpoints continue the same mask stream
+        return {str(device): generator.get_state() for device, generator in self.generators.items()}
+
+    def load_state_dict(self, state_dict):
+        for device, state in state_dict.items():
+            device = torch.device(device)
+            self.generators[device] = torch.Generator(device=device)
+            self.generators[device].set_state(state)
+
+    def __call__(self, input_ids, step=None):
+        """input_ids: B x L -> masked input_ids, masked_ids, masked_pos, masked_weights (B x max_pred)"""
+        generator = self.get_generator(input_ids.device, step)
+        pos = torch.arange(input_ids.size(1), device=input_ids.device).unsqueeze(0)
+        cand = (pos >= self.vis_len) & (input_ids != self.pad_id)
+        n_cand = cand.sum(1)
+        last_sep = (n_cand + self.vis_len - 1).unsqueeze(1)
+
+        n_pred = torch.round((n_cand - 1).float() * self.mask_prob).long().clamp(min=1, max=self.max_pred)
+
+        # random order of the candidates, non-candidates last
+        keys = torch.rand(input_ids.shape, generator=generator, device=input_ids.device)
+        keys = keys.masked_fill(~cand, 2.)
+        if self.mask_last_sep:
+            with_sep = torch.rand(input_ids.size(0), 1, generator=generator, device=input_ids.device) > 0.5
+            keys = keys.masked_fill(with_sep & (pos == last_sep), -1.)
+        order = keys.argsort(dim=1)[:, :self.max_pred]
+
+        masked_weights = (torch.arange(self.max_pred, device=input_ids.device).unsqueeze(0) < n_pred.unsqueeze(1)).long()
+        masked_pos = order * masked_weights
+        masked_ids = input_ids.gather(1, masked_pos) * masked_weights
+
+        input_ids = input_ids.clone()
+        input_ids.scatter_(1, masked_pos, torch.where(masked_weights.bool(), torch.full_like(masked_pos, self.mask_id),
+                                                      input_ids.gather(1, masked_pos)))
+        return input_ids, masked_ids, masked_pos, masked_weights
@@ -1,4 +1,11 @@
-from .tokenization import BertTokenizer, BasicTokenizer, WordpieceTokenizer
-from .model import (BertConfig, BertModel, BertForPreTrainingLossMask)
-from .optimization import BertAdam, BertAdamFineTune
-from .file_utils import PYTORCH_PRETRAINED_BERT_CACHE
+import os
+
+# models/ of the repository root comes after this directory: the code shared with the pre-training model
+# (gray_input, grad_checkpoint, conv_bn_fold, attn_mask, ...) is imported from there as pytorch_pretrained_bert.<name>
+# instead of being copied here
+__path__.append(os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), *[os.pardir] * 4, 'models')))
+
+from .tokenization import BertTokenizer, BasicTokenizer, WordpieceTokenizer
+from .model import (BertConfig, BertModel, BertForPreTrainingLossMask)
+from .optimization import BertAdam, BertAdamFineTune
+from .file_utils import PYTORCH_PRETRAINED_BERT_CACHE
@@ -22,6 +22,11 @@ import torch.nn.functional as F
 
 from .file_utils import cached_path
 from .loss import LabelSmoothingLoss
+from .attn_mask import build_attn_mask
+from .grad_checkpoint import set_grad_checkpoint
+from utils.amp import compute_dtype
+from .gray_input import fold_gray_input
+from .conv_bn_fold import FoldedBackbone, FoldedEncoder, use_folded
 import torchvision
 from torchvision.transforms import ToTensor
 from PIL import Image
@@ -33,39 +38,53 @@ from einops import rearrange
 from glob import glob
 
 
-class pixel_full_sampling(nn.Module):
-    def __init__(self):
+class pixel_full_sampling(FoldedEncoder):
+    def __init__(self, features=False, gray_input=False):
         super(pixel_full_sampling, self).__init__()
         # self.args = args
+        self.features = features  # inputs are ResNet-50 grids of the feature store
         model = torchvision.models.resnet50(pretrained=True)
         modules = list(model.children())[:-2]
         self.model = nn.Sequential(*modules)
+        if gray_input:
+            fold_gray_input(self.model)  # B x 1 x W x H inputs
+        self.folded = FoldedBackbone()  # eval without grad: BN folded into the convs, channels_last
 
         pool_func = (
             nn.AdaptiveAvgPool2d
         )
         self.pool = pool_func((3, 1))
     def forward(self, x):
-        out = self.model(x)
+        if self.features:
+            out = x.float()
+        else:
+            out = self.folded(self.model, x) if use_folded(self) else self.model(x)
         out = torch.flatten(out, start_dim=2) #out torch.Size([100, 2048, 3])
         out = out.transpose(1, 2).contiguous() #out torch.Size([100, 3, 2048])
-        vis_pe = torch.arange(out.size()[1], dtype=torch.long).cuda()
+        vis_pe = torch.arange(out.size()[1], dtype=torch.long, device=out.device)
         vis_pe = vis_pe.unsqueeze(0).expand(out.size()[0], out.size()[1])
         return out, vis_pe
 
-class pixel_random_sample(nn.Module):
+class pixel_random_sample(FoldedEncoder):
     def __init__(self, args):
         super(pixel_random_sample, self).__init__()
         self.args = args
         model = torchvision.models.resnet50(pretrained=True)
         modules = list(model.children())[:-2]
         self.model = nn.Sequential(*modules)
+        if args.gray_input:
+            fold_gray_input(self.model)  # B x 1 x W x H inputs
+        self.folded = FoldedBackbone()  # eval without grad: BN folded into the convs, channels_last
 
     def forward(self, x):
-        out = self.model(x)  # 512x512: torch.Size([16, 2048, 16, 16])
+        # --feature_store: x is already the grid of self.model, only the pixel sampling is done per step
+        if self.args.feature_store:
+            out = x.float()
+        else:
+            out = self.folded(self.model, x) if use_folded(self) else self.model(x)  # 512x512: [16, 2048, 16, 16]
         out = torch.flatten(out, start_dim=2)
         out = out.transpose(1, 2).contiguous()  # B x N x 2048
-        vis_pe = torch.arange(out.size()[1], dtype=torch.long).cuda()
+        vis_pe = torch.arange(out.size()[1], dtype=torch.long, device=out.device)
         vis_pe = vis_pe.unsqueeze(0).expand(out.size()[0], out.size()[1])
         num_range = out.size()[1]
         random_sampling = torch.randperm(num_range)[:self.args.len_vis_input]
@@ -121,7 +140,10 @@ class BertConfig(object):
                  initializer_range=0.02,
                  task_idx=None,
                  fp32_embedding=False,
-                 label_smoothing=None):
+                 label_smoothing=None,
+                 attn_impl="eager",
+                 grad_checkpoint="none",
+                 grad_checkpoint_every=1):
         """Constructs BertConfig.
 
         Args:
@@ -145,6 +167,10 @@ class BertConfig(object):
                 `BertModel`.
             initializer_range: The sttdev of the truncated_normal_initializer for
                 initializing all weight matrices.
+            attn_impl: "eager" (matmul / softmax / matmul) or "sdpa" (fused QKV projection +
+                torch.nn.functional.scaled_dot_product_attention), same parameters for both.
+            grad_checkpoint: activation checkpointing of the encoder layers, "none", "layer" or "attention"
+                (models/grad_checkpoint.py at the repository root), on every grad_checkpoint_every-th layer.
         """
         if isinstance(vocab_size_or_config_json_file, str):
             with open(vocab_size_or_config_json_file, "r", encoding='utf-8') as reader:
@@ -167,6 +193,9 @@ class BertConfig(object):
             self.task_idx = task_idx
             self.fp32_embedding = fp32_embedding
             self.label_smoothing = label_smoothing
+            self.attn_impl = attn_impl
+            self.grad_checkpoint = grad_checkpoint
+            self.grad_checkpoint_every = grad_checkpoint_every
         else:
             raise ValueError("First argument must be either a vocabulary size (int)"
                              "or the path to a pretrained model config file (str)")
@@ -275,6 +304,8 @@ class BertSelfAttention(nn.Module):
         self.value = nn.Linear(config.hidden_size, self.all_head_size)
 
         self.dropout = nn.Dropout(config.attention_probs_dropout_prob)
+        # config.json of released checkpoints have no attn_impl
+        self.sdpa = getattr(config, 'attn_impl', 'eager') == 'sdpa'
 
     def transpose_for_scores(self, x):
         new_x_shape = x.size()[
@@ -282,7 +313,34 @@ class BertSelfAttention(nn.Module):
         x = x.view(*new_x_shape)
         return x.permute(0, 2, 1, 3)
 
+    def sdpa_forward(self, hidden_states, attention_mask, history_states=None):
+        # one GEMM over the concatenated query / key / value weights, which stay separate parameters
+        # so checkpoints are the ones of the eager path
+        if history_states is None:
+            weight = torch.cat((self.query.weight, self.key.weight, self.value.weight), dim=0)
+            bias = torch.cat((self.query.bias, self.key.bias, self.value.bias), dim=0)
+            query, key, value = F.linear(hidden_states, weight, bias).chunk(3, dim=-1)
+        else:
+            x_states = torch.cat((history_states, hidden_states), dim=1)
+            query = self.query(hidden_states)
+            weight = torch.cat((self.key.weight, self.value.weight), dim=0)
+            bias = torch.cat((self.key.bias, self.value.bias), dim=0)
+            key, value = F.linear(x_states, weight, bias).chunk(2, dim=-1)
+
+        query_layer = self.transpose_for_scores(query)
+        key_layer = self.transpose_for_scores(key)
+        value_layer = self.transpose_for_scores(value)
+
+        # additive 0 / -10000 mask of get_extended_attention_mask, B x 1 x 1|L x L
+        context_layer = F.scaled_dot_product_attention(
+            query_layer, key_layer, value_layer, attn_mask=attention_mask.to(query_layer.dtype),
+            dropout_p=self.dropout.p if self.training else 0.0)
+        context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
+        return context_layer.view(*(context_layer.size()[:-2] + (self.all_head_size,)))
+
     def forward(self, hidden_states, attention_mask, history_states=None):
+        if self.sdpa:
+            return self.sdpa_forward(hidden_states, attention_mask, history_states=history_states)
         if history_states is None:
             mixed_query_layer = self.query(hidden_states)
             mixed_key_layer = self.key(hidden_states)
@@ -395,6 +453,9 @@ class BertEncoder(nn.Module):
         layer = BertLayer(config)
         self.layer = nn.ModuleList([copy.deepcopy(layer)
                                     for _ in range(config.num_hidden_layers)])
+        # config.json of released checkpoints have no grad_checkpoint
+        set_grad_checkpoint(self.layer, getattr(config, 'grad_checkpoint', 'none'),
+                            getattr(config, 'grad_checkpoint_every', 1))
 
     def forward(self, hidden_states, attention_mask, prev_embedding=None, prev_encoded_layers=None, output_all_encoded_layers=True):
         assert (prev_embedding is None) == (prev_encoded_layers is None), \
@@ -617,6 +678,13 @@ class PreTrainedBertModel(nn.Module):
         # label smoothing
         if ('label_smoothing' in kwargs) and kwargs['label_smoothing']:
             config.label_smoothing = kwargs['label_smoothing']
+        # attention backend
+        if ('attn_impl' in kwargs) and kwargs['attn_impl']:
+            config.attn_impl = kwargs['attn_impl']
+        # activation checkpointing
+        if ('grad_checkpoint' in kwargs) and kwargs['grad_checkpoint']:
+            config.grad_checkpoint = kwargs['grad_checkpoint']
+            config.grad_checkpoint_every = kwargs.get('grad_checkpoint_every') or 1
         if 'drop_prob' in kwargs:
             print('setting the new dropout rate!', kwargs['drop_prob'])
             config.attention_probs_dropout_prob = kwargs['drop_prob']
@@ -624,7 +692,7 @@ class PreTrainedBertModel(nn.Module):
 
         logger.info("Model config {}".format(config))
         # clean the arguments in kwargs
-        for arg_clean in ('config_path', 'type_vocab_size', 'relax_projection', 'task_idx', 'max_position_embeddings', 'fp32_embedding', 'label_smoothing', 'drop_prob'):
+        for arg_clean in ('config_path', 'type_vocab_size', 'relax_projection', 'task_idx', 'max_position_embeddings', 'fp32_embedding', 'label_smoothing', 'drop_prob', 'attn_impl', 'grad_checkpoint', 'grad_checkpoint_every'):
             if arg_clean in kwargs:
                 del kwargs[arg_clean]
 
@@ -812,7 +880,7 @@ class BertModel(PreTrainedBertModel):
         # effectively the same as removing these entirely.
         try:
             extended_attention_mask = extended_attention_mask.to(
-                dtype=next(self.parameters()).dtype)  # fp16 compatibility
+                dtype=compute_dtype(self))  # fp16 / autocast compatibility
         except StopIteration:
             extended_attention_mask = extended_attention_mask.to(dtype=torch.float16)
 
@@ -886,7 +954,7 @@ class ImageBertEmbeddings(nn.Module):
         )
         
         if self.args.img_postion:
-            position_ids = torch.arange(seq_len, dtype=torch.long).cuda()
+            position_ids = torch.arange(seq_len, dtype=torch.long, device=input_imgs.device)
             position_ids = position_ids.unsqueeze(0).expand(bsz, seq_len)
             position_embeddings = self.position_embeddings(position_ids)
             pos_vis_embeddings = self.position_embeddings(vis_pe)
@@ -917,7 +985,7 @@ class BertForPreTrainingLossMask(PreTrainedBertModel):
                 for p in c.parameters():
                     p.requires_grad = True
         elif args.img_encoding == 'fully_use_cnn':    
-            self.img_encoder = pixel_full_sampling()
+            self.img_encoder = pixel_full_sampling(features=bool(args.feature_store), gray_input=args.gray_input)
             for p in self.img_encoder.parameters():
                 p.requires_grad = False
             for c in list(self.img_encoder.children())[5:]:
@@ -944,7 +1012,10 @@ class BertForPreTrainingLossMask(PreTrainedBertModel):
         else:
             self.cls = BertPreTrainingHeads(config, bert.embeddings.word_embeddings.weight, num_labels=num_labels)
 
-    def get_extended_attention_mask(self, input_ids, token_type_ids, attention_mask):
+    def get_extended_attention_mask(self, input_ids, token_type_ids, attention_mask, attn_desc=None):
+        if attn_desc is not None:
+            # B x 4 descriptors of Preprocess4Seq2seq (attn_mask.py)
+            attention_mask = build_attn_mask(attn_desc, input_ids.size(1))
         if attention_mask is None:
             attention_mask = torch.ones_like(input_ids)
         if token_type_ids is None:
@@ -958,16 +1029,16 @@ class BertForPreTrainingLossMask(PreTrainedBertModel):
 
         try:
             extended_attention_mask = extended_attention_mask.to(
-                dtype=next(self.parameters()).dtype)  # fp16 compatibility
+                dtype=compute_dtype(self))  # fp16 / autocast compatibility
         except StopIteration:
             extended_attention_mask = extended_attention_mask.to(dtype=torch.float16)
 
         extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
         return extended_attention_mask
 
-    def forward(self, img, _, input_ids, token_type_ids=None, attention_mask=None, masked_lm_labels=None, ans_labels=None, masked_pos=None, masked_weights=None, task_idx=None, drop_worst_ratio=0.2, vqa_inference=False, ans_type=None): 
+    def forward(self, img, _, input_ids, token_type_ids=None, attention_mask=None, masked_lm_labels=None, ans_labels=None, masked_pos=None, masked_weights=None, task_idx=None, drop_worst_ratio=0.2, vqa_inference=False, ans_type=None, attn_desc=None): 
         vis_feats, vis_pe = self.img_encoder(img) # image region features
-        extended_attention_mask = self.get_extended_attention_mask(input_ids, token_type_ids, attention_mask)
+        extended_attention_mask = self.get_extended_attention_mask(input_ids, token_type_ids, attention_mask, attn_desc)
         img_embed_out = self.img_embeddings(input_ids[:, :self.len_vis_input+2], vis_feats, vis_pe, token_type_ids[:, :self.len_vis_input+2])  # img_embed_out: torch.Size([32, 5, 768])
         
         txt_embed_out = self.txt_embeddings(input_ids[:, self.len_vis_input+2:], token_type_ids[:, self.len_vis_input+2:])#, attention_mask[:, self.len_vis_input+2:, self.len_vis_input+2:])  # txt_embed_out: torch.Size([32, 507, 768])
@@ -1073,7 +1144,7 @@ class CXRBertDecoder(nn.Module):  # MultimodalBertEncoder, BERT
                 for p in c.parameters():
                     p.requires_grad = True
         elif args.img_encoding == 'fully_use_cnn':    
-            self.img_encoder = pixel_full_sampling()
+            self.img_encoder = pixel_full_sampling(features=bool(args.feature_store), gray_input=args.gray_input)
             for p in self.img_encoder.parameters():
                 p.requires_grad = False
             for c in list(self.img_encoder.children())[5:]:
@@ -1096,7 +1167,7 @@ class CXRBertDecoder(nn.Module):  # MultimodalBertEncoder, BERT
             raise NotImplementedError
         try:
             extended_attention_mask = extended_attention_mask.to(
-                dtype=next(self.parameters()).dtype)  # fp16 compatibility
+                dtype=compute_dtype(self))  # fp16 / autocast compatibility
         except StopIteration:
             extended_attention_mask = extended_attention_mask.to(dtype=torch.float16)
 
@@ -1153,7 +1224,10 @@ class BertForSeq2SeqDecoder(PreTrainedBertModel):
         self.ngram_size = ngram_size
         self.min_len = min_len
 
-    def forward(self, vis_feats, _, input_ids, token_type_ids, position_ids, attention_mask, gt_token, device, task_idx=None, sample_mode='greedy',):
+    def forward(self, vis_feats, _, input_ids, token_type_ids, position_ids, attention_mask, gt_token, device, task_idx=None, sample_mode='greedy', attn_desc=None):
+        if attn_desc is not None:
+            # B x 4 descriptors of Preprocess4Seq2seqDecoder (attn_mask.py)
+            attention_mask = build_attn_mask(attn_desc, position_ids.size(1))
         if self.search_beam_size > 1:
             return self.beam_search(vis_feats, input_ids, token_type_ids, position_ids, attention_mask, gt_token, device, task_idx)
         input_shape = list(input_ids.size())
@@ -1295,8 +1369,7 @@ class BertForSeq2SeqDecoder(PreTrainedBertModel):
 
             if len(total_scores) == 0:
                 k_ids = torch.reshape(kk_ids, [batch_size, K])
-                back_ptrs = torch.zeros(batch_size, K)#, dtype=torch.long)
-                back_ptrs = back_ptrs.type(torch.cuda.LongTensor)
+                back_ptrs = torch.zeros(batch_size, K, dtype=torch.long, device=kk_ids.device)
 
                 k_scores = torch.reshape(kk_scores, [batch_size, K])
             else:
@@ -1309,7 +1382,7 @@ class BertForSeq2SeqDecoder(PreTrainedBertModel):
                 k_scores, k_ids = torch.topk(kk_scores, k=K)
 
                 back_ptrs = torch.div(k_ids, K)#,  dtype=torch.int64)
-                back_ptrs = back_ptrs.type(torch.cuda.LongTensor)
+                back_ptrs = back_ptrs.long()
 
                 kk_ids = torch.reshape(kk_ids, [batch_size, K * K])
                 k_ids = torch.gather(kk_ids, 1, k_ids)
@@ -1419,9 +1492,9 @@ class BertForSeq2SeqDecoder(PreTrainedBertModel):
                             for i, wid in enumerate(cands):
                                 buf_matrix[bk, wid] = 1.0
                         forbid_word_mask = torch.tensor(
-                            buf_matrix, dtype=log_scores.dtype)
+                            buf_matrix, dtype=log_scores.dtype, device=log_scores.device)
                         forbid_word_mask = torch.reshape(
-                            forbid_word_mask, [batch_size * K, 1, vocab_size]).cuda()
+                            forbid_word_mask, [batch_size * K, 1, vocab_size])
                     else:
                         forbid_word_mask = None
             next_pos += 1
@@ -77,6 +77,25 @@ def load_vocab(vocab_file):
     return vocab
 
 
+class LRUCache(object):
+    """Small least-recently-used dict, picklable (the tokenizers are copied to the DataLoader workers)."""
+
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.data = collections.OrderedDict()
+
+    def get(self, key):
+        value = self.data.get(key)
+        if value is not None:
+            self.data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.data[key] = value
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+
 def whitespace_tokenize(text):
     """Runs basic whitespace cleaning and splitting on a peice of text."""
     text = text.strip()
@@ -102,6 +121,8 @@ class BertTokenizer(object):
             do_lower_case=do_lower_case, never_split=never_split)
         self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab)
         self.max_len = max_len if max_len is not None else int(1e12)
+        # basic token -> wordpiece ids, reports reuse a small vocabulary
+        self._ids_cache = LRUCache()
 
     def tokenize(self, text):
         split_tokens = []
@@ -110,6 +131,24 @@ class BertTokenizer(object):
                 split_tokens.append(sub_token)
         return split_tokens
 
+    def encode(self, text):
+        """Same as convert_tokens_to_ids(tokenize(text)), with the ids of every word cached."""
+        ids = []
+        for token in self.basic_tokenizer.tokenize(text):
+            token_ids = self._ids_cache.get(token)
+            if token_ids is None:
+                token_ids = tuple(self.vocab[t] for t in self.wordpiece_tokenizer.tokenize(token))
+                self._ids_cache.put(token, token_ids)
+            ids.extend(token_ids)
+        if len(ids) > self.max_len:
+            raise ValueError(
+                "Token indices sequence length is longer than the specified maximum "
+                " sequence length for this BERT model ({} > {}). Running this"
+                " sequence through BERT will result in indexing errors".format(
+                    len(ids), self.max_len)
+            )
+        return ids
+
     def convert_tokens_to_ids(self, tokens):
         """Converts a sequence of tokens into ids using the vocab."""
         ids = []
@@ -189,28 +228,40 @@ class BasicTokenizer(object):
         """
         self.do_lower_case = do_lower_case
         self.never_split = never_split
+        # whitespace token -> lower cased, accent stripped, punctuation split tokens
+        self._cache = LRUCache()
 
     def tokenize(self, text):
         """Tokenizes a piece of text."""
-        text = self._clean_text(text)
-        # This was added on November 1st, 2018 for the multilingual and Chinese
-        # models. This is also applied to the English models now, but it doesn't
-        # matter since the English models were not trained on any Chinese data
-        # and generally don't have any Chinese data in them (there are Chinese
-        # characters in the vocabulary because Wikipedia does have some Chinese
-        # words in the English Wikipedia.).
-        text = self._tokenize_chinese_chars(text)
+        if text.isascii():
+            # same as _clean_text + _tokenize_chinese_chars for ascii, without the per-character unicode lookups
+            text = text.translate(_ASCII_CLEAN_TABLE)
+        else:
+            text = self._clean_text(text)
+            # This was added on November 1st, 2018 for the multilingual and Chinese
+            # models. This is also applied to the English models now, but it doesn't
+            # matter since the English models were not trained on any Chinese data
+            # and generally don't have any Chinese data in them (there are Chinese
+            # characters in the vocabulary because Wikipedia does have some Chinese
+            # words in the English Wikipedia.).
+            text = self._tokenize_chinese_chars(text)
         orig_tokens = whitespace_tokenize(text)
-        split_tokens = []
+        output_tokens = []
         for token in orig_tokens:
-            if self.do_lower_case and token not in self.never_split:
-                token = token.lower()
-                token = self._run_strip_accents(token)
-            split_tokens.extend(self._run_split_on_punc(token))
-
-        output_tokens = whitespace_tokenize(" ".join(split_tokens))
+            split_tokens = self._cache.get(token)
+            if split_tokens is None:
+                split_tokens = self._tokenize_word(token)
+                self._cache.put(token, split_tokens)
+            output_tokens.extend(split_tokens)
         return output_tokens
 
+    def _tokenize_word(self, token):
+        if self.do_lower_case and token not in self.never_split:
+            token = token.lower()
+            token = self._run_strip_accents(token)
+        # accent stripping can leave whitespace-like marks out, split again as the full-text version does
+        return tuple(whitespace_tokenize(" ".join(self._run_split_on_punc(token))))
+
     def _run_strip_accents(self, text):
         """Strips accents from a piece of text."""
         text = unicodedata.normalize("NFD", text)
@@ -300,6 +351,11 @@ class WordpieceTokenizer(object):
         self.vocab = vocab
         self.unk_token = unk_token
         self.max_input_chars_per_word = max_input_chars_per_word
+        # char tries for the greedy longest match: every vocab entry for the start of a word,
+        # the "##" entries (without "##") for the rest of it
+        self._start_trie = _build_trie(self.vocab)
+        self._sub_trie = _build_trie(t[2:] for t in self.vocab if t.startswith("##"))
+        self._cache = LRUCache()
 
     def tokenize(self, text):
         """Tokenizes a piece of text into its word pieces.
@@ -321,39 +377,54 @@ class WordpieceTokenizer(object):
 
         output_tokens = []
         for token in whitespace_tokenize(text):
-            chars = list(token)
-            if len(chars) > self.max_input_chars_per_word:
-                output_tokens.append(self.unk_token)
-                continue
-
-            is_bad = False
-            start = 0
-            sub_tokens = []
-            while start < len(chars):
-                end = len(chars)
-                cur_substr = None
-                while start < end:
-                    substr = "".join(chars[start:end])
-                    if start > 0:
-                        substr = "##" + substr
-                    if substr in self.vocab:
-                        cur_substr = substr
-                        break
-                    end -= 1
-                if cur_substr is None:
-                    is_bad = True
-                    break
-                sub_tokens.append(cur_substr)
-                start = end
-
-            if is_bad:
-                output_tokens.append(self.unk_token)
-                # print('bad!', text.encode('utf-8'))
-            else:
-                output_tokens.extend(sub_tokens)
-                # print('good')
+            sub_tokens = self._cache.get(token)
+            if sub_tokens is None:
+                sub_tokens = self._tokenize_word(token)
+                self._cache.put(token, sub_tokens)
+            output_tokens.extend(sub_tokens)
         return output_tokens
 
+    def _tokenize_word(self, token):
+        if len(token) > self.max_input_chars_per_word:
+            return (self.unk_token,)
+
+        start = 0
+        sub_tokens = []
+        while start < len(token):
+            end, cur_substr = _longest_match(self._start_trie if start == 0 else self._sub_trie, token, start)
+            if cur_substr is None:
+                return (self.unk_token,)
+            sub_tokens.append(cur_substr if start == 0 else "##" + cur_substr)
+            start = end
+        return tuple(sub_tokens)
+
+
+_TRIE_END = ""  # no char is an empty string
+
+
+def _build_trie(tokens):
+    trie = {}
+    for token in tokens:
+        if not token:
+            continue
+        node = trie
+        for char in token:
+            node = node.setdefault(char, {})
+        node[_TRIE_END] = token
+    return trie
+
+
+def _longest_match(trie, text, start):
+    """(end, text[start:end]) of the longest entry of trie starting at text[start], (start, None) if none"""
+    node, match = trie, (start, None)
+    for i in range(start, len(text)):
+        node = node.get(text[i])
+        if node is None:
+            break
+        if _TRIE_END in node:
+            match = (i + 1, node[_TRIE_END])
+    return match
+
 
 def _is_whitespace(char):
     """Checks whether `chars` is a whitespace character."""
@@ -367,6 +438,11 @@ def _is_whitespace(char):
     return False
 
 
+# ascii: control chars dropped, whitespace (\t, \n, \r) to " ", as _clean_text does
+_ASCII_CLEAN_TABLE = {cp: None for cp in list(range(32)) + [127] if chr(cp) not in "\t\n\r"}
+_ASCII_CLEAN_TABLE.update({ord(c): " " for c in "\t\n\r"})
+
+
 def _is_control(char):
     """Checks whether `chars` is a control character."""
     # These are technically control characters but we count them as whitespace
@@ -584,4 +660,4 @@ class BpeOnlineParallelApplier:
 
     def __call__(self, lines):
         assert len(self.bpe_appliers) == len(lines)
-        return tuple(applier(l) for applier, l in zip(self.bpe_appliers, lines))
\ No newline at end of file
+        return tuple(applier(l) for applier, l in zip(self.bpe_appliers, lines))
\ No newline at end of file
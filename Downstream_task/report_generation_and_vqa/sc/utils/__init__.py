@@ -0,0 +1,5 @@
+import os
+
+# utils/ of the repository root comes after this directory: the helpers shared with the pre-training code
+# (amp, distributed, checkpoint, telemetry, ...) are imported from there as utils.<name> instead of being copied here
+__path__.append(os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), *[os.pardir] * 4, 'utils')))
@@ -164,7 +164,9 @@ class CXR_Retrieval_Dataset(Dataset):
 
     def data_processing(self, origin_txt, img_path):
         if args.CXRBERT:
-            if self.args.img_channel == 3:
+            if self.args.gray_input:
+                image = Image.open(os.path.join(self.data_dir, img_path)).convert("L")
+            elif self.args.img_channel == 3:
                 image = Image.open(os.path.join(self.data_dir, img_path))
             elif self.args.img_channel == 1:
                 image = Image.open(os.path.join(self.data_dir, img_path))
@@ -229,7 +231,9 @@ class CXR_Retrieval_Dataset(Dataset):
             attn_masks = torch.tensor(attn_masks)
             segment = torch.tensor(segment)
 
-            if self.args.img_channel == 3:
+            if self.args.gray_input:
+                image = Image.open(os.path.join(self.data_dir, img_path)).convert("L")
+            elif self.args.img_channel == 3:
                 image = Image.open(os.path.join(self.data_dir, img_path))
             elif self.args.img_channel == 1:
                 image = Image.open(os.path.join(self.data_dir, img_path))
@@ -765,9 +769,15 @@ if __name__ == '__main__':
                         choices=['random-pixel', 'full-fiber', 'ViT'])
     # TODO: MIMIC OR OPENI, 3 or 1 channel
     parser.add_argument("--img_channel", type=int, default=1, choices=[1, 3])
+    parser.add_argument("--gray_input", type=bool, default=False,
+                        help="1-channel images, the RGB weights and normalization are folded into the first conv")
     parser.add_argument("--num_image_embeds", type=int, default=256, choices=[36, 49, 256])
     parser.add_argument("--img_size", type=int, default=512, choices=[224, 512])  # TODO: change helper.py, resize(224)
     parser.add_argument("--img_embed_pool_type", type=str, default="max", choices=["max", "avg"])
+    parser.add_argument("--grad_checkpoint", type=str, default="none", choices=["none", "layer", "attention"],
+                        help="activation checkpointing of the BERT encoder layers, see models/grad_checkpoint.py")
+    parser.add_argument("--grad_checkpoint_every", type=int, default=1,
+                        help="checkpoint every k-th layer (0, k, 2k, ...) with --grad_checkpoint")
 
     # -------------------------------------------------------------------------------------------
     # TODO: ...!
@@ -0,0 +1,407 @@
+"""
+data pipeline throughput benchmark
+
+Generates a synthetic corpus (X-ray sized jpgs + radiology-like reports + a local word-piece vocab, no downloads)
+and runs the datasets of the repository on it, on the CPU:
+    cxr:       data/dataset_origin.py CXRDataset (pre-training)
+    mmbt:      Downstream_task/Classification/mmbt JsonlDataset
+    img2txt:   Downstream_task/report_generation_and_vqa/sc Img2txtDataset (report generation)
+    retrieval: Downstream_task/Retrieval/full_dset_retrieval.py CXR_Retrieval_Dataset
+
+For every dataset it reports
+    samples/sec through a DataLoader for 0..max_workers workers (first batch, i.e. worker start-up, excluded)
+    ms/sample of each stage, timed one after the other on the same rows in the main process:
+        read (jpg bytes), decode, transform, tokenize, mask (MLM + attention mask build), collate,
+        batch_transform (--batch_transforms: Resize / Normalize of the collated uint8 images, on the CPU here)
+Each dataset runs in its own process, the subprojects have their own `data` package.
+
+Example:
+    $ python benchmark_data.py --max_workers 8
+    $ python benchmark_data.py --dataset cxr retrieval --num_rows 512 --output bench_data.json
+"""
+import os
+import io
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import functools
+import subprocess
+import numpy as np
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+MMBT_DIR = os.path.join(ROOT, 'Downstream_task', 'Classification', 'mmbt')
+SC_DIR = os.path.join(ROOT, 'Downstream_task', 'report_generation_and_vqa', 'sc')
+
+DATASETS = ['cxr', 'mmbt', 'img2txt', 'retrieval']
+STAGES = ['read', 'decode', 'transform', 'tokenize', 'mask', 'collate', 'batch_transform']
+
+SPECIAL_TOKENS = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]']
+REPORT_WORDS = ['the', 'there', 'is', 'are', 'no', 'new', 'left', 'right', 'lung', 'lungs', 'heart', 'size',
+                'normal', 'clear', 'mild', 'moderate', 'small', 'large', 'pleural', 'effusion', 'pneumothorax',
+                'consolidation', 'opacity', 'atelectasis', 'edema', 'cardiomegaly', 'silhouette', 'mediastinal',
+                'contour', 'stable', 'unchanged', 'compared', 'prior', 'study', 'chest', 'radiograph', 'portable',
+                'view', 'upright', 'frontal', 'lateral', 'base', 'bases', 'lower', 'upper', 'lobe', 'tube', 'line',
+                'catheter', 'tip', 'projects', 'over', 'within', 'limits', 'of', 'and', 'with', 'in', 'at', 'to',
+                'likely', 'possible', 'evidence', 'acute', 'process', 'vascular', 'congestion', 'findings']
+WORD_PIECES = ['##s', '##ed', '##ing', '##ly', '##al', '##ary', '##ic', '.', ',', ':', '-']
+LABELS = ["'Atelectasis'", "'Cardiomegaly'", "'Consolidation'", "'Edema'", "'Pleural Effusion'",
+          "'Pneumothorax'", "'Lung Opacity'", "'Support Devices'", "'No Finding'"]
+
+
+def make_report(rng):
+    sentences = []
+    for _ in range(rng.randint(3, 10)):
+        # some words only split into word-pieces (stem + ##s / ##ly ...)
+        words = [rng.choice(REPORT_WORDS) + (rng.choice(['s', 'ly', 'ed']) if rng.random() < 0.1 else '')
+                 for _ in range(rng.randint(4, 12))]
+        sentences.append(' '.join(words).capitalize() + '.')
+    return ' '.join(sentences)
+
+
+def make_image(rng, img_size):
+    """gray chest-like blob + noise, saved as the 3-channel jpgs of re_512_3ch"""
+    y, x = np.mgrid[-1:1:img_size * 1j, -1:1:img_size * 1j]
+    body = np.exp(-(x ** 2 / 0.5 + y ** 2 / 0.8)) * 180 + 30
+    noise = np.random.RandomState(rng.randint(0, 2 ** 31)).normal(0, 12, (img_size, img_size))
+    pixels = np.clip(body + noise, 0, 255).astype(np.uint8)
+    return Image.fromarray(pixels).convert('RGB')
+
+
+def make_corpus(out_dir, num_rows, img_size, seed=0):
+    """train.jsonl (id, split, label, text, img: absolute jpg path), images/, vocab/vocab.txt"""
+    rng = random.Random(seed)
+    os.makedirs(os.path.join(out_dir, 'images'), exist_ok=True)
+    os.makedirs(os.path.join(out_dir, 'vocab'), exist_ok=True)
+
+    with open(os.path.join(out_dir, 'vocab', 'vocab.txt'), 'w') as f:
+        f.write('\n'.join(SPECIAL_TOKENS + REPORT_WORDS + WORD_PIECES) + '\n')
+
+    with open(os.path.join(out_dir, 'train.jsonl'), 'w') as f:
+        for i in range(num_rows):
+            img_path = os.path.join(out_dir, 'images', f's{i:08d}.jpg')
+            make_image(rng, img_size).save(img_path, quality=95)
+            label = ', '.join(rng.sample(LABELS, rng.randint(1, 3)))
+            f.write(json.dumps({'id': f's{i:08d}', 'split': 'Train', 'label': label, 'text': make_report(rng),
+                                'img': img_path}) + '\n')
+    return out_dir
+
+
+class Bench():
+    """
+    dataset, collate_fn: what the entry point puts in its DataLoader
+    read / decode / transform: jpg path -> bytes -> image -> tensor, as the dataset does
+    tokenize: report -> ids, as the dataset does
+    mask: collated batch -> MLM masked ids and the attention masks, None if the dataset has none to build
+    batch_transform: collated batch -> model input images, None if the transforms run per sample
+    """
+    def __init__(self, dataset, collate_fn, decode, transform, tokenize, mask=None, read=None, batch_transform=None):
+        self.dataset = dataset
+        self.batch_transform = batch_transform
+        self.collate_fn = collate_fn
+        self.read = read if read is not None else read_bytes
+        self.decode = decode
+        self.transform = transform
+        self.tokenize = tokenize
+        self.mask = mask
+
+
+def read_bytes(img_path):
+    with open(img_path, 'rb') as f:
+        return f.read()
+
+
+def decode_jpg(data, mode=None, size=None):
+    image = Image.open(io.BytesIO(data))
+    if size is not None:
+        image.draft(mode if mode is not None else image.mode, (size, size))  # --jpeg_draft, data/jpeg_draft.py
+    return image.convert(mode) if mode is not None else image.copy()  # copy forces the decode
+
+
+def build_cxr(corpus, opt):
+    from transformers import BertTokenizer
+    from data.dataset_origin import CXRDataset
+    from data.helper import get_transforms
+    from data.helper import get_batch_resize
+    from data.image_store import normalize_batch, to_uint8_tensor
+    from data.length_bucket import cxr_collate_fn
+    from models.attn_mask import build_attn_mask
+
+    args = argparse.Namespace(
+        bert_model=os.path.join(corpus, 'vocab'), seq_len=253, max_seq_len=512, num_image_embeds=180, img_size=opt.img_size,
+        img_channel=3, gray_input=opt.gray_input, jpeg_draft=opt.jpeg_draft, batch_transforms=opt.batch_transforms, token_store=False, image_store=False, feature_store=False, seed=opt.seed, max_pred=64, mlm_replay=False,
+        Mixed=False, BAR_attn=True, disturbing_mask=False, s2s_prob=1.0, bi_prob=0.0)
+    tokenizer = BertTokenizer.from_pretrained(args.bert_model, do_lower_case=True).tokenize
+    dataset = CXRDataset(os.path.join(corpus, 'train.jsonl'), tokenizer, get_transforms(args), args)
+
+    def mask(batch):
+        cls_tok, input_ids, txt_labels, attn_masks, img, segment, is_aligned, sep_tok, itm_prob = batch
+        dataset.mlm_masker(input_ids)
+        return build_attn_mask(attn_masks, args.num_image_embeds + 2 + input_ids.size(1))
+
+    transform, batch_transform = dataset.transforms, None
+    if opt.batch_transforms:
+        transform = to_uint8_tensor
+        batch_transform = lambda batch: normalize_batch(batch[4], gray_input=args.gray_input, size=get_batch_resize(args))
+
+    return Bench(dataset, functools.partial(cxr_collate_fn, pad_id=dataset.pad_id),
+                 functools.partial(decode_jpg, mode='L' if opt.gray_input else 'RGB', size=dataset.draft_size),
+                 transform, lambda txt: dataset.encode_txt(0, txt), mask, batch_transform=batch_transform)
+
+
+def build_mmbt(corpus, opt):
+    from pytorch_pretrained_bert import BertTokenizer
+    from data.dataset import JsonlDataset
+    from data.helpers import get_transforms, get_labels_and_frequencies, get_vocab, collate_fn
+    from data.image_store import normalize_batch, to_uint8_tensor
+
+    args = argparse.Namespace(
+        bert_model=os.path.join(corpus, 'vocab'), model='mmbt', task_type='multilabel', openi=False,
+        max_seq_len=512, num_image_embeds=3, drop_img_percent=0.0, token_store=False, image_store=False, feature_store=False,
+        img_size=opt.img_size, gray_input=opt.gray_input, batch_transforms=opt.batch_transforms)
+    data_path = os.path.join(corpus, 'train.jsonl')
+    args.labels, args.label_freqs = get_labels_and_frequencies(data_path)
+    tokenizer = BertTokenizer.from_pretrained(args.bert_model, do_lower_case=True).tokenize
+    vocab = get_vocab(args)
+    dataset = JsonlDataset(data_path, tokenizer, get_transforms(args), vocab, args)
+
+    def tokenize(txt):
+        return [vocab.stoi[w] if w in vocab.stoi else vocab.stoi["[UNK]"] for w in tokenizer(txt)]
+
+    transform, batch_transform = dataset.transforms, None
+    if opt.batch_transforms:
+        transform = lambda image: to_uint8_tensor(image.convert('L' if opt.gray_input else 'RGB'))
+        batch_transform = lambda batch: normalize_batch(batch[3], gray_input=args.gray_input)
+
+    # the 1d attention mask is part of collate_fn
+    return Bench(dataset, functools.partial(collate_fn, args=args), decode_jpg, transform, tokenize,
+                 batch_transform=batch_transform)
+
+
+def build_img2txt(corpus, opt):
+    from pytorch_pretrained_bert.tokenization import BertTokenizer
+    from pytorch_pretrained_bert.attn_mask import build_attn_mask
+    from loader_utils import batch_list_to_batch_tensors
+    from mlm_masking import Seq2seqMLMMasker
+    from data.image_store import normalize_batch, to_uint8_tensor
+    import data_loader
+
+    len_vis_input = 256 if opt.img_size == 512 else 49
+    args = argparse.Namespace(tasks='report_generation', image_store=None, feature_store=None, token_store=False, gray_input=opt.gray_input,
+                              jpeg_draft=opt.jpeg_draft, batch_transforms=opt.batch_transforms,
+                              bert_model='bert-base-uncased', vqa_rad='all', max_len_b=253, max_seq_length=len_vis_input + 253 + 3, max_pred=10,
+                              mask_prob=0.15)
+    tokenizer = BertTokenizer.from_pretrained(os.path.join(corpus, 'vocab'), do_lower_case=True)
+    truncate_config = {'max_len_b': args.max_len_b, 'trunc_seg': 'b', 'always_truncate_tail': True}
+    pipeline = data_loader.Preprocess4Seq2seq(args, args.max_pred, args.mask_prob, list(tokenizer.vocab.keys()),
+                                              tokenizer.convert_tokens_to_ids, args.max_seq_length, False,
+                                              truncate_config=truncate_config, mode="s2s", len_vis_input=len_vis_input)
+    data_path = os.path.join(corpus, 'train.jsonl')
+    dataset = data_loader.Img2txtDataset(args, 'train', data_path, os.path.dirname(data_path), ['train'],
+                                         opt.batch_size, tokenizer, args.max_seq_length, file_valid_jpgs=data_path,
+                                         bi_uni_pipeline=[pipeline], s2s_prob=1, bi_prob=0, tasks=args.tasks)
+    mlm_masker = Seq2seqMLMMasker(tokenizer.vocab["[MASK]"], args.max_pred, args.mask_prob, len_vis_input + 2,
+                                  pad_id=tokenizer.vocab["[PAD]"], seed=opt.seed)
+
+    def transform(image):
+        if opt.batch_transforms:
+            return to_uint8_tensor(image.convert('L'))
+        if opt.gray_input:
+            image = image.convert('L')
+            return pipeline.ToTensor(pipeline.Resize(image) if pipeline.len_vis_input < 100 else image)
+        image = pipeline.gray_scale_3ch(image)
+        if pipeline.len_vis_input < 100:
+            image = pipeline.Resize(image)
+        return pipeline.res_Normalize(pipeline.ToTensor(image))
+
+    def mask(batch):
+        input_ids, segment_ids, input_mask = batch[:3]
+        mlm_masker(input_ids)
+        return build_attn_mask(input_mask, input_ids.size(1))
+
+    # the report is tokenized when the dataset is built, ids are looked up per sample
+    def batch_transform(batch):
+        return normalize_batch(batch[7], gray_input=args.gray_input, size=224 if len_vis_input < 100 else None)
+
+    return Bench(dataset, batch_list_to_batch_tensors, functools.partial(decode_jpg, size=pipeline.draft_size), transform,
+                 lambda txt: tokenizer.convert_tokens_to_ids(tokenizer.tokenize(txt)), mask,
+                 batch_transform=batch_transform if opt.batch_transforms else None)
+
+
+def build_retrieval(corpus, opt):
+    import torch
+    from transformers import BertTokenizer
+    from data.helper import get_transforms, get_batch_resize
+    from data.image_store import normalize_batch, to_uint8_tensor
+    import Downstream_task.Retrieval.full_dset_retrieval as retrieval
+
+    args = argparse.Namespace(
+        bert_model=os.path.join(corpus, 'vocab'), seq_len=128, max_seq_len=512, num_image_embeds=256,
+        img_size=opt.img_size, img_channel=1, gray_input=opt.gray_input, jpeg_draft=opt.jpeg_draft, batch_transforms=opt.batch_transforms, token_store=False, image_store=False, feature_store=False,
+        label_conditioned=True, MIMIC_dset=True, CXRBERT=True)
+    retrieval.args = args  # the dataset reads the module level args of the script
+    tokenizer = BertTokenizer.from_pretrained(args.bert_model, do_lower_case=True).tokenize
+    dataset = retrieval.CXR_Retrieval_Dataset(os.path.join(corpus, 'train.jsonl'), tokenizer, get_transforms(args), args)
+
+    def transform(image):
+        if opt.batch_transforms:
+            return to_uint8_tensor(image.convert('L'))
+        if opt.gray_input:
+            return dataset.transforms(image.convert('L'))
+        return dataset.transforms(retrieval.transforms.Grayscale(num_output_channels=3)(image))
+
+    def batch_transform(batch):
+        imgs = torch.cat((batch[3], batch[10]), dim=0)  # positive and negative pairs, as the trainer
+        return normalize_batch(imgs, gray_input=args.gray_input, size=get_batch_resize(args))
+
+    # positive + negative pair per sample, 1d attention masks built in __getitem__
+    return Bench(dataset, functools.partial(retrieval.collate_fn, args=args, pad_id=dataset.vocab_stoi["[PAD]"]),
+                 functools.partial(decode_jpg, size=dataset.draft_size), transform, lambda txt: dataset.encode_txt(0, txt),
+                 batch_transform=batch_transform if opt.batch_transforms else None)
+
+
+BUILDERS = {'cxr': (build_cxr, ROOT), 'mmbt': (build_mmbt, MMBT_DIR), 'img2txt': (build_img2txt, SC_DIR),
+            'retrieval': (build_retrieval, ROOT)}
+
+
+def timed_map(fn, inputs):
+    """outputs of fn over inputs, seconds per input"""
+    st = time.perf_counter()
+    outputs = [fn(x) for x in inputs]
+    return outputs, (time.perf_counter() - st) / max(len(inputs), 1)
+
+
+def time_stages(bench, rows, batch_size):
+    import torch
+
+    img_paths = [row['img'] for row in rows]
+    texts = [row['text'] for row in rows]
+    times = {}
+    data, times['read'] = timed_map(bench.read, img_paths)
+    images, times['decode'] = timed_map(bench.decode, data)
+    _, times['transform'] = timed_map(bench.transform, images)
+    _, times['tokenize'] = timed_map(bench.tokenize, texts)
+
+    samples = [bench.dataset[i] for i in range(len(rows))]
+    chunks = [samples[i:i + batch_size] for i in range(0, len(samples), batch_size)]
+    batches, collate_time = timed_map(bench.collate_fn, chunks)
+    times['collate'] = collate_time * len(chunks) / len(samples)
+    if bench.mask is not None:
+        with torch.no_grad():
+            _, mask_time = timed_map(bench.mask, batches)
+        times['mask'] = mask_time * len(batches) / len(samples)
+    if bench.batch_transform is not None:
+        _, batch_time = timed_map(bench.batch_transform, batches)
+        times['batch_transform'] = batch_time * len(batches) / len(samples)
+    return {stage: t * 1000 for stage, t in times.items()}
+
+
+def time_loader(bench, num_workers, batch_size, num_batches):
+    """samples/sec of the DataLoader, the first batch (worker start-up) is timed apart"""
+    from torch.utils.data import DataLoader
+
+    loader = DataLoader(bench.dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers,
+                        collate_fn=bench.collate_fn, drop_last=True)
+    st = time.perf_counter()
+    it = iter(loader)
+    next(it)
+    first_batch = time.perf_counter() - st
+
+    n_batches = 0
+    st = time.perf_counter()
+    for _ in it:
+        n_batches += 1
+        if n_batches == num_batches:
+            break
+    elapsed = time.perf_counter() - st
+    return {'num_workers': num_workers, 'samples_per_sec': n_batches * batch_size / elapsed if n_batches else None,
+            'first_batch_sec': first_batch}
+
+
+def run_dataset(name, opt):
+    """child process: benchmark one dataset, write its results as json"""
+    import torch
+
+    builder, import_root = BUILDERS[name]
+    sys.path.insert(0, import_root)
+    torch.manual_seed(opt.seed)
+    random.seed(opt.seed)
+
+    bench = builder(opt.corpus, opt)
+    rows = [json.loads(l) for l in open(os.path.join(opt.corpus, 'train.jsonl'))][:opt.stage_rows]
+    result = {'dataset': name, 'stages_ms_per_sample': time_stages(bench, rows, opt.batch_size), 'loader': []}
+    for num_workers in range(opt.max_workers + 1):
+        result['loader'].append(time_loader(bench, num_workers, opt.batch_size, opt.num_batches))
+    with open(opt.child_output, 'w') as f:
+        json.dump(result, f, indent=2)
+
+
+def print_result(result):
+    print(f"\n== {result['dataset']}")
+    if 'error' in result:
+        print(f"failed: {result['error']}")
+        return
+    stages = result['stages_ms_per_sample']
+    print('ms/sample  ' + '  '.join(f'{s}: {stages[s]:.2f}' if s in stages else f'{s}: -' for s in STAGES))
+    for r in result['loader']:
+        sps = f"{r['samples_per_sec']:.1f}" if r['samples_per_sec'] is not None else '-'
+        print(f"workers {r['num_workers']:2d}  {sps:>8} samples/sec  (first batch {r['first_batch_sec']:.2f}s)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset", type=str, nargs='+', default=DATASETS, choices=DATASETS)
+    parser.add_argument("--corpus", type=str, default=None, help="synthetic corpus dir, generated in a temp dir if not set")
+    parser.add_argument("--num_rows", type=int, default=256, help="rows of the generated corpus")
+    parser.add_argument("--img_size", type=int, default=512, choices=[224, 512])
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--max_workers", type=int, default=min(4, os.cpu_count()), help="DataLoader workers 0..max_workers")
+    parser.add_argument("--num_batches", type=int, default=10, help="batches timed per worker count, after the first")
+    parser.add_argument("--stage_rows", type=int, default=64, help="rows timed per stage")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--gray_input", action='store_true', help="1-channel image pipelines (--gray_input of the entry points)")
+    parser.add_argument("--jpeg_draft", action='store_true', help="reduced-resolution jpg decoding for --img_size 224")
+    parser.add_argument("--batch_transforms", action='store_true', help="uint8 samples, Resize / Normalize per batch")
+    parser.add_argument("--output", type=str, default=None, help="json file of all results, to track regressions")
+    parser.add_argument("--child_output", type=str, default=None, help=argparse.SUPPRESS)
+    opt = parser.parse_args()
+
+    if opt.child_output is not None:
+        run_dataset(opt.dataset[0], opt)
+        sys.exit(0)
+
+    tmp_dir = None
+    if opt.corpus is None:
+        tmp_dir = tempfile.TemporaryDirectory()
+        opt.corpus = tmp_dir.name
+    if not os.path.exists(os.path.join(opt.corpus, 'train.jsonl')):
+        print(f'Generating {opt.num_rows} rows in {opt.corpus}')
+        make_corpus(opt.corpus, opt.num_rows, opt.img_size, opt.seed)
+
+    results = []
+    for name in opt.dataset:
+        child_output = os.path.join(opt.corpus, f'{name}.bench.json')
+        cmd = [sys.executable, os.path.abspath(__file__), '--dataset', name, '--corpus', opt.corpus,
+               '--img_size', str(opt.img_size), '--batch_size', str(opt.batch_size), '--max_workers', str(opt.max_workers),
+               '--num_batches', str(opt.num_batches), '--stage_rows', str(opt.stage_rows), '--seed', str(opt.seed),
+               '--child_output', child_output] + [f'--{k}' for k in ['gray_input', 'jpeg_draft', 'batch_transforms']
+                                          if getattr(opt, k)]
+        proc = subprocess.run(cmd, cwd=BUILDERS[name][1], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                              universal_newlines=True)
+        if proc.returncode == 0:
+            result = json.load(open(child_output))
+        else:
+            result = {'dataset': name, 'error': proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else proc.returncode}
+        print_result(result)
+        results.append(result)
+
+    if opt.output is not None:
+        with open(opt.output, 'w') as f:
+            json.dump({'num_rows': opt.num_rows, 'img_size': opt.img_size, 'batch_size': opt.batch_size, 'gray_input': opt.gray_input,
+                       'jpeg_draft': opt.jpeg_draft, 'batch_transforms': opt.batch_transforms,
+                       'cpu_count': os.cpu_count(), 'results': results}, f, indent=2)
+    if tmp_dir is not None:
+        tmp_dir.cleanup()
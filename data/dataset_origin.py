@@ -6,13 +6,22 @@ import json
 import random
 import numpy as np
 from PIL import Image
-from fuzzywuzzy import fuzz
 
 import torch
 from torch.utils.data import Dataset
 from transformers import BertModel, BertTokenizer, AutoTokenizer
 from transformers.tokenization_albert import AlbertTokenizer
 
+from data.jsonl_columns import load_jsonl
+from data.token_store import load_token_store
+from data.image_store import load_image_store, to_uint8_tensor
+from data.feature_store import load_feature_store
+from data.jpeg_draft import open_image
+from data.label_index import LabelIndex
+from data.mlm_masking import MLMMasker
+from data.length_bucket import get_text_lengths
+from models.attn_mask import attn_desc, FULL, S2S, BAR, DISTURBING
+
 
 def truncate_txt(txt_tokens, max_seq_len):
     while True:
@@ -26,16 +35,17 @@ class CXRDataset(Dataset):
     def __init__(self, data_path, tokenizer, transforms, args):
         self.args = args
         self.data_dir = os.path.dirname(data_path)
-        self.data = [json.loads(l) for l in open(data_path)]
+        self.data = load_jsonl(data_path)  # columnar, memory-mapped rows shared by the workers
+        self.label_index = LabelIndex([d['label'] for d in self.data])
 
         self.max_seq_len = args.max_seq_len  # 512
         self.max_seq_len -= args.num_image_embeds  # 512 - #img_embeds
 
         self.seq_len = args.seq_len
         self.transforms = transforms
+        self.disturbing_mask = args.disturbing_mask
 
         self.total_len = self.seq_len + self.args.num_image_embeds + 3
-        self._tril_matrix = torch.tril(torch.ones((self.total_len, self.total_len), dtype=torch.long))
 
         self.tokenizer = tokenizer  # tokenizer = BertTokenizer.from_pretrained('bert-based-uncased').tokenize
 
@@ -74,32 +84,51 @@ class CXRDataset(Dataset):
             self.vocab_stoi = self.BertTokenizer.vocab
             self.vocab_len = len(self.vocab_stoi)  # 30522
 
+        # pre-tokenized reports, built by data/token_store.py
+        self.token_store = load_token_store(data_path, len(self.data), args.bert_model) if args.token_store else None
+        # decoded uint8 pixels, built by data/image_store.py, normalized per batch by the trainer
+        self.image_store = load_image_store(data_path, len(self.data), args.img_size) if args.image_store else None
+        # ResNet-50 grids, built by data/feature_store.py, the image encoder skips its backbone
+        self.feature_store = load_feature_store(data_path, len(self.data), args.img_size) if args.feature_store else None
+        # jpgs decoded near 224 in the DCT domain, Resize(224) of the transforms is done afterwards
+        self.draft_size = 224 if args.jpeg_draft and args.img_size == 224 else None
+
+        # MLM masking is done per batch by the trainer, on the device
+        self.pad_id = self.vocab_stoi["<pad>" if args.bert_model == "albert-base-v2" else "[PAD]"]
+        self.mlm_masker = MLMMasker(self.vocab_stoi["[MASK]"], self.vocab_len,
+                                    [self.vocab_stoi["[SEP]"], self.pad_id],
+                                    max_pred=args.max_pred, seed=args.seed, replay=args.mlm_replay)
+
     def __len__(self):
         return len(self.data)
 
+    def text_lengths(self):
+        return get_text_lengths(self.data, self.token_store)
+
     def __getitem__(self, idx):
         # MLM
-        origin_txt, img_path, is_aligned, itm_prob = self.random_pair_sampling(idx)
-
-        if self.args.img_channel == 3:
-            image = Image.open(os.path.join(self.data_dir, img_path)).convert("RGB")
-        elif self.args.img_channel == 1:
-            image = Image.open(os.path.join(self.data_dir, img_path)).convert("RGB")
-
-        image = self.transforms(image)
-
-        tokenized_sentence = self.tokenizer(origin_txt)  # ['i','ate','an','apple'], no special token
-
-        truncate_txt(tokenized_sentence, self.seq_len)
+        origin_txt, img_path, is_aligned, itm_prob, txt_idx = self.random_pair_sampling(idx)
 
-        if self.args.bert_model == "albert-base-v2":
-            encoded_sentence = [self.vocab_stoi[w] if w in self.vocab_stoi else self.vocab_stoi["<unk>"]
-                                for w in tokenized_sentence]
+        if self.feature_store is not None:
+            image = self.feature_store[idx]  # fp16, 2048 x M x M
+        elif self.image_store is not None:
+            image = self.image_store[idx]  # uint8, 1 x H x W
         else:
-            encoded_sentence = [self.vocab_stoi[w] if w in self.vocab_stoi else self.vocab_stoi["[UNK]"]
-                                for w in tokenized_sentence]  # [178, 8756, 1126, 12075]
+            if self.args.gray_input:
+                image = open_image(os.path.join(self.data_dir, img_path), "L", self.draft_size)
+            elif self.args.img_channel == 3:
+                image = open_image(os.path.join(self.data_dir, img_path), "RGB", self.draft_size)
+            elif self.args.img_channel == 1:
+                image = open_image(os.path.join(self.data_dir, img_path), "RGB", self.draft_size)
+
+            if self.args.batch_transforms:
+                image = to_uint8_tensor(image)  # uint8, resized and normalized per batch by the trainer
+            else:
+                image = self.transforms(image)
+
+        encoded_sentence = self.encode_txt(txt_idx, origin_txt)  # [178, 8756, 1126, 12075]
 
-        input_ids, txt_labels = self.random_word(encoded_sentence)
+        input_ids, txt_labels = encoded_sentence, [-100] * len(encoded_sentence)  # masked by MLMMasker
 
         if self.disturbing_mask:
             input_ids = input_ids + [self.vocab_stoi["[SEP]"]]
@@ -135,101 +164,60 @@ class CXRDataset(Dataset):
         segment = torch.tensor(segment)
         is_aligned = torch.tensor(is_aligned)
 
-        attn_1d = torch.tensor(attn_masks)
-
-        full_attn = torch.tensor((attn_masks_i + attn_masks_t),
-                                 dtype=torch.long).unsqueeze(0).expand(self.total_len, self.total_len).clone()
-
-        extended_attn_masks = torch.zeros(self.total_len, self.total_len, dtype=torch.long)
-        second_st, second_end = self.args.num_image_embeds + 2, self.args.num_image_embeds + 2 + len(input_ids)
-        extended_attn_masks[:, :self.args.num_image_embeds + 2].fill_(1)
-        extended_attn_masks[second_st:second_end, second_st:second_end].copy_(
-            self._tril_matrix[:second_end - second_st, :second_end - second_st])
-        s2s_attn = extended_attn_masks
-
-        mixed_lst = [full_attn, s2s_attn]
+        # compact mask descriptor, the dense total_len x total_len mask is built on the model side (models/attn_mask.py)
+        vis_len = self.args.num_image_embeds + 2
+        txt_len = sum(attn_masks_t)  # text + [SEP], without padding
 
         if self.args.Mixed:
-            # print('Mixed attn mask')
             assert (self.args.s2s_prob + self.args.bi_prob) == 1.0
-            attn_masks_tensor = random.choices(mixed_lst, weights=[self.args.bi_prob, self.args.s2s_prob])[0]
-            # print(f'S2S {self.args.s2s_prob} vs Bi {self.args.bi_prob}')
-
+            mode = random.choices([FULL, S2S], weights=[self.args.bi_prob, self.args.s2s_prob])[0]
         elif self.args.BAR_attn:
-            # print('BAR_attn attn mask')
-            extended_attn_masks[:self.args.num_image_embeds+2, :].fill_(1)
-            attn_masks_tensor = extended_attn_masks
-
+            mode = BAR
         elif self.args.disturbing_mask:
-            baseline_attn = torch.zeros(self.total_len, self.total_len, dtype=torch.long)
-            baseline_attn[:self.args.num_image_embeds + 2, :self.args.num_image_embeds + 2].fill_(1)
-            baseline_attn[self.args.num_image_embeds + 2:, self.args.num_image_embeds + 2:].fill_(1)
-            attn_masks_tensor = baseline_attn
-
+            mode = DISTURBING
         else:
-            if self.args.attn_1d:
-                # print('1d_bidirectional attn mask')
-                attn_masks_tensor = attn_1d  # '1d attention mask'
+            mode = FULL  # 1d and full bidirectional attn mask give the same extended mask
 
-            else:
-                # print('full_bidirecitonal attn mask')
-                attn_masks_tensor = full_attn  # 'Full attention mask'
+        txt_end = vis_len + txt_len if mode == FULL else self.total_len
+        attn_masks_tensor = attn_desc(vis_len, vis_len, txt_end, mode)
 
         sep_tok = [self.vocab_stoi["[SEP]"]]
         sep_tok = torch.tensor(sep_tok)
 
         return cls_tok, input_ids_tensor, txt_labels, attn_masks_tensor, image, segment, is_aligned, sep_tok, itm_prob
 
-    def random_word(self, tokens):
-        output_label = []
+    def encode_txt(self, txt_idx, origin_txt):
+        if self.token_store is not None:
+            return self.token_store.get(txt_idx, self.seq_len)
 
-        for i, token in enumerate(tokens):
-            prob = random.random()
-            if prob < 0.15:
-                prob /= 0.15
-
-                # 80% randomly change token to mask token
-                if prob < 0.8:
-                    tokens[i] = self.vocab_stoi["[MASK]"]
-
-                # 10% randomly change token to random token
-                elif prob < 0.9:
-                    tokens[i] = random.randrange(self.vocab_len)
-
-                output_label.append(token)
-            else:
-                tokens[i] = token
-                output_label.append(-100)  # 0
+        tokenized_sentence = self.tokenizer(origin_txt)  # ['i','ate','an','apple'], no special token
 
-        if all(o == -100 for o in output_label):  # 0
-            # at least one mask
-            output_label[0] = tokens[0]
-            tokens[0] = self.vocab_stoi["[MASK]"]
+        truncate_txt(tokenized_sentence, self.seq_len)
 
-        return tokens, output_label
+        if self.args.bert_model == "albert-base-v2":
+            encoded_sentence = [self.vocab_stoi[w] if w in self.vocab_stoi else self.vocab_stoi["<unk>"]
+                                for w in tokenized_sentence]
+        else:
+            encoded_sentence = [self.vocab_stoi[w] if w in self.vocab_stoi else self.vocab_stoi["[UNK]"]
+                                for w in tokenized_sentence]  # [178, 8756, 1126, 12075]
+        return encoded_sentence
 
     def random_pair_sampling(self, idx):
         _, _, label, txt, img = self.data[idx].keys()  # id, txt, img
 
-        d_label = self.data[idx][label]
         d_txt = self.data[idx][txt]
         d_img = self.data[idx][img]
 
         itm_prob = random.random()
 
         if itm_prob > 0.5:
-            return d_txt, d_img, 1, itm_prob
+            return d_txt, d_img, 1, itm_prob, idx
         else:
-            for itr in range(300):
-                random_txt, random_label = self.get_random_line()
-                if fuzz.token_sort_ratio(d_label, random_label) != 100:
-                    return random_txt, d_img, 0, itm_prob
-                    break
-                else:
-                    pass
-
-    def get_random_line(self):
-        rand_num = random.randint(0, len(self.data) - 1)
+            random_txt, rand_num = self.get_random_line(idx)
+            return random_txt, d_img, 0, itm_prob, rand_num
+
+    def get_random_line(self, idx):
+        # random report whose label set differs from the one of idx
+        rand_num = self.label_index.sample_negative(idx)
         txt = self.data[rand_num]['text']
-        label = self.data[rand_num]['label']
-        return txt, label
+        return txt, rand_num
@@ -0,0 +1,153 @@
+"""
+offline ResNet-50 feature store
+
+The ResNet-50 of the image encoders is frozen, yet every training step runs it over the full 512x512 image.
+build_feature_store runs the backbone once per image, in eval mode, and writes its 2048 x M x M grid
+(M = img_size / 32, 16 for 512) as fp16 into a memory-mapped file indexed by jsonl row, plus one last row
+for the gray image the mmbt dataset uses for dropped images.
+With --feature_store the datasets return the grid instead of the image and the image encoders skip the backbone;
+the random pixel sampling is still done on the grid at every step.
+
+BatchNorm runs on its running statistics here, while the frozen backbone in train mode used the batch statistics.
+1 MiB per image at 512 (2048 x 16 x 16 x fp16).
+
+Example:
+    $ python -m data.feature_store --data_path /path/to/Train_253.jsonl --img_size 512 --device cuda
+    $ python -m data.feature_store --data_path /path/to/Train_253.jsonl --checkpoint /path/to/pytorch_model.bin
+"""
+import os
+import json
+import argparse
+import numpy as np
+from PIL import Image
+
+import torch
+import torchvision
+import torch.nn as nn
+import torchvision.transforms as transforms
+from torch.utils.data import Dataset, DataLoader
+
+from data.image_store import IMG_MEAN, IMG_STD
+
+FEATURE_DIM = 2048
+STRIDE = 32  # ResNet-50 output stride
+
+
+def get_store_prefix(data_path, img_size):
+    # Train_253.jsonl -> Train_253.feat512.{fp16, meta.json}
+    return os.path.splitext(data_path)[0] + '.feat{}'.format(img_size)
+
+
+def get_backbone(checkpoint=None):
+    """ResNet-50 without avgpool / fc, as in the image encoders, with their weights from checkpoint if given"""
+    model = torchvision.models.resnet50(pretrained=checkpoint is None)
+    backbone = nn.Sequential(*list(model.children())[:-2])
+    if checkpoint is not None:
+        state_dict = torch.load(checkpoint, map_location='cpu')
+        # enc.img_encoder.model.0.weight, img_encoder.model.0.weight, ... -> 0.weight
+        key = 'img_encoder.model.'
+        state_dict = {k[k.index(key) + len(key):]: v for k, v in state_dict.items() if key in k}
+        backbone.load_state_dict(state_dict)
+    return backbone.eval()
+
+
+class ImagePaths(Dataset):
+    """same pixels as get_transforms in data/helper.py (Resize for 224) on the 3-channel image"""
+    def __init__(self, data_dir, img_paths, img_size):
+        self.data_dir = data_dir
+        self.img_paths = img_paths
+        self.img_size = img_size
+        self.transforms = transforms.Compose([transforms.ToTensor(), transforms.Normalize(IMG_MEAN, IMG_STD)])
+
+    def __len__(self):
+        return len(self.img_paths)
+
+    def __getitem__(self, idx):
+        if not self.img_paths[idx]:
+            image = Image.fromarray(128 * np.ones((self.img_size, self.img_size, 3), dtype=np.uint8))
+        else:
+            image = Image.open(os.path.join(self.data_dir, self.img_paths[idx])).convert("RGB")
+        if image.size != (self.img_size, self.img_size):
+            image = transforms.Resize(self.img_size)(image)
+        return self.transforms(image)
+
+
+@torch.no_grad()
+def build_feature_store(data_path, img_size, prefix=None, img_key='img', checkpoint=None, device='cpu',
+                        batch_size=32, num_workers=4):
+    data_dir = os.path.dirname(data_path)
+    prefix = prefix if prefix is not None else get_store_prefix(data_path, img_size)
+    img_paths = [json.loads(l)[img_key] for l in open(data_path)]
+    grid = img_size // STRIDE
+
+    backbone = get_backbone(checkpoint).to(device)
+    features = np.memmap(prefix + '.fp16', dtype=np.float16, mode='w+',
+                         shape=(len(img_paths) + 1, FEATURE_DIM, grid, grid))
+    loader = DataLoader(ImagePaths(data_dir, img_paths + [None], img_size), batch_size=batch_size,
+                        num_workers=num_workers)
+    st = 0
+    for images in loader:
+        out = backbone(images.to(device))
+        features[st:st + out.size(0)] = out.half().cpu().numpy()
+        st += out.size(0)
+    features.flush()
+    del features
+
+    with open(prefix + '.meta.json', 'w') as f:
+        json.dump({'data_path': data_path, 'img_key': img_key, 'img_size': img_size, 'grid': grid,
+                   'num_rows': len(img_paths), 'checkpoint': checkpoint, 'paths': img_paths}, f)
+    return prefix
+
+
+class FeatureStore():
+    """
+    Read-only view over a store written by build_feature_store.
+    store[idx] -> fp16 tensor, 2048 x grid x grid, of jsonl row idx
+    """
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.meta = json.load(open(prefix + '.meta.json'))
+        self.grid = self.meta['grid']
+        self.features = np.memmap(prefix + '.fp16', dtype=np.float16, mode='r',
+                                  shape=(self.meta['num_rows'] + 1, FEATURE_DIM, self.grid, self.grid))
+        self._path_to_row = None
+
+    def __len__(self):
+        return self.meta['num_rows']
+
+    def __getitem__(self, idx):
+        return torch.from_numpy(np.array(self.features[idx]))
+
+    def gray(self):
+        # grid of the gray image the mmbt JsonlDataset uses for dropped images, stored after the last row
+        return self[self.meta['num_rows']]
+
+    def row_of(self, img_path):
+        if self._path_to_row is None:
+            self._path_to_row = {p: i for i, p in enumerate(self.meta['paths'])}
+        return self._path_to_row[img_path]
+
+
+def load_feature_store(data_path, num_rows, img_size):
+    store = FeatureStore(get_store_prefix(data_path, img_size))
+    assert len(store) == num_rows, \
+        f'{store.prefix}: {len(store)} rows in feature store, {num_rows} in {data_path}. Rebuild the store.'
+    return store
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_path", type=str, required=True, nargs='+', help="jsonl split(s) to encode")
+    parser.add_argument("--img_size", type=int, default=512, choices=[224, 512])
+    parser.add_argument("--img_key", type=str, default="img")
+    parser.add_argument("--checkpoint", type=str, default=None,
+                        help="model state_dict to take the backbone weights from, ImageNet ResNet-50 if not set")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--num_workers", type=int, default=4)
+    args = parser.parse_args()
+
+    for data_path in args.data_path:
+        prefix = build_feature_store(data_path, args.img_size, img_key=args.img_key, checkpoint=args.checkpoint,
+                                     device=args.device, batch_size=args.batch_size, num_workers=args.num_workers)
+        print(f'{data_path} -> {prefix}')
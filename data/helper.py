@@ -6,9 +6,20 @@ import os
 import sys
 import torchvision.transforms as transforms
 
+def get_batch_resize(args):
+    """Resize of get_transforms, done on the uint8 batch by normalize_batch with --batch_transforms"""
+    return 224 if args.img_size == 224 else None
+
+
 def get_transforms(args):
 
-    if args.img_size == 224:
+    if args.gray_input:
+        # 1-channel image, Normalize is folded into the first conv of the image encoder (models/image.py)
+        return transforms.Compose(
+            ([transforms.Resize(224)] if args.img_size == 224 else []) + [transforms.ToTensor()]
+        )
+
+    elif args.img_size == 224:
         return transforms.Compose(
             [
                 transforms.Resize(224),
@@ -0,0 +1,131 @@
+"""
+decoded-pixel image store
+
+Decodes every image of a jsonl split once and writes it as a fixed-size uint8 single-channel
+array into a memory-mapped file, indexed by jsonl row. The datasets then return raw uint8
+pixels and normalize_batch does ToTensor + Normalize on the whole batch (on the device).
+X-rays are grayscale, so one channel is kept instead of three.
+--batch_transforms uses the same batch side without a store: the datasets decode the jpgs and return them
+as uint8 tensors (to_uint8_tensor), Resize + ToTensor + Normalize run on the batch in normalize_batch.
+
+Example:
+    $ python -m data.image_store --data_path /path/to/Train_253.jsonl --img_size 512
+"""
+import os
+import json
+import argparse
+import numpy as np
+from PIL import Image
+
+import torch
+import torchvision.transforms.functional as TF
+
+# referred from ChexNet, same constants as data/helper.py
+IMG_MEAN = [0.485, 0.456, 0.406]
+IMG_STD = [0.229, 0.224, 0.225]
+
+
+def get_store_prefix(data_path, img_size):
+    # Train_253.jsonl -> Train_253.img512.{uint8, meta.json}
+    return os.path.splitext(data_path)[0] + '.img{}'.format(img_size)
+
+
+def load_gray(path, img_size):
+    """PIL decode -> 1 channel -> img_size x img_size, same pixels as Resize(img_size) on a square image"""
+    image = Image.open(path).convert("L")
+    if image.size != (img_size, img_size):
+        image = image.resize((img_size, img_size), Image.BILINEAR)
+    return np.asarray(image, dtype=np.uint8)
+
+
+def build_image_store(data_path, img_size, prefix=None, img_key='img'):
+    data_dir = os.path.dirname(data_path)
+    prefix = prefix if prefix is not None else get_store_prefix(data_path, img_size)
+    img_paths = [json.loads(l)[img_key] for l in open(data_path)]
+
+    images = np.memmap(prefix + '.uint8', dtype=np.uint8, mode='w+',
+                       shape=(max(len(img_paths), 1), img_size, img_size))
+    for i, img_path in enumerate(img_paths):
+        if img_path:
+            images[i] = load_gray(os.path.join(data_dir, img_path), img_size)
+        else:
+            images[i] = 128  # same gray image as JsonlDataset for dropped images
+    images.flush()
+    del images
+
+    with open(prefix + '.meta.json', 'w') as f:
+        json.dump({'data_path': data_path, 'img_key': img_key, 'img_size': img_size,
+                   'num_rows': len(img_paths), 'paths': img_paths}, f)
+    return prefix
+
+
+class ImageStore():
+    """
+    Read-only view over a store written by build_image_store.
+    store[idx] -> uint8 tensor, 1 x img_size x img_size, of jsonl row idx
+    """
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.meta = json.load(open(prefix + '.meta.json'))
+        self.img_size = self.meta['img_size']
+        self.images = np.memmap(prefix + '.uint8', dtype=np.uint8, mode='r',
+                                shape=(max(self.meta['num_rows'], 1), self.img_size, self.img_size))
+        self._path_to_row = None
+
+    def __len__(self):
+        return self.meta['num_rows']
+
+    def __getitem__(self, idx):
+        return torch.from_numpy(np.array(self.images[idx])).unsqueeze(0)
+
+    def row_of(self, img_path):
+        if self._path_to_row is None:
+            self._path_to_row = {p: i for i, p in enumerate(self.meta['paths'])}
+        return self._path_to_row[img_path]
+
+    def gray(self):
+        # same gray image as the mmbt JsonlDataset uses for dropped images
+        return torch.full((1, self.img_size, self.img_size), 128, dtype=torch.uint8)
+
+
+def load_image_store(data_path, num_rows, img_size):
+    store = ImageStore(get_store_prefix(data_path, img_size))
+    assert len(store) == num_rows, \
+        f'{store.prefix}: {len(store)} rows in image store, {num_rows} in {data_path}. Rebuild the store.'
+    return store
+
+
+def to_uint8_tensor(image):
+    """PIL image -> uint8 C x H x W tensor, the per-sample output of --batch_transforms"""
+    pixels = torch.from_numpy(np.array(image, dtype=np.uint8))
+    return pixels.unsqueeze(0) if pixels.dim() == 2 else pixels.permute(2, 0, 1).contiguous()
+
+
+def normalize_batch(imgs, mean=IMG_MEAN, std=IMG_STD, gray_input=False, size=None):
+    """
+    uint8 B x 1 x H x W -> float B x 3 x H x W (B x 3 x H x W inputs are normalized per channel)
+    Same arithmetic as ToTensor() + Normalize(mean, std) on the 3-channel image, on whatever device imgs is.
+    gray_input: ToTensor() only, float B x 1 x H x W, mean / std are folded into the image encoder (models/image.py)
+    size: Resize(size) of the uint8 batch first (bilinear, antialiased), no-op if the shorter side is already size
+    """
+    if size is not None and min(imgs.shape[-2:]) != size:
+        imgs = TF.resize(imgs, size, antialias=True)
+    imgs = imgs.to(dtype=torch.float32).div(255)
+    if gray_input:
+        return imgs
+    imgs = imgs.expand(-1, len(mean), -1, -1)
+    mean = torch.as_tensor(mean, dtype=imgs.dtype, device=imgs.device)
+    std = torch.as_tensor(std, dtype=imgs.dtype, device=imgs.device)
+    return imgs.sub(mean[:, None, None]).div(std[:, None, None])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_path", type=str, required=True, nargs='+', help="jsonl split(s) to decode")
+    parser.add_argument("--img_size", type=int, default=512, choices=[224, 512])
+    parser.add_argument("--img_key", type=str, default="img")
+    args = parser.parse_args()
+
+    for data_path in args.data_path:
+        prefix = build_image_store(data_path, args.img_size, img_key=args.img_key)
+        print(f'{data_path} -> {prefix}')
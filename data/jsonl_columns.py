@@ -0,0 +1,133 @@
+"""
+columnar jsonl rows
+
+A list of python dicts gets un-shared page by page in every DataLoader worker (refcount writes), so the
+RSS of a MIMIC-size split grows with num_workers. JsonlColumns keeps every column of the jsonl as one
+utf-8 byte buffer + int64 offsets, saved next to the jsonl and memory-mapped, and rebuilds the row dict on
+access, so data[idx]['text'], data[idx].keys(), len(data) and iteration work as with the list.
+
+Train_253.jsonl -> Train_253.cols.meta.json, Train_253.cols.{column index}.bytes.npy / .offsets.npy
+The files are rebuilt when the jsonl changes, and kept in memory if the data directory is read-only.
+"""
+import os
+import json
+import numpy as np
+
+
+def get_store_prefix(data_path):
+    return os.path.splitext(data_path)[0] + '.cols'
+
+
+def get_column_files(prefix, i):
+    return f'{prefix}.{i}.bytes.npy', f'{prefix}.{i}.offsets.npy'
+
+
+def get_source_stamp(data_path):
+    stat = os.stat(data_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _load_array(path):
+    array = np.load(path, mmap_mode='r')
+    return array if array.size else np.load(path)  # empty files can not be mapped
+
+
+class JsonlColumns():
+    """
+    keys: column names, in the order of the jsonl rows
+    json_keys: columns holding non-str values (lists, numbers, null), stored as json
+    """
+    def __init__(self, keys, json_keys, buffers, offsets):
+        self.keys = keys
+        self.json_keys = set(json_keys)
+        self.buffers = buffers
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets[self.keys[0]]) - 1 if self.keys else 0
+
+    def get(self, idx, key):
+        offsets = self.offsets[key]
+        value = bytes(self.buffers[key][offsets[idx]:offsets[idx + 1]]).decode('utf-8')
+        return json.loads(value) if key in self.json_keys else value
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        return {key: self.get(idx, key) for key in self.keys}
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def column(self, key):
+        return [self.get(idx, key) for idx in range(len(self))]
+
+
+def build_jsonl_columns(data_path):
+    rows = [json.loads(l) for l in open(data_path)]
+    keys = list(rows[0].keys()) if rows else []
+    for i, row in enumerate(rows):
+        if list(row.keys()) != keys:
+            raise ValueError(f'{data_path}:{i + 1} has keys {list(row.keys())}, first row has {keys}')
+
+    json_keys = [k for k in keys if any(not isinstance(row[k], str) for row in rows)]
+    buffers, offsets = {}, {}
+    for key in keys:
+        values = [row[key] if key not in json_keys else json.dumps(row[key]) for row in rows]
+        encoded = [v.encode('utf-8') for v in values]
+        offsets[key] = np.concatenate([[0], np.cumsum([len(e) for e in encoded])]).astype(np.int64)
+        buffers[key] = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return JsonlColumns(keys, json_keys, buffers, offsets)
+
+
+def save_jsonl_columns(columns, data_path, prefix):
+    for i, key in enumerate(columns.keys):
+        bytes_file, offsets_file = get_column_files(prefix, i)
+        for path, array in [(bytes_file, columns.buffers[key]), (offsets_file, columns.offsets[key])]:
+            tmp = path + f'.tmp{os.getpid()}.npy'
+            np.save(tmp, array)
+            os.replace(tmp, path)
+
+    # meta last, a store is valid once its meta matches the jsonl
+    tmp = prefix + f'.meta.json.tmp{os.getpid()}'
+    with open(tmp, 'w') as f:
+        json.dump({'data_path': data_path, 'source': get_source_stamp(data_path), 'keys': columns.keys,
+                   'json_keys': sorted(columns.json_keys), 'num_rows': len(columns)}, f)
+    os.replace(tmp, prefix + '.meta.json')
+
+
+def open_jsonl_columns(data_path, prefix):
+    meta_file = prefix + '.meta.json'
+    if not os.path.exists(meta_file):
+        return None
+    meta = json.load(open(meta_file))
+    if meta['source'] != get_source_stamp(data_path):
+        return None
+
+    buffers, offsets = {}, {}
+    for i, key in enumerate(meta['keys']):
+        bytes_file, offsets_file = get_column_files(prefix, i)
+        buffers[key] = _load_array(bytes_file)
+        offsets[key] = _load_array(offsets_file)
+    return JsonlColumns(meta['keys'], meta['json_keys'], buffers, offsets)
+
+
+def load_jsonl(data_path):
+    """drop-in for [json.loads(l) for l in open(data_path)], falls back to it if the rows have different keys"""
+    prefix = get_store_prefix(data_path)
+    columns = open_jsonl_columns(data_path, prefix)
+    if columns is not None:
+        return columns
+
+    try:
+        columns = build_jsonl_columns(data_path)
+    except ValueError:
+        return [json.loads(l) for l in open(data_path)]  # rows with different keys, kept as dicts
+    try:
+        save_jsonl_columns(columns, data_path, prefix)
+    except OSError:
+        return columns  # read-only data directory, the numpy buffers are still shared by the workers
+    return open_jsonl_columns(data_path, prefix)
@@ -0,0 +1,57 @@
+"""
+label index for negative sampling
+
+Replaces the "draw a random row until fuzz.token_sort_ratio(label, random_label) != 100" loops.
+Every row gets a canonical label-set id once at dataset construction and rows are grouped by id,
+so a row with a different label set is drawn in constant time, with the same (uniform) distribution
+the rejection loop had.
+"""
+import re
+import random
+import numpy as np
+
+_non_alnum = re.compile(r"(?ui)\W")
+
+
+def canonical_label(label):
+    """token_sort_ratio(a, b) == 100 <=> canonical_label(a) == canonical_label(b) != ''"""
+    label = ''.join(c for c in str(label) if ord(c) < 128)
+    return ' '.join(sorted(_non_alnum.sub(' ', label).lower().split()))
+
+
+class LabelIndex():
+    """
+    label_ids[i]: canonical label-set id of row i
+    rows: row indices ordered by label id, label id k owns rows[start[k]:start[k] + count[k]]
+    """
+    def __init__(self, labels):
+        key_to_id = {}
+        label_ids = []
+        for i, label in enumerate(labels):
+            key = canonical_label(label)
+            # fuzz scores an empty label 0 against everything, so it never matches, not even itself
+            key = key if key else ('', i)
+            label_ids.append(key_to_id.setdefault(key, len(key_to_id)))
+
+        self.label_ids = np.asarray(label_ids, dtype=np.int64)
+        self.rows = np.argsort(self.label_ids, kind='stable')
+        self.count = np.bincount(self.label_ids, minlength=len(key_to_id))
+        self.start = np.concatenate([[0], np.cumsum(self.count)[:-1]]).astype(np.int64)
+
+    def __len__(self):
+        return len(self.label_ids)
+
+    @property
+    def num_labels(self):
+        return len(self.count)
+
+    def sample_negative(self, idx):
+        """uniform random row whose label set differs from the one of row idx"""
+        k = self.label_ids[idx]
+        n_neg = len(self.label_ids) - self.count[k]
+        if n_neg == 0:
+            raise ValueError(f'every row has the label set of row {idx}, no negative to sample')
+        r = random.randrange(n_neg)
+        if r >= self.start[k]:
+            r += self.count[k]
+        return int(self.rows[r])
@@ -0,0 +1,119 @@
+"""
+length bucketing + dynamic text padding
+
+The datasets pad every report to seq_len. LengthBucketBatchSampler groups reports of similar length into the same
+batch and the collate functions below cut the text padding every row of the batch shares, so the encoder only
+runs over the longest report of the batch (+ image tokens) instead of the full seq_len.
+
+Usable with any dataset that can give its report lengths (CXRDataset, CXR_Retrieval_Dataset, CNN_BERT_Dataset):
+    DataLoader(dset, batch_sampler=LengthBucketBatchSampler(dset.text_lengths(), batch_size), collate_fn=...)
+"""
+import numpy as np
+
+import torch
+from torch.utils.data import Sampler
+from torch.utils.data.dataloader import default_collate
+
+
+def get_text_lengths(data, token_store=None, txt_key='text'):
+    """
+    number of word-pieces per row from the token store, or the number of words as a proxy
+    (only used to order the rows, the padding is cut on the real ids)
+    """
+    if token_store is not None:
+        return np.diff(np.asarray(token_store.offsets)).tolist()
+    return [len(d[txt_key].split()) for d in data]
+
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Every epoch: shuffle, cut into buckets of bucket_size batches, sort each bucket by length,
+    split it into batches and shuffle the batches. Batches hold reports of similar length while the
+    sample order stays random across epochs (call set_epoch like with DistributedSampler).
+    num_replicas / rank: DDP, every rank takes every num_replicas-th batch of the same order, the first batches
+    are repeated so that every rank gets the same number of batches.
+    """
+    def __init__(self, lengths, batch_size, bucket_size=50, shuffle=True, drop_last=False, seed=0,
+                 num_replicas=1, rank=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        if self.drop_last:
+            num_batches = len(self.lengths) // self.batch_size
+        else:
+            num_batches = (len(self.lengths) + self.batch_size - 1) // self.batch_size
+        return (num_batches + self.num_replicas - 1) // self.num_replicas
+
+    def __iter__(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        indices = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+
+        batches = []
+        chunk = self.batch_size * self.bucket_size
+        for st in range(0, len(indices), chunk):
+            bucket = indices[st:st + chunk]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind='stable')]
+            batches.extend(bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size))
+
+        if self.drop_last and len(batches[-1]) < self.batch_size:
+            batches = [b for b in batches if len(b) == self.batch_size]
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        if self.num_replicas > 1:
+            batches += batches[:len(self) * self.num_replicas - len(batches)]
+            batches = batches[self.rank::self.num_replicas]
+        return iter([b.tolist() for b in batches])
+
+
+def get_text_len(input_ids, pad_id=0):
+    """longest unpadded text of the batch"""
+    return int((input_ids != pad_id).sum(1).max())
+
+
+def trim_text_padding(input_ids, segment, attn_masks, vis_len=0, pad_id=0, txt_len=None):
+    """
+    input_ids, segment: B x seq_len, padded at the end
+    attn_masks: B x (vis_len + seq_len) 1d mask, image tokens first
+    txt_len: length to cut to, the longest text of input_ids by default
+    """
+    txt_len = txt_len if txt_len is not None else get_text_len(input_ids, pad_id)
+    return input_ids[:, :txt_len], segment[:, :txt_len], attn_masks[:, :vis_len + txt_len]
+
+
+def cxr_collate_fn(batch, pad_id=0):
+    """
+    collate_fn of CXRDataset, cuts the text padding and the attention mask descriptors to the batch.
+    FULL / S2S: the kept positions never attend to the padding, the model computes the same as on the full seq_len.
+    BAR (image rows) and DISTURBING (text rows) attend to the padding in the full-length mask, not to the cut one:
+    main_origin.py rejects --length_bucket with --BAR_attn / --disturbing_mask.
+    """
+    cls_tok, input_ids, txt_labels, attn_masks, img, segment, is_aligned, sep_tok, itm_prob = default_collate(batch)
+
+    txt_len = get_text_len(input_ids, pad_id)
+    cut = input_ids.size(1) - txt_len
+    input_ids, segment = input_ids[:, :txt_len], segment[:, :txt_len]
+    txt_labels = txt_labels[:, :txt_labels.size(1) - cut]
+
+    # descriptors: [vis_len, txt_st, txt_end, mode], the sequence now ends at vis_len + txt_len
+    attn_masks = attn_masks.clone()
+    attn_masks[:, 2] = torch.min(attn_masks[:, 2], attn_masks[:, 0] + txt_len)
+
+    return cls_tok, input_ids, txt_labels, attn_masks, img, segment, is_aligned, sep_tok, itm_prob
+
+
+def cnn_bert_collate_fn(batch, pad_id=0):
+    """collate_fn of CNN_BERT_Dataset"""
+    input_ids, attn_masks, segment, image = default_collate(batch)
+    input_ids, segment, attn_masks = trim_text_padding(input_ids, segment, attn_masks, pad_id=pad_id)
+    return input_ids, attn_masks, segment, image
@@ -0,0 +1,98 @@
+"""
+batched MLM masking
+
+Masks a whole collated batch of token ids at once with a torch.Generator, instead of a python loop over
+the tokens of every report in the DataLoader workers. Runs wherever input_ids is (the trainers call it after
+moving the batch to the device).
+
+Semantics of the per-token loop it replaces (CXRDataset.random_word):
+    each text token is picked with mask_prob, a picked token is [MASK] 80%, a random id 10%, unchanged 10%,
+    labels hold the original id at picked positions and -100 elsewhere,
+    a report without any picked token gets its first token masked.
+
+The picked positions also come out padded to max_pred (masked_pos, masked_weights 1 / 0), so the model runs its
+MLM head on a fixed B x max_pred block instead of selecting the labelled positions, whose number only the host
+knows after a sync. max_pred caps the picks of a report: the ones after the first max_pred stay unmasked and
+unlabelled (15% of 253 tokens is 38 +- 6 picks, the default 64 of main_origin.py almost never cuts any).
+
+replay=True reseeds the generator with (seed, step) for every batch, so the masks of a step can be
+reproduced from the same batch, independently of how many batches were masked before.
+"""
+import torch
+import torch.nn.functional as F
+
+
+class MLMMasker():
+    def __init__(self, mask_id, vocab_len, special_ids, mask_prob=0.15, max_pred=None, seed=0, replay=False):
+        """
+        special_ids: ids that are never masked ([SEP], [PAD], ...)
+        max_pred: most picked tokens per report, None: no cap, the positions are padded to the batch length then
+        """
+        self.mask_id = mask_id
+        self.vocab_len = vocab_len
+        self.special_ids = list(special_ids)
+        self.mask_prob = mask_prob
+        self.max_pred = max_pred
+        self.seed = seed
+        self.replay = replay
+        self.generators = {}
+
+    def get_generator(self, device, step=None):
+        if device not in self.generators:
+            self.generators[device] = torch.Generator(device=device)
+            self.generators[device].manual_seed(self.seed)
+        generator = self.generators[device]
+        if self.replay:
+            assert step is not None, 'replay mode needs the step of the batch'
+            generator.manual_seed(self.seed * 1000003 + step)
+        return generator
+
+    def state_dict(self):
+        # generator states of the devices, resumed checkpoints continue the same mask stream
+        return {str(device): generator.get_state() for device, generator in self.generators.items()}
+
+    def load_state_dict(self, state_dict):
+        for device, state in state_dict.items():
+            device = torch.device(device)
+            self.generators[device] = torch.Generator(device=device)
+            self.generators[device].set_state(state)
+
+    def candidates(self, input_ids):
+        special_ids = torch.tensor(self.special_ids, dtype=input_ids.dtype, device=input_ids.device)
+        return ~(input_ids.unsqueeze(-1) == special_ids).any(-1)
+
+    def __call__(self, input_ids, step=None):
+        """
+        input_ids: B x L long -> masked input_ids, labels (B x L, -100 where not picked),
+        masked_pos (B x max_pred, the picked positions in order, 0 padded), masked_weights (B x max_pred, 1 / 0)
+        """
+        generator = self.get_generator(input_ids.device, step)
+        cand = self.candidates(input_ids)
+
+        prob = torch.rand(input_ids.shape, generator=generator, device=input_ids.device)
+        picked = cand & (prob < self.mask_prob)
+
+        # at least one mask: first candidate of the reports with nothing picked is always [MASK]
+        first_cand = cand & (cand.long().cumsum(1) == 1)
+        forced = first_cand & ~picked.any(1, keepdim=True)
+        picked = picked | forced
+        if self.max_pred is not None:
+            picked = picked & (picked.long().cumsum(1) <= self.max_pred)
+
+        labels = torch.where(picked, input_ids, torch.full_like(input_ids, -100))
+
+        # 80% [MASK], 10% random token, 10% unchanged, same split of prob / mask_prob as the per-token loop
+        prob = prob / self.mask_prob
+        random_ids = torch.randint(self.vocab_len, input_ids.shape, generator=generator, device=input_ids.device)
+        masked = torch.where(picked & (prob >= 0.8) & (prob < 0.9), random_ids, input_ids)
+        masked = torch.where((picked & (prob < 0.8)) | forced, torch.full_like(input_ids, self.mask_id), masked)
+
+        # picked positions first, in order: sorted keys, the others are shifted past the end
+        seq_len = input_ids.size(1)
+        max_pred = self.max_pred if self.max_pred is not None else seq_len
+        idx = torch.arange(seq_len, device=input_ids.device)
+        keys = torch.where(picked, idx, idx + seq_len).sort(1).values[:, :max_pred]
+        keys = F.pad(keys, (0, max_pred - keys.size(1)), value=seq_len)  # reports shorter than max_pred
+        masked_weights = (keys < seq_len).long()
+        masked_pos = keys * masked_weights
+        return masked, labels, masked_pos, masked_weights
@@ -0,0 +1,280 @@
+"""
+pre-tokenized report store
+
+Tokenizes every report of a jsonl split once and keeps the word-piece ids in a flat
+int32 array with an offsets index. Both files are memory-mapped, so the DataLoader
+workers slice ids out of shared pages instead of re-running the tokenizer each epoch.
+
+Example:
+    $ python -m data.token_store --data_path /path/to/Train_253.jsonl --bert_model bert-base-scratch
+
+The command line shards every split by line ranges over a process pool (--num_workers, all cores by default),
+each worker loads the tokenizer of --bert_model once and writes its shard, and the shards are merged into
+the single store the datasets read. VQA-RAD question sets (json lists) are tokenized the way the
+report_generation_and_vqa pipeline cleans them:
+    $ python -m data.token_store --data_path /path/to/vqa_rad/trainset.json /path/to/vqa_rad/testset.json \
+        --bert_model bert-base-uncased --txt_key question --preprocess vqa_rad
+
+The mmbt and report_generation_and_vqa pipelines read the stores with this module too, as data.token_store: their
+data packages extend __path__ with this directory.
+"""
+import os
+import json
+import shutil
+import argparse
+import multiprocessing
+import numpy as np
+
+
+def get_store_prefix(data_path):
+    # Train_253.jsonl -> Train_253.tokens.{int32, offsets.npy, meta.json}
+    return os.path.splitext(data_path)[0] + '.tokens'
+
+
+def get_store_files(prefix):
+    return prefix + '.int32', prefix + '.offsets.npy', prefix + '.meta.json'
+
+
+def encode_txt(tokenizer, vocab_stoi, txt, unk_token="[UNK]"):
+    unk_id = vocab_stoi[unk_token]
+    return [vocab_stoi[w] if w in vocab_stoi else unk_id for w in tokenizer(txt)]
+
+
+def vqa_rad_question(sentence):
+    """question cleaning of pre_processing in report_generation_and_vqa/sc/data_loader.py, before tokenization"""
+    sentence = sentence.lower()
+    if "? -yes/no" in sentence:
+        sentence = sentence.replace("? -yes/no", "")
+    if "? -open" in sentence:
+        sentence = sentence.replace("? -open", "")
+    if "? - open" in sentence:
+        sentence = sentence.replace("? - open", "")
+    return sentence.replace(',', '').replace('?', '').replace('\'s', ' \'s').replace('...', '').replace('x ray', 'x-ray').replace('.', '')
+
+
+PREPROCESS = {'vqa_rad': vqa_rad_question}
+
+
+def is_json_list(data_path):
+    # VQA-RAD sets are one json list, the report splits are jsonl
+    return os.path.splitext(data_path)[1] == '.json'
+
+
+def get_shards(data_path, num_shards):
+    """
+    jsonl: num_shards byte ranges cut on line boundaries, read by every worker on its own
+    json list: row ranges
+    """
+    if is_json_list(data_path):
+        num_rows = len(json.load(open(data_path)))
+        bounds = [num_rows * k // num_shards for k in range(num_shards + 1)]
+    else:
+        size = os.path.getsize(data_path)
+        bounds = [0]
+        with open(data_path, 'rb') as f:
+            for k in range(1, num_shards):
+                pos = max(size * k // num_shards, bounds[-1])
+                if pos > 0:
+                    f.seek(pos - 1)
+                    f.readline()  # to the start of the first line at or after pos
+                    pos = min(f.tell(), size)
+                bounds.append(pos)
+        bounds.append(size)
+    return [(st, end) for st, end in zip(bounds[:-1], bounds[1:]) if end > st]
+
+
+def read_texts(data_path, txt_key='text', shard=None):
+    """texts of the rows in shard (a range of get_shards), all rows by default"""
+    if is_json_list(data_path):
+        rows = json.load(open(data_path))
+        rows = rows[shard[0]:shard[1]] if shard is not None else rows
+        for row in rows:
+            yield row[txt_key]
+        return
+
+    st, end = shard if shard is not None else (0, os.path.getsize(data_path))
+    with open(data_path, 'rb') as f:
+        f.seek(st)
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            yield json.loads(line)[txt_key]
+
+
+def write_tokens(f, texts, tokenizer, vocab_stoi, unk_token="[UNK]", preprocess=None):
+    """appends the ids of texts to the open file f, returns the number of ids per text"""
+    lengths = []
+    for txt in texts:
+        txt = PREPROCESS[preprocess](txt) if preprocess is not None else txt
+        ids = encode_txt(tokenizer, vocab_stoi, txt, unk_token)
+        np.asarray(ids, dtype=np.int32).tofile(f)
+        lengths.append(len(ids))
+    return lengths
+
+
+def save_store_index(data_path, prefix, lengths, txt_key, vocab_size, meta=None):
+    _, offsets_file, meta_file = get_store_files(prefix)
+    offsets = np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)]).astype(np.int64)
+    np.save(offsets_file, offsets)
+
+    meta = dict(meta or {})
+    meta.update({'data_path': data_path, 'txt_key': txt_key, 'num_rows': len(offsets) - 1,
+                 'num_tokens': int(offsets[-1]), 'vocab_size': vocab_size})
+    with open(meta_file, 'w') as f:
+        json.dump(meta, f, indent=2)
+
+
+def build_token_store(data_path, tokenizer, vocab_stoi, prefix=None, txt_key='text', unk_token="[UNK]", meta=None,
+                      preprocess=None):
+    """
+    tokenizer: tokenize function, str -> list of word-pieces (no special tokens)
+    vocab_stoi: word-piece -> id
+    preprocess: key of PREPROCESS applied to every text first
+    Reports are stored untruncated, the datasets cut them to their own seq_len.
+    """
+    prefix = prefix if prefix is not None else get_store_prefix(data_path)
+    tokens_file, _, _ = get_store_files(prefix)
+
+    with open(tokens_file, 'wb') as f:
+        lengths = write_tokens(f, read_texts(data_path, txt_key), tokenizer, vocab_stoi, unk_token, preprocess)
+    save_store_index(data_path, prefix, lengths, txt_key, len(vocab_stoi), dict(meta or {}, preprocess=preprocess))
+    return prefix
+
+
+_worker_tokenizer = None
+
+
+def _init_worker(bert_model):
+    global _worker_tokenizer
+    _worker_tokenizer = get_tokenizer(bert_model)
+
+
+def _tokenize_shard(job):
+    data_path, shard, shard_file, txt_key, preprocess = job
+    tokenizer, vocab_stoi, unk_token = _worker_tokenizer
+    with open(shard_file, 'wb') as f:
+        return write_tokens(f, read_texts(data_path, txt_key, shard), tokenizer, vocab_stoi, unk_token, preprocess)
+
+
+def build_token_store_parallel(data_path, bert_model, num_workers, prefix=None, txt_key='text', preprocess=None,
+                               pool=None):
+    """
+    Same store as build_token_store with the tokenizer of bert_model, tokenized by num_workers processes:
+    every shard of get_shards goes to its own file, the shard files are then concatenated in order.
+    pool: multiprocessing pool initialized with _init_worker(bert_model), to share it across splits
+    """
+    prefix = prefix if prefix is not None else get_store_prefix(data_path)
+    tokens_file, _, _ = get_store_files(prefix)
+
+    # a few shards per worker, so one slow shard does not hold the others
+    shards = get_shards(data_path, num_workers * 4)
+    jobs = [(data_path, shard, f'{prefix}.shard{k}.int32', txt_key, preprocess) for k, shard in enumerate(shards)]
+    own_pool = pool is None
+    if own_pool:
+        pool = multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(bert_model,))
+    try:
+        shard_lengths = pool.map(_tokenize_shard, jobs)
+    finally:
+        if own_pool:
+            pool.close()
+            pool.join()
+
+    with open(tokens_file, 'wb') as f:
+        for job in jobs:
+            with open(job[2], 'rb') as shard_f:
+                shutil.copyfileobj(shard_f, f)
+            os.remove(job[2])
+
+    lengths = [n for shard in shard_lengths for n in shard]
+    _, vocab_stoi, _ = get_tokenizer(bert_model)
+    save_store_index(data_path, prefix, lengths, txt_key, len(vocab_stoi),
+                     meta={'bert_model': bert_model, 'preprocess': preprocess})
+    return prefix
+
+
+class TokenStore():
+    """
+    Read-only view over a store written by build_token_store.
+    store[idx] -> np.int32 array of the ids of row idx (jsonl line order)
+    """
+    def __init__(self, prefix):
+        tokens_file, offsets_file, meta_file = get_store_files(prefix)
+        self.prefix = prefix
+        self.meta = json.load(open(meta_file))
+        self.offsets = np.load(offsets_file, mmap_mode='r')
+        if self.meta['num_tokens'] > 0:
+            self.tokens = np.memmap(tokens_file, dtype=np.int32, mode='r')
+        else:
+            self.tokens = np.zeros(0, dtype=np.int32)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return self.tokens[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def get(self, idx, max_len=None):
+        """ids of row idx truncated to max_len, as a python list (same as truncate_txt + vocab lookup)"""
+        st, end = int(self.offsets[idx]), int(self.offsets[idx + 1])
+        if max_len is not None:
+            end = min(end, st + max_len)
+        return self.tokens[st:end].tolist()
+
+
+def load_token_store(data_path, num_rows, bert_model=None, preprocess=None):
+    """the store of data_path, checked against the rows of the split, the tokenizer and the PREPROCESS key it needs"""
+    store = TokenStore(get_store_prefix(data_path))
+    assert len(store) == num_rows, \
+        f'{store.prefix}: {len(store)} rows in token store, {num_rows} in {data_path}. Rebuild the store.'
+    if bert_model is not None:
+        assert store.meta.get('bert_model') == bert_model, \
+            f'{store.prefix} was built for {store.meta.get("bert_model")}, not {bert_model}'
+    assert store.meta.get('preprocess') == preprocess, \
+        f'{store.prefix} was built with --preprocess {store.meta.get("preprocess")}, not {preprocess}'
+    return store
+
+
+def get_tokenizer(bert_model):
+    """same tokenizer and vocab as main_origin.py and CXRDataset pick for bert_model"""
+    from transformers import BertTokenizer, AutoTokenizer
+    from transformers.tokenization_albert import AlbertTokenizer
+
+    if bert_model == "albert-base-v2":
+        tokenizer = AlbertTokenizer.from_pretrained(bert_model, do_lower_case=True)
+        return tokenizer.tokenize, tokenizer.get_vocab(), "<unk>"
+    elif bert_model == "emilyalsentzer/Bio_ClinicalBERT":
+        tokenizer = AutoTokenizer.from_pretrained(bert_model)
+    elif bert_model == "bionlp/bluebert_pubmed_mimic_uncased_L-12_H-768_A-12":
+        tokenizer = AutoTokenizer.from_pretrained(bert_model)
+    elif bert_model == "bert-small-scratch":
+        tokenizer = BertTokenizer.from_pretrained("google/bert_uncased_L-4_H-512_A-8", do_lower_case=True)
+    elif bert_model == "bert-base-scratch":
+        tokenizer = BertTokenizer.from_pretrained("bert-base-uncased", do_lower_case=True)
+    else:
+        tokenizer = BertTokenizer.from_pretrained(bert_model, do_lower_case=True)
+    return tokenizer.tokenize, tokenizer.vocab, "[UNK]"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_path", type=str, required=True, nargs='+', help="jsonl split(s) to tokenize")
+    parser.add_argument("--bert_model", type=str, default="bert-base-scratch")
+    parser.add_argument("--txt_key", type=str, default="text", help="'question' for the VQA-RAD sets")
+    parser.add_argument("--preprocess", type=str, default=None, choices=list(PREPROCESS))
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count(), help="tokenizer processes, 1: no pool")
+    args = parser.parse_args()
+
+    if args.num_workers > 1:
+        with multiprocessing.Pool(args.num_workers, initializer=_init_worker, initargs=(args.bert_model,)) as pool:
+            for data_path in args.data_path:
+                prefix = build_token_store_parallel(data_path, args.bert_model, args.num_workers, txt_key=args.txt_key,
+                                                    preprocess=args.preprocess, pool=pool)
+                print(f'{data_path} -> {prefix}')
+    else:
+        tokenizer, vocab_stoi, unk_token = get_tokenizer(args.bert_model)
+        for data_path in args.data_path:
+            prefix = build_token_store(data_path, tokenizer, vocab_stoi, txt_key=args.txt_key, unk_token=unk_token,
+                                       meta={'bert_model': args.bert_model, 'preprocess': args.preprocess},
+                                       preprocess=args.preprocess)
+            print(f'{data_path} -> {prefix}')
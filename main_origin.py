@@ -7,38 +7,85 @@ os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
 os.environ["CUDA_VISIBLE_DEVICES"] = "5,7"
 
 
-import wandb
+import copy
 import argparse
+import functools
 from datetime import datetime
 
+import torch
+
 from data.dataset_origin import CXRDataset
 from data.helper import get_transforms
-from torch.utils.data import DataLoader
+from data.length_bucket import LengthBucketBatchSampler, cxr_collate_fn
+from torch.utils.data import DataLoader, BatchSampler, RandomSampler, Subset
 
 from utils.utils import *
-from models.train_origin import CXRBERT_Trainer  # CXR-BERT
+from utils.distributed import (DIST_BACKENDS, init_distributed, is_main_process, get_rank, get_world_size,
+                               get_train_sampler, get_eval_sampler, set_epoch, broadcast_object, cleanup)
+from utils.amp import MixedPrecision
+from utils.checkpoint import ResumableBatchSampler
+from utils.eval_worker import EvalWorker, subsample_indices
+from utils.telemetry import TELEMETRY_SINKS, init_wandb
+from models.cxrbert_origin import CXRBERT
+from models.train_origin import CXRBERT_Trainer, evaluate, load_config  # CXR-BERT
 
 from transformers import BertTokenizer, AlbertTokenizer, AutoTokenizer
 
-def train(args):
-    wandb.init(config=args, project='CXR-BERT')
-
-    set_seed(args.seed)
-
+def get_tokenizer(args):
     # TODO: bert-base,small,tiny tokenizer
     if args.bert_model == "albert-base-v2":
-        tokenizer = AlbertTokenizer.from_pretrained(args.bert_model, do_lower_case=True).tokenize
+        return AlbertTokenizer.from_pretrained(args.bert_model, do_lower_case=True).tokenize
     elif args.bert_model == "emilyalsentzer/Bio_ClinicalBERT":  # same with Bert-base-cased model
-        tokenizer = AutoTokenizer.from_pretrained(args.bert_model).tokenize
+        return AutoTokenizer.from_pretrained(args.bert_model).tokenize
     elif args.bert_model == "bionlp/bluebert_pubmed_mimic_uncased_L-12_H-768_A-12":
-        tokenizer = AutoTokenizer.from_pretrained(args.bert_model).tokenize
+        return AutoTokenizer.from_pretrained(args.bert_model).tokenize
     elif args.bert_model == "bert-small-scratch":
-        tokenizer = BertTokenizer.from_pretrained("google/bert_uncased_L-4_H-512_A-8", do_lower_case=True).tokenize
+        return BertTokenizer.from_pretrained("google/bert_uncased_L-4_H-512_A-8", do_lower_case=True).tokenize
     elif args.bert_model == "bert-base-scratch":
-        tokenizer = BertTokenizer.from_pretrained("bert-base-uncased", do_lower_case=True).tokenize
+        return BertTokenizer.from_pretrained("bert-base-uncased", do_lower_case=True).tokenize
     else:
-        tokenizer = BertTokenizer.from_pretrained(args.bert_model, do_lower_case=True).tokenize
+        return BertTokenizer.from_pretrained(args.bert_model, do_lower_case=True).tokenize
+
+
+def eval_worker(args):
+    """scores the checkpoints of a run with --async_eval on the test set as they are written (utils/eval_worker.py)"""
+    set_seed(args.seed)
+    test_dataset = CXRDataset(args.test_dataset, get_tokenizer(args), get_transforms(args), args)
+    masker = test_dataset.mlm_masker
+    rows = subsample_indices(len(test_dataset), args.eval_subsample, seed=args.seed)
+    collate_fn = functools.partial(cxr_collate_fn, pad_id=test_dataset.pad_id) if args.length_bucket else None
+    test_data_loader = DataLoader(Subset(test_dataset, rows), batch_size=args.batch_size,
+                                  num_workers=args.num_workers, collate_fn=collate_fn)
+
+    cuda_condition = torch.cuda.is_available() and args.with_cuda
+    device = torch.device(args.eval_device or ("cuda" if cuda_condition else "cpu"))
+    model = CXRBERT(load_config(args), args).to(device)
+    amp = MixedPrecision(args.mixed_precision, device)
 
+    def score(state):
+        model.load_state_dict(state['model'])
+        # a fresh copy of the masker: the same masks for every checkpoint
+        result = evaluate(model, test_data_loader, copy.deepcopy(masker), args, device, amp)
+        return dict(result, eval_rows=len(rows))
+
+    worker = EvalWorker(args.eval_worker, args.eval_metrics_file, args.eval_poll)
+    worker.run(score)
+
+
+def train(args):
+    # torchrun: one process per gpu, DistributedDataParallel (utils/distributed.py)
+    init_distributed(args.dist_backend, args.with_cuda)
+    if args.output_path is None:
+        # the start time of rank 0 for every rank, each one would take its own otherwise
+        args.output_path = broadcast_object('output/' + str(datetime.now()))
+    if is_main_process() and not os.path.exists(args.output_path):  # torchrun: rank 0 saves
+        os.makedirs(args.output_path)
+        os.chmod(args.output_path, 0o777)
+    init_wandb(args.telemetry, args, project='CXR-BERT')  # --telemetry wandb only, rank 0
+
+    set_seed(args.seed + get_rank())  # model weights are broadcast from rank 0, dropout differs per rank
+
+    tokenizer = get_tokenizer(args)
     transforms = get_transforms(args)
 
     print("Load Train dataset", args.train_dataset)
@@ -49,17 +96,40 @@ def train(args):
         if args.test_dataset is not None else None
 
     print("Create DataLoader")
-    train_data_loader = DataLoader(train_dataset, batch_size=args.batch_size, num_workers=args.num_workers, shuffle=True)
-    test_data_loader = DataLoader(test_dataset, batch_size=args.batch_size, num_workers=args.num_workers, shuffle=False) \
-        if test_dataset is not None else None
+    if args.length_bucket:
+        # batches of reports of similar length, text padded only to the longest report of the batch
+        collate_fn = functools.partial(cxr_collate_fn, pad_id=train_dataset.pad_id)
+        train_sampler = LengthBucketBatchSampler(train_dataset.text_lengths(), args.batch_size, seed=args.seed,
+                                                 num_replicas=get_world_size(), rank=get_rank())
+        train_sampler = ResumableBatchSampler(train_sampler, seed=args.seed)
+        train_data_loader = DataLoader(train_dataset, batch_sampler=train_sampler, num_workers=args.num_workers,
+                                       collate_fn=collate_fn)
+        test_data_loader = DataLoader(test_dataset, batch_size=args.batch_size, num_workers=args.num_workers,
+                                      sampler=get_eval_sampler(test_dataset), shuffle=False,
+                                      collate_fn=collate_fn) if test_dataset is not None else None
+    else:
+        train_sampler = get_train_sampler(train_dataset, seed=args.seed)
+        if train_sampler is None:
+            train_sampler = RandomSampler(train_dataset)
+        # batch order from (seed, epoch), --resume skips the batches done (utils/checkpoint.py)
+        train_sampler = ResumableBatchSampler(BatchSampler(train_sampler, args.batch_size, drop_last=False),
+                                              seed=args.seed)
+        train_data_loader = DataLoader(train_dataset, batch_sampler=train_sampler, num_workers=args.num_workers)
+        test_data_loader = DataLoader(test_dataset, batch_size=args.batch_size, num_workers=args.num_workers,
+                                      sampler=get_eval_sampler(test_dataset), shuffle=False) \
+            if test_dataset is not None else None
 
     print("Creating BERT Trainer")
     trainer = CXRBERT_Trainer(args, train_dataloader=train_data_loader, test_dataloader=test_data_loader)
 
     print("Training Start!")
-    for epoch in range(args.epochs):
+    for epoch in range(trainer.start_epoch, args.epochs):
+        set_epoch(train_data_loader, epoch)
         trainer.train(epoch)
         trainer.save(epoch, args.output_path)
+    trainer.checkpoints.wait()
+    trainer.telemetry.close()
+    cleanup()
 
 
 if __name__ == '__main__':
@@ -72,20 +142,31 @@ if __name__ == '__main__':
                         default='/home/mimic-cxr/dataset/new_dset/Valid_253.jsonl',
                         help='test dataset for evaluating train set')
 
-    output_path = 'output/' + str(datetime.now())
-    if not os.path.exists(output_path):
-        os.mkdir(output_path)
-        os.chmod(output_path, 0o777)
-
-    parser.add_argument("--output_path", type=str, default=output_path, help="ex)path/to/save/model")
+    parser.add_argument("--output_path", type=str, default=None,
+                        help="ex)path/to/save/model, default output/<start time of the run>")
     parser.add_argument("--log_freq", type=int, default=10, help="printing loss every n inter: setting n")
+    parser.add_argument("--telemetry", type=str, default="jsonl", choices=TELEMETRY_SINKS,
+                        help="time per step of data wait, h2d, forward, backward and optimizer, throughput and peak "
+                             "memory to output_path/telemetry.jsonl (.csv), epoch metrics to metrics.jsonl; wandb: "
+                             "also both to a wandb run, the only sink needing wandb")
+    parser.add_argument("--telemetry_every", type=int, default=50,
+                        help="steps buffered between two telemetry writes (one cuda synchronize each)")
+    parser.add_argument("--wandb_watch", type=bool, default=False,
+                        help="--telemetry wandb: wandb.watch the model, gradient histograms, hooks on every parameter")
     parser.add_argument("--with_cuda", type=bool, default=True, help="training with CUDA: True or False")
     parser.add_argument("--cuda_devices", type=int, nargs='+', default=None, help="CUDA device ids")
+    parser.add_argument("--dist_backend", type=str, default="auto", choices=DIST_BACKENDS,
+                        help="torchrun launch: DistributedDataParallel backend, auto: nccl on cuda, gloo on cpu")
 
     parser.add_argument("--mlm_task", type=str, default=True,
                         help="The model will train only mlm task!! | True | False")
     parser.add_argument("--itm_task", type=str, default=True,
                         help="The model will train only itm task!! | True | False")
+    parser.add_argument("--max_pred", type=int, default=64,
+                        help="most MLM targets per report, the MLM head runs on batch_size x max_pred positions "
+                             "(15%% of --seq_len 253 is 38 on average, picks after the first max_pred stay unmasked)")
+    parser.add_argument("--mlm_replay", type=bool, default=False,
+                        help="reseed the MLM masking with (seed, step), same masks for the same step of every run")
 
     parser.add_argument('--attn_1d', type=bool, default=False, help='choose 1d attn(True) or full attn(False)')
     parser.add_argument('--BAR_attn', default=True, type=bool, help="Bidirectional Auto Regressive attn mask")
@@ -95,8 +176,11 @@ if __name__ == '__main__':
     parser.add_argument('--disturbing_mask', default=False, type=bool, help="Baseline attn mask(I-I, T-T)")
 
     parser.add_argument("--epochs", type=int, default=50, help='number of epochs')
-    parser.add_argument("--batch_size", type=int, default=36, help="number of batch size")
+    parser.add_argument("--batch_size", type=int, default=36, help="number of batch size (per process with torchrun)")
     parser.add_argument("--num_workers", type=int, default=20, help="dataloader worker size")
+    parser.add_argument("--length_bucket", type=bool, default=False,
+                        help="batch reports of similar length and pad the text to the longest one of the batch, "
+                             "with --Mixed or the 1d / full attn mask (--BAR_attn '')")
 
     # TODO: init model
     parser.add_argument("--hidden_size", type=int, default=768, choices=[768, 512, 128])
@@ -104,6 +188,23 @@ if __name__ == '__main__':
 
     ## pre_trained_model_path, weight_load
     parser.add_argument("--weight_load", type=bool, default=False, help='pre-trained_model_mid_epoch_load')
+    parser.add_argument("--checkpoint_every", type=int, default=0,
+                        help="full training state every n steps to output_path/checkpoints, written in the background, "
+                             "0: off")
+    parser.add_argument("--checkpoint_keep", type=int, default=2,
+                        help="newest checkpoints kept, 0: all; --async_eval: older ones once --eval_worker scored them")
+    parser.add_argument("--resume", type=str, default=None,
+                        help="checkpoint file, or a checkpoints directory for the newest one: continue at its step")
+    parser.add_argument("--async_eval", type=bool, default=False,
+                        help="no test loader at the end of the epoch, a checkpoint for --eval_worker instead")
+    parser.add_argument("--eval_worker", type=str, default=None,
+                        help="checkpoints directory of a run: score its checkpoints on test_dataset, no training")
+    parser.add_argument("--eval_device", type=str, default=None, help="device of --eval_worker, e.g. cuda:1 or cpu")
+    parser.add_argument("--eval_subsample", type=int, default=0,
+                        help="--eval_worker: fixed random subset of n test rows, 0: all")
+    parser.add_argument("--eval_poll", type=int, default=30, help="--eval_worker: seconds between two looks")
+    parser.add_argument("--eval_metrics_file", type=str, default=None,
+                        help="--eval_worker: jsonl the results are appended to, <checkpoints>/eval_metrics.jsonl")
     parser.add_argument("--pre_trained_model_path", type=str,
                         default='/home/hg_lee/cxr-bert/clinicalbert_vlp_re35_5',
 
@@ -129,15 +230,33 @@ if __name__ == '__main__':
     parser.add_argument("--img_postion", default=True, help='img_postion use!')
     parser.add_argument("--seq_len", type=int, default=253, help="maximum sequence len", choices=[128, 253])  # 253
     parser.add_argument("--max_seq_len", type=int, default=512, help="total sequence len")
+    parser.add_argument("--token_store", type=bool, default=False,
+                        help="read pre-tokenized reports built by data/token_store.py instead of tokenizing")
 
     parser.add_argument("--img_hidden_sz", type=int, default=2048)
     parser.add_argument("--img_encoder", type=str, default='random-pixel',
                         choices=['random-pixel', 'full-fiber', 'ViT'])
     parser.add_argument("--img_channel", type=int, default=3, choices=[1, 3])
+    parser.add_argument("--gray_input", type=bool, default=False,
+                        help="1-channel images, the RGB weights and normalization are folded into the first conv")
     parser.add_argument("--num_image_embeds", type=int, default=180, choices=[36, 49, 180, 256])
     parser.add_argument("--img_size", type=int, default=512, choices=[224, 512])  # TODO: change helper.py, resize(224)
+    parser.add_argument("--image_store", type=bool, default=False,
+                        help="read decoded pixels built by data/image_store.py instead of decoding jpgs")
+    parser.add_argument("--batch_transforms", type=bool, default=False,
+                        help="decoded uint8 images, Resize / Normalize run on the batch on the device")
+    parser.add_argument("--jpeg_draft", type=bool, default=False,
+                        help="img_size 224: decode jpgs near 224 in the DCT domain (data/jpeg_draft.py), then Resize")
+    parser.add_argument("--feature_store", type=bool, default=False,
+                        help="read ResNet-50 grids built by data/feature_store.py, the frozen backbone is not run")
     parser.add_argument("--img_embed_pool_type", type=str, default="max", choices=["max", "avg"])
+    parser.add_argument("--grad_checkpoint", type=str, default="none", choices=["none", "layer", "attention"],
+                        help="activation checkpointing of the BERT encoder layers, see models/grad_checkpoint.py")
+    parser.add_argument("--grad_checkpoint_every", type=int, default=1,
+                        help="checkpoint every k-th layer (0, k, 2k, ...) with --grad_checkpoint")
 
+    parser.add_argument("--mixed_precision", type=str, default="none", choices=["none", "fp16", "bf16"],
+                        help="torch.autocast compute dtype, fp16 with loss scaling (cuda), bf16 (cuda / cpu)")
     parser.add_argument("--lr", type=float, default=1e-5)
     parser.add_argument("--gradient_accumulation_steps", type=int, default=4)  # loss, optimizer.step() slowly
     parser.add_argument("--warmup", type=float, default=0.1)  # optimizer = BertAdam(warmup=args.warmup)
@@ -152,4 +271,12 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
-    train(args)
+    if args.length_bucket and not args.Mixed and (args.BAR_attn or args.disturbing_mask):
+        # the image rows of BAR and the text rows of DISTURBING attend to the text padding, which the buckets cut
+        raise ValueError("--length_bucket changes what --BAR_attn / --disturbing_mask attend to, "
+                         "use it with --Mixed or the 1d / full attn mask (--BAR_attn '')")
+
+    if args.eval_worker:
+        eval_worker(args)
+    else:
+        train(args)
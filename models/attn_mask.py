@@ -0,0 +1,48 @@
+"""
+attention masks from compact descriptors
+
+The datasets (CXRDataset, Preprocess4Seq2seq / Preprocess4Seq2seqDecoder of sc, which imports this module through
+the __path__ of pytorch_pretrained_bert) emit one small descriptor per sample instead of a dense total_len x total_len
+mask:
+    [vis_len, txt_st, txt_end, mode]
+    vis_len: [CLS] + image tokens + [SEP], every row attends to them in the causal modes
+    txt_st, txt_end: text block, causal (lower triangular) in S2S and BAR, key padding in FULL
+The models take the B x 4 batch of descriptors as their attn_desc argument, next to the dense attn_mask of the
+callers that still build one (a B x 4 key padding mask of a 4-token batch would otherwise look the same), and
+build the 0/1 masks for the whole batch on the device, from index grids cached per length.
+"""
+import torch
+
+FULL = 0        # rows attend to every key < txt_end (1d / full bidirectional mask)
+S2S = 1         # image keys for every row, causal text block
+BAR = 2         # S2S + image rows attend to everything
+DISTURBING = 3  # image-image and text-text blocks only
+
+_grid_cache = {}
+
+
+def attn_desc(vis_len, txt_st, txt_end, mode):
+    return torch.tensor([vis_len, txt_st, txt_end, mode], dtype=torch.long)
+
+
+def _get_grid(total_len, device):
+    key = (total_len, device)
+    if key not in _grid_cache:
+        idx = torch.arange(total_len, device=device)
+        _grid_cache[key] = (idx.view(1, -1, 1), idx.view(1, 1, -1))
+    return _grid_cache[key]
+
+
+def build_attn_mask(desc, total_len):
+    """desc: B x 4 long -> B x total_len x total_len long 0/1 mask, same as the per-sample masks"""
+    row, col = _get_grid(total_len, desc.device)
+    vis_len, txt_st, txt_end, mode = [d.view(-1, 1, 1) for d in desc.unbind(1)]
+
+    in_txt_row = (row >= txt_st) & (row < txt_end)
+    in_txt_col = (col >= txt_st) & (col < txt_end)
+    s2s = (col < vis_len) | (in_txt_row & in_txt_col & (col <= row))
+
+    mask = torch.where(mode == FULL, (col < txt_end).expand_as(s2s), s2s)
+    mask = torch.where(mode == BAR, s2s | (row < vis_len), mask)
+    mask = torch.where(mode == DISTURBING, ((row < vis_len) == (col < vis_len)) & (row < txt_end) & (col < txt_end), mask)
+    return mask.long()
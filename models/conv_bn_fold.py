@@ -0,0 +1,159 @@
+"""
+Conv-BN folding + channels_last for the ResNet-50 trunk of the image encoders at inference
+
+In eval mode BatchNorm is a per-channel affine map on its running statistics, so it folds into the conv
+before it: w' = w * gamma / sqrt(var + eps), b' = (b - mean) * gamma / sqrt(var + eps) + beta.
+fold_conv_bn returns such a folded copy of a trunk in channels_last (NHWC) layout, which the cudnn / oneDNN
+convolutions prefer. FoldedBackbone keeps that copy next to the trunk, folded once per device on the first
+forward in eval mode without grad, i.e. evaluation and serving; training and state_dicts use the trunk as before.
+The encoders derive from FoldedEncoder, which drops the copies on train() / eval(), load_state_dict and
+.to() / .cuda() / .half(), the points where the weights of the trunk change. Weights changed in place in eval mode
+outside of those (e.g. param.copy_()) need an explicit self.folded.clear(). The mmbt and sc encoders import this
+module too (their models / pytorch_pretrained_bert packages extend __path__ with this directory).
+
+Parity of the folded trunk and CPU latency of both, at 224 and 512:
+    $ python -m models.conv_bn_fold --sizes 224 512 --batch_size 8 --threads 8
+    $ python -m models.conv_bn_fold --gray_input --checkpoint /path/to/pytorch_model.bin
+"""
+import copy
+import itertools
+import time
+import argparse
+
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+
+def _fold_children(module):
+    # torchvision ResNet registers every BatchNorm2d right after the conv it normalizes (stem, Bottleneck, downsample)
+    prev_name, prev = None, None
+    for name, child in module.named_children():
+        if isinstance(child, nn.BatchNorm2d) and isinstance(prev, nn.Conv2d):
+            setattr(module, prev_name, fuse_conv_bn_eval(prev, child))
+            setattr(module, name, nn.Identity())
+        else:
+            _fold_children(child)
+        prev_name, prev = name, child
+
+
+@torch.no_grad()
+def fold_conv_bn(backbone, channels_last=True):
+    """eval-mode copy of backbone with every BatchNorm2d folded into the preceding Conv2d"""
+    folded = copy.deepcopy(backbone).eval()
+    _fold_children(folded)
+    for p in folded.parameters():
+        p.requires_grad_(False)
+    if channels_last:
+        folded = folded.to(memory_format=torch.channels_last)
+    return folded
+
+
+class FoldedBackbone():
+    """
+    folded copies of a trunk for its eval / no-grad forwards, one per device: DataParallel replicas share this object
+    (replicate copies the __dict__ of the module), each of them folds its own once. Not a submodule, so not in the
+    state_dict. Kept until clear(), see FoldedEncoder.
+    """
+    def __init__(self, channels_last=True):
+        self.channels_last = channels_last
+        self.cache = {}  # device -> folded trunk
+
+    def __call__(self, backbone, x):
+        folded = self.cache.get(x.device)
+        if folded is None:
+            folded = self.cache[x.device] = fold_conv_bn(backbone, self.channels_last)
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        return folded(x)
+
+    def clear(self):
+        self.cache = {}
+
+
+class FoldedEncoder(nn.Module):
+    """
+    nn.Module of the image encoders with a FoldedBackbone as self.folded: the folded copies are dropped whenever the
+    trunk may change (train(), load_state_dict(), a .to() / .half() that replaces its tensors), they are folded again
+    by the next eval forward without grad
+    """
+    def _clear_folded(self):
+        folded = self.__dict__.get('folded')
+        if folded is not None:
+            folded.clear()
+
+    def train(self, mode=True):
+        self._clear_folded()
+        return super(FoldedEncoder, self).train(mode)
+
+    def _tensor_keys(self):
+        return [(t.device, t.dtype, t.data_ptr()) for t in itertools.chain(self.parameters(), self.buffers())]
+
+    def _apply(self, fn, *args, **kwargs):
+        # .to() / .cuda() / .half() ...: only a change of the tensors drops the folded copies, not a no-op .to(device)
+        keys = self._tensor_keys()
+        module = super(FoldedEncoder, self)._apply(fn, *args, **kwargs)
+        if self._tensor_keys() != keys:
+            self._clear_folded()
+        return module
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self._clear_folded()
+        return super(FoldedEncoder, self)._load_from_state_dict(*args, **kwargs)
+
+
+def use_folded(module):
+    return not module.training and not torch.is_grad_enabled()
+
+
+def benchmark(backbone, sizes, batch_size=8, in_channels=3, steps=10, warmup=3):
+    """max abs / max relative output difference of the folded trunk, ms per batch of both, on cpu"""
+    backbone = backbone.eval()
+    folded = fold_conv_bn(backbone)
+    results = []
+    with torch.no_grad():
+        for size in sizes:
+            x = torch.rand(batch_size, in_channels, size, size)
+            ref, out = backbone(x), folded(x.contiguous(memory_format=torch.channels_last))
+            diff = (ref - out).abs().max().item()
+            row = {'size': size, 'max_abs_diff': diff, 'max_rel_diff': diff / ref.abs().max().item()}
+            for name, model, inp in (('bn', backbone, x),
+                                     ('folded', folded, x.contiguous(memory_format=torch.channels_last))):
+                for _ in range(warmup):
+                    model(inp)
+                st = time.perf_counter()
+                for _ in range(steps):
+                    model(inp)
+                row[name + '_ms'] = (time.perf_counter() - st) * 1000 / steps
+            results.append(row)
+    return results
+
+
+if __name__ == '__main__':
+    from models.gray_input import fold_gray_input
+    from data.feature_store import get_backbone
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[224, 512])
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--threads', type=int, default=0, help="torch.set_num_threads, 0: torch default")
+    parser.add_argument('--gray_input', action='store_true', help="1-channel trunk of --gray_input")
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help="model state_dict to take the trunk weights from, ImageNet ResNet-50 if not set")
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--rtol', type=float, default=1e-3, help="parity tolerance, relative to the largest output")
+    args = parser.parse_args()
+
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    backbone = get_backbone(args.checkpoint)
+    if args.gray_input:
+        fold_gray_input(backbone)
+    failed = False
+    for r in benchmark(backbone, args.sizes, args.batch_size, 1 if args.gray_input else 3, args.steps):
+        ok = r['max_rel_diff'] <= args.rtol
+        failed |= not ok
+        print(f"{r['size']:4d}px  bn {r['bn_ms']:8.1f} ms  folded {r['folded_ms']:8.1f} ms  "
+              f"speedup {r['bn_ms'] / r['folded_ms']:.2f}x  max abs diff {r['max_abs_diff']:.2e}  "
+              f"rel {r['max_rel_diff']:.2e}  {'ok' if ok else 'FAIL'}")
+    raise SystemExit(1 if failed else 0)
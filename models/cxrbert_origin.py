@@ -4,6 +4,9 @@ import torch
 import torch.nn as nn
 
 from models.image import ImageEncoder_cnn, Img_patch_embedding
+from models.attn_mask import build_attn_mask
+from models.grad_checkpoint import set_grad_checkpoint
+from utils.amp import compute_dtype
 
 from transformers.modeling_auto import AutoModel
 from transformers.modeling_bert import BertConfig, BertModel, BertPreTrainedModel
@@ -71,28 +74,35 @@ class CXRBertEncoder(BertPreTrainedModel):
 
         self.encoder = bert.encoder
         self.pooler = bert.pooler
+        if args.grad_checkpoint != 'none':
+            set_grad_checkpoint(self.encoder.layer, args.grad_checkpoint, args.grad_checkpoint_every)
 
-    def get_extended_attn_mask(self, attn_mask):
+    def get_extended_attn_mask(self, attn_mask, total_len, attn_desc=None):
+        if attn_desc is not None:
+            attn_mask = build_attn_mask(attn_desc, total_len)
         if attn_mask.dim() == 2:
             extended_attn_mask = attn_mask.unsqueeze(1).unsqueeze(2)
         elif attn_mask.dim() == 3:
             extended_attn_mask = attn_mask.unsqueeze(1)
         else:
             raise NotImplementedError
-        extended_attn_mask = extended_attn_mask.to(dtype=torch.float16)
+        extended_attn_mask = extended_attn_mask.to(dtype=compute_dtype(self))
         extended_attn_mask = (1.0 - extended_attn_mask) * - 10000.0
 
         return extended_attn_mask
 
-    def forward(self, cls_tok, input_txt, attn_mask, segment, input_img, sep_tok):
+    def forward(self, cls_tok, input_txt, attn_mask, segment, input_img, sep_tok, attn_desc=None):
+        """attn_mask: dense B x total_len | B x total_len x total_len mask, or None with the descriptors attn_desc"""
 
-        extended_attn_mask = self.get_extended_attn_mask(attn_mask)
+        # [CLS] + image + [SEP] + text, the text may be cut to the longest report of the batch
+        extended_attn_mask = self.get_extended_attn_mask(attn_mask, self.args.num_image_embeds + 2 + input_txt.size(1),
+                                                         attn_desc)
 
         if self.args.disturbing_mask:
-            img_tok = (torch.LongTensor(input_txt.size(0), (self.args.num_image_embeds)).fill_(0).cuda())
-            sep_segment = (torch.LongTensor(input_txt.size(0), 1).fill_(0).cuda())
-            cls_segment = (torch.LongTensor(input_txt.size(0), 1).fill_(0).cuda())
-            txt_cls_segment = (torch.LongTensor(input_txt.size(0), 1).fill_(1).cuda())
+            img_tok = input_txt.new_zeros(input_txt.size(0), self.args.num_image_embeds)
+            sep_segment = input_txt.new_zeros(input_txt.size(0), 1)
+            cls_segment = input_txt.new_zeros(input_txt.size(0), 1)
+            txt_cls_segment = input_txt.new_ones(input_txt.size(0), 1)
             txt_cls_out = self.txt_embeddings(cls_tok, txt_cls_segment)
             img, img_pos = self.img_encoder(input_img)  # BxNx2048
 
@@ -112,9 +122,9 @@ class CXRBertEncoder(BertPreTrainedModel):
             return encoded_layers[-1], cls_represent
 
         else:
-            img_tok = (torch.LongTensor(input_txt.size(0), self.args.num_image_embeds).fill_(0).cuda())
+            img_tok = input_txt.new_zeros(input_txt.size(0), self.args.num_image_embeds)
 
-            cls_segment = (torch.LongTensor(input_txt.size(0), 1).fill_(0).cuda())
+            cls_segment = input_txt.new_zeros(input_txt.size(0), 1)
             cls_out = self.txt_embeddings(cls_tok, cls_segment)
             sep_out = self.txt_embeddings(sep_tok, cls_segment)
 
@@ -141,9 +151,20 @@ class CXRBERT(BertPreTrainedModel):
         self.mlm = BertPreTrainingHeads(config, self.enc.txt_embeddings.word_embeddings.weight)
         self.itm = ImageTextMatching(args.hidden_size)
 
-    def forward(self, cls_tok, input_txt, attn_mask, segment, input_img, sep_tok):
-        x_mlm, x_itm, _ = self.enc(cls_tok, input_txt, attn_mask, segment, input_img, sep_tok)
+    def forward(self, cls_tok, input_txt, attn_mask, segment, input_img, sep_tok, masked_pos=None, attn_desc=None):
+        """
+        attn_desc: B x 4 mask descriptors of CXRDataset (models/attn_mask.py), attn_mask is None then
+        masked_pos: B x max_pred positions of the MLM targets in input_txt (MLMMasker, 0 padded). If given, only
+        these positions go through the transform + vocabulary projection and the MLM scores are
+        B x max_pred x vocab_size, the padded slots are left out of the loss by their weights.
+        Otherwise B x total_len x vocab_size as before.
+        """
+        x_mlm, x_itm, _ = self.enc(cls_tok, input_txt, attn_mask, segment, input_img, sep_tok, attn_desc)
 
+        if masked_pos is not None:
+            # the text is the end of the sequence, after [CLS] + image + [SEP]
+            masked_pos = masked_pos + (x_mlm.size(1) - input_txt.size(1))
+            x_mlm = torch.gather(x_mlm, 1, masked_pos.unsqueeze(2).expand(-1, -1, x_mlm.size(-1)))  # B x max_pred x H
         prediction_scores_masked, _ = self.mlm(x_mlm)
         predict_itm = self.itm(x_itm)
         return prediction_scores_masked, predict_itm
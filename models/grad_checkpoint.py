@@ -0,0 +1,128 @@
+"""
+activation checkpointing for the BERT encoders
+
+A training step keeps the activations of every encoder layer for backward, at 436 positions x 12 layers most
+of the memory of the step. A checkpointed module keeps only its inputs and runs its forward again in backward:
+    "layer": the whole BertLayer (attention + feed-forward) of every `every`-th layer
+    "attention": only the attention block of every `every`-th layer, the B x heads x L x L scores / probs
+                 are its largest activations
+    "none": off
+The class of the module is swapped for a subclass whose forward runs under torch.utils.checkpoint, so the
+parameter names, the state_dicts and the DataParallel replicas are unchanged. Only active in train mode with
+grad enabled; the RNG state is restored for the recompute, so the dropout masks and the gradients are the same
+as without checkpointing. Needs torch >= 1.11 (non-reentrant checkpoint).
+Set by --grad_checkpoint in main_origin.py, mmbt main.py and sc finetune.py (BertConfig.grad_checkpoint of the sc
+BertEncoder); the mmbt and sc model packages import this file.
+
+Step time, peak memory and gradient difference per mode, on a randomly initialized encoder:
+    $ python -m models.grad_checkpoint --device cuda --batch_size 36 --seq_len 436
+    $ python -m models.grad_checkpoint --device cuda --modes none layer layer:2 layer:3 attention
+"""
+import time
+import argparse
+
+import torch
+from torch.utils.checkpoint import checkpoint
+
+GRAD_CHECKPOINT_MODES = ['none', 'layer', 'attention']
+
+_checkpointed_classes = {}
+
+
+def _checkpointed_class(cls):
+    if cls not in _checkpointed_classes:
+        def forward(self, *args, **kwargs):
+            if self.training and torch.is_grad_enabled():
+                return checkpoint(cls.forward, self, *args, use_reentrant=False, **kwargs)
+            return cls.forward(self, *args, **kwargs)
+        _checkpointed_classes[cls] = type('Checkpointed' + cls.__name__, (cls,),
+                                          {'forward': forward, '_checkpoint_base': cls})
+    return _checkpointed_classes[cls]
+
+
+def _uncheckpoint(module):
+    base = type(module).__dict__.get('_checkpoint_base')
+    if base is not None:
+        module.__class__ = base
+
+
+def set_grad_checkpoint(layers, mode='none', every=1):
+    """layers: nn.ModuleList of BertLayer (BertEncoder.layer, HF or sc), each with an .attention block"""
+    assert mode in GRAD_CHECKPOINT_MODES, mode
+    assert every >= 1, every
+    for i, layer in enumerate(layers):
+        _uncheckpoint(layer)
+        _uncheckpoint(layer.attention)
+        if mode == 'none' or i % every:
+            continue
+        module = layer if mode == 'layer' else layer.attention
+        module.__class__ = _checkpointed_class(type(module))
+    return layers
+
+
+def parse_mode(spec):
+    # "layer" -> ("layer", 1), "layer:2" -> ("layer", 2)
+    mode, _, every = spec.partition(':')
+    return mode, int(every) if every else 1
+
+
+def benchmark(model, layers, forward, specs, steps=10, warmup=3):
+    """
+    forward() -> output tensor of model, backward of its squared mean per step, for each mode spec of specs:
+    ms / step, peak MiB over the memory allocated before (cuda only), max abs grad diff vs the first spec
+    """
+    device = next(model.parameters()).device
+    model.train()
+    results, ref_grads = [], None
+    for spec in specs:
+        set_grad_checkpoint(layers, *parse_mode(spec))
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+            torch.cuda.reset_peak_memory_stats(device)
+            base = torch.cuda.memory_allocated(device)
+        for step in range(warmup + steps):
+            if step == warmup:
+                if device.type == 'cuda':
+                    torch.cuda.synchronize(device)
+                st = time.perf_counter()
+            model.zero_grad(set_to_none=True)
+            torch.manual_seed(step)  # same dropout masks for every mode
+            forward().float().pow(2).mean().backward()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        step_ms = (time.perf_counter() - st) * 1000 / steps
+        peak = (torch.cuda.max_memory_allocated(device) - base) / 2 ** 20 if device.type == 'cuda' else float('nan')
+
+        grads = [p.grad.detach().clone() for p in model.parameters() if p.grad is not None]
+        if ref_grads is None:
+            ref_grads = grads
+        grad_diff = max((a.float() - b.float()).abs().max().item() for a, b in zip(ref_grads, grads))
+        results.append({'mode': spec, 'step_ms': step_ms, 'peak_mib': peak, 'grad_diff': grad_diff})
+    set_grad_checkpoint(layers, 'none')
+    return results
+
+
+def print_results(results):
+    for r in results:
+        print(f"{r['mode']:12s} {r['step_ms']:9.1f} ms/step  peak {r['peak_mib']:9.1f} MiB  "
+              f"grad max abs diff {r['grad_diff']:.2e}")
+
+
+if __name__ == '__main__':
+    from transformers.modeling_bert import BertConfig, BertEncoder
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--bert_model', type=str, default='bert-base-uncased', help="config of the encoder")
+    parser.add_argument('--batch_size', type=int, default=36)
+    parser.add_argument('--seq_len', type=int, default=436, help="[CLS] + image + [SEP] + text positions")
+    parser.add_argument('--modes', type=str, nargs='+', default=['none', 'layer', 'layer:2', 'attention'],
+                        help="mode[:every], mode in " + ', '.join(GRAD_CHECKPOINT_MODES))
+    parser.add_argument('--steps', type=int, default=10)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    encoder = BertEncoder(BertConfig.from_pretrained(args.bert_model)).to(device)
+    hidden = torch.randn(args.batch_size, args.seq_len, encoder.layer[0].attention.self.all_head_size, device=device)
+    mask = torch.zeros(args.batch_size, 1, 1, args.seq_len, device=device)
+    print_results(benchmark(encoder, encoder.layer, lambda: encoder(hidden, mask)[0], args.modes, steps=args.steps))
@@ -0,0 +1,46 @@
+"""
+native single-channel input for the ResNet-50 trunks of the image encoders
+
+The X-rays are gray; the ImageNet trunks take RGB. Instead of replicating the channel and normalizing it three
+times per image, fold_gray_input swaps the first conv for GrayInputConv2d, which takes the ToTensor() output in
+[0, 1] directly. Imported by the mmbt and sc models too (their models / pytorch_pretrained_bert packages extend
+__path__ with this directory), so the folded weights are computed by this one implementation everywhere.
+"""
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class GrayInputConv2d(nn.Conv2d):
+    """
+    First conv of the ResNet taking the 1-channel image, ToTensor() only, in [0, 1].
+    Normalize(mean, std) + the 3-channel replication are folded into the RGB weights:
+        conv(norm(x)) = conv(x, sum_c w_c / std_c) - conv(1, sum_c w_c * mean_c / std_c)
+    The second term is a constant map, computed on ones so the zero padding of the borders stays exact.
+    Shares the weight of conv, so state_dicts and checkpoints are the ones of the 3-channel model,
+    3-channel inputs go through the plain conv. mean / std: IMG_MEAN / IMG_STD of data/image_store.py.
+    """
+    def __init__(self, conv, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
+        super(GrayInputConv2d, self).__init__(conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride,
+                                              conv.padding, conv.dilation, conv.groups, conv.bias is not None,
+                                              conv.padding_mode)
+        self.weight = conv.weight
+        self.bias = conv.bias
+        self.register_buffer('mean', torch.tensor(mean).view(1, -1, 1, 1), persistent=False)
+        self.register_buffer('std', torch.tensor(std).view(1, -1, 1, 1), persistent=False)
+
+    def forward(self, x):
+        if x.size(1) != 1:
+            return super(GrayInputConv2d, self).forward(x)
+        weight = self.weight / self.std
+        out = F.conv2d(x, weight.sum(1, keepdim=True), self.bias, self.stride, self.padding, self.dilation)
+        ones = x.new_ones(1, 1, x.size(2), x.size(3))
+        offset = F.conv2d(ones, (weight * self.mean).sum(1, keepdim=True), None, self.stride, self.padding,
+                          self.dilation)
+        return out - offset
+
+
+def fold_gray_input(backbone):
+    """nn.Sequential ResNet-50 without avgpool / fc -> same module taking 1 x H x W inputs"""
+    backbone[0] = GrayInputConv2d(backbone[0])
+    return backbone
@@ -4,6 +4,10 @@ import torch.nn as nn
 
 from einops import rearrange
 
+from models.gray_input import fold_gray_input
+from models.conv_bn_fold import FoldedBackbone, FoldedEncoder, use_folded
+
+
 class ImageEncoder_pool(nn.Module):
     def __init__(self, args):
         super(ImageEncoder_pool, self).__init__()
@@ -43,21 +47,28 @@ class ImageEncoder_pool(nn.Module):
         return random_sample
 
 
-class ImageEncoder_cnn(nn.Module):
+class ImageEncoder_cnn(FoldedEncoder):
     def __init__(self, args):
         super(ImageEncoder_cnn, self).__init__()
         self.args = args
         model = torchvision.models.resnet50(pretrained=True)
         modules = list(model.children())[:-2]
         self.model = nn.Sequential(*modules)
+        if args.gray_input:
+            fold_gray_input(self.model)  # B x 1 x W x H inputs
+        self.folded = FoldedBackbone()  # eval without grad: BN folded into the convs, channels_last
 
     def forward(self, x):
         # B x 3 x W x H -> B x 2048 x M x M -> B x 2048 x N -> B x N x 2048
-        out = self.model(x)  # 512x512: torch.Size([16, 2048, 16, 16])
+        # --feature_store: x is already the B x 2048 x M x M grid of self.model (data/feature_store.py)
+        if self.args.feature_store:
+            out = x.float()
+        else:
+            out = self.folded(self.model, x) if use_folded(self) else self.model(x)  # 512x512: [16, 2048, 16, 16]
         out = torch.flatten(out, start_dim=2)
         out = out.transpose(1, 2).contiguous()  # B x N x 2048
 
-        vis_pe = torch.arange(out.size()[1], dtype=torch.long).cuda()
+        vis_pe = torch.arange(out.size()[1], dtype=torch.long, device=out.device)
         vis_pe = vis_pe.unsqueeze(0).expand(out.size()[0], out.size()[1])
 
         num_range = out.size()[1]
@@ -86,7 +97,7 @@ class fully_use_cnn(nn.Module):
         out = torch.flatten(out, start_dim=2)
         out = out.transpose(1, 2).contiguous()
 
-        vis_pe = torch.arange(out.size()[1], dtype=torch.long).cuda()
+        vis_pe = torch.arange(out.size()[1], dtype=torch.long, device=out.device)
         vis_pe = vis_pe.unsqueeze(0).expand(out.size()[0], out.size()[1])
 
         return out, vis_pe
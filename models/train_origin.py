@@ -3,61 +3,152 @@ Construct CXR-BERT or BertForMaskedLM, Training and Saving
 """
 import os
 import tqdm
-import wandb
 import datetime
-import numpy as np
 
 import torch
 import torch.nn as nn
 
 from models.cxrbert_origin import CXRBERT
+from data.image_store import normalize_batch
+from data.helper import get_batch_resize
+from utils.amp import MixedPrecision
+from utils.metrics import RunningMetrics
+from utils.distributed import is_distributed, is_main_process, wrap_ddp
+from utils.checkpoint import CheckpointManager, set_rng_state
+from utils.eval_worker import EvalWorker
+from utils.telemetry import StepTelemetry, watch_wandb
 
 from transformers.optimization import AdamW
 from transformers import BertConfig, AlbertConfig, AutoConfig
 
 
+def evaluate(model, test_data, masker, args, device, amp, desc=''):
+    """mean losses / accuracies of model over test_data, summed over the ranks under DDP"""
+    mlm_criterion = nn.CrossEntropyLoss(ignore_index=-100)
+    itm_criterion = nn.CrossEntropyLoss()
+    batch_resize = get_batch_resize(args)
+
+    test_data_iter = tqdm.tqdm(enumerate(test_data),
+                               desc=desc,
+                               total=len(test_data),
+                               bar_format='{l_bar}{r_bar}',
+                               disable=not is_main_process())
+    model.eval()
+    with torch.no_grad():
+        eval_metrics = RunningMetrics(device)
+        for i, data in test_data_iter:
+            cls_tok, input_ids, txt_labels, attn_masks, img, segment, is_aligned, sep_tok, itm_prob = data
+
+            cls_tok = cls_tok.to(device)
+            input_ids = input_ids.to(device)
+            input_ids, mlm_labels, masked_pos, masked_weights = masker(input_ids, step=i)
+            attn_masks = attn_masks.to(device)
+            img = img.to(device)
+            if args.image_store or args.batch_transforms:
+                img = normalize_batch(img, gray_input=args.gray_input, size=batch_resize)
+            segment = segment.to(device)
+            is_aligned = is_aligned.to(device)
+            sep_tok = sep_tok.to(device)
+
+            # MLM scores at the B x max_pred picked positions, the padded slots have the target -100 (ignore_index)
+            mlm_targets = mlm_labels.gather(1, masked_pos).masked_fill(masked_weights == 0, -100).flatten()
+            mlm_weights = masked_weights.flatten()
+            with amp.autocast():
+                mlm_output, itm_output = model(cls_tok, input_ids, None, segment, img, sep_tok,
+                                               masked_pos=masked_pos, attn_desc=attn_masks)
+                mlm_output = mlm_output.flatten(0, 1)  # B * max_pred x vocab_size
+
+                if args.mlm_task and args.itm_task == False:
+                    valid_mlm_loss = mlm_criterion(mlm_output, mlm_targets)
+                    valid_loss = valid_mlm_loss
+                    print('only valid mlm loss')
+
+                if args.itm_task and args.mlm_task == False:
+                    valid_itm_loss = itm_criterion(itm_output, is_aligned)
+                    valid_loss = valid_itm_loss
+                    print('only valid itm loss')
+
+                if args.mlm_task and args.itm_task:
+                    # TODO: weight each loss, mlm > itm
+                    valid_mlm_loss = mlm_criterion(mlm_output, mlm_targets)
+                    valid_itm_loss = itm_criterion(itm_output, is_aligned)
+                    eval_metrics.add('mlm_loss', valid_mlm_loss)
+                    eval_metrics.add('itm_loss', valid_itm_loss)
+
+                    valid_loss = valid_itm_loss + valid_mlm_loss
+
+            eval_metrics.add('loss', valid_loss)
+
+            if args.itm_task:
+                eval_metrics.add('itm_acc', itm_output.argmax(dim=-1).eq(is_aligned).sum(), is_aligned.nelement())
+
+            if args.mlm_task:
+                # weighted sum: the padded slots count neither as hits nor as targets
+                eval_metrics.add('mlm_acc', (mlm_output.argmax(dim=-1).eq(mlm_targets) * mlm_weights).sum(),
+                                 mlm_weights.sum())
+
+        return eval_metrics.compute()
+
+
+def load_config(args):
+    if args.bert_model == "albert-base-v2":
+        return AlbertConfig.from_pretrained(args.bert_model)
+    elif args.bert_model == "emilyalsentzer/Bio_ClinicalBERT":
+        return AutoConfig.from_pretrained(args.bert_model)
+    elif args.bert_model == "bionlp/bluebert_pubmed_mimic_uncased_L-12_H-768_A-12":
+        return AutoConfig.from_pretrained(args.bert_model)
+    elif args.bert_model == "bert-small-scratch":
+        return BertConfig.from_pretrained("google/bert_uncased_L-4_H-512_A-8")
+    elif args.bert_model == "bert-base-scratch":
+        return BertConfig.from_pretrained("bert-base-uncased")
+    else:
+        return BertConfig.from_pretrained(args.bert_model)  # bert-base, small, tiny
+
+
 class CXRBERT_Trainer():
     def __init__(self, args, train_dataloader, test_dataloader=None):
         self.args = args
+        self.batch_resize = get_batch_resize(args)
 
         cuda_condition = torch.cuda.is_available() and args.with_cuda
 
-        self.device = torch.device("cuda" if cuda_condition else "cpu")
-        print('Current cuda device ', torch.cuda.current_device())  # check
+        if is_distributed():
+            # torchrun: the gpu of this rank (utils/distributed.py init_distributed) or cpu
+            self.device = torch.device("cuda", torch.cuda.current_device()) if cuda_condition else torch.device("cpu")
+        else:
+            self.device = torch.device("cuda" if cuda_condition else "cpu")
+        if cuda_condition:
+            print('Current cuda device ', torch.cuda.current_device())  # check
 
         if args.weight_load:
             config = AutoConfig.from_pretrained(args.pre_trained_model_path)
-            model_state_dict = torch.load(os.path.join(args.pre_trained_model_path, 'pytorch_model.bin'))
+            model_state_dict = torch.load(os.path.join(args.pre_trained_model_path, 'pytorch_model.bin'), map_location='cpu')
             self.model = CXRBERT.from_pretrained(args.pre_trained_model_path, state_dict=model_state_dict,
                                                  config=config, args=args).to(self.device)
             print('training restart with mid epoch')
             print(config)
         else:
-            if args.bert_model == "albert-base-v2":
-                config = AlbertConfig.from_pretrained(args.bert_model)
-            elif args.bert_model == "emilyalsentzer/Bio_ClinicalBERT":
-                config = AutoConfig.from_pretrained(args.bert_model)
-            elif args.bert_model == "bionlp/bluebert_pubmed_mimic_uncased_L-12_H-768_A-12":
-                config = AutoConfig.from_pretrained(args.bert_model)
-            elif args.bert_model == "bert-small-scratch":
-                config = BertConfig.from_pretrained("google/bert_uncased_L-4_H-512_A-8")
-            elif args.bert_model == "bert-base-scratch":
-                config = BertConfig.from_pretrained("bert-base-uncased")
-            else:
-                config = BertConfig.from_pretrained(args.bert_model)  # bert-base, small, tiny
-
+            config = load_config(args)
             self.model = CXRBERT(config, args).to(self.device)
 
-        wandb.watch(self.model)
+        if args.wandb_watch:
+            watch_wandb(args.telemetry, self.model)  # gradient hooks on every parameter, off by default
 
-        if args.with_cuda and torch.cuda.device_count() > 1:
+        if is_distributed():
+            # a single task: the head of the other one is computed but not in the loss
+            single_task = self.args.mlm_task == False or self.args.itm_task == False
+            self.model = wrap_ddp(self.model, self.device, find_unused_parameters=single_task)
+        elif cuda_condition and torch.cuda.device_count() > 1:
             print("Using %d GPUS for BERT" % torch.cuda.device_count())
             self.model = nn.DataParallel(self.model, device_ids=args.cuda_devices)
 
         self.train_data = train_dataloader
         self.test_data = test_dataloader
+        self.train_masker = train_dataloader.dataset.mlm_masker
+        self.test_masker = test_dataloader.dataset.mlm_masker if test_dataloader is not None else None
 
         self.optimizer = AdamW(self.model.parameters(), lr=args.lr)
+        self.amp = MixedPrecision(args.mixed_precision, self.device)
 
         self.mlm_criterion = nn.CrossEntropyLoss(ignore_index=-100)
         self.itm_criterion = nn.CrossEntropyLoss()
@@ -65,199 +156,205 @@ class CXRBERT_Trainer():
         self.log_freq = args.log_freq
         self.step_cnt = 0
 
+        # data wait / h2d / forward / backward / optimizer time per step to output_path/telemetry.jsonl
+        self.telemetry = StepTelemetry(args.telemetry, args.output_path, self.device, every=args.telemetry_every)
+
+        # full training state every checkpoint_every steps, written in the background (utils/checkpoint.py)
+        # --async_eval: not pruned before the evaluation worker has scored them
+        checkpoints_dir = os.path.join(args.output_path, 'checkpoints')
+        scored = EvalWorker(checkpoints_dir, args.eval_metrics_file).scored if args.async_eval else None
+        self.checkpoints = CheckpointManager(checkpoints_dir, every=args.checkpoint_every, keep=args.checkpoint_keep,
+                                             scored=scored)
+        self.start_epoch, self.start_step, self.resume_rng = 0, 0, None
+        if args.resume:
+            self.resume(args.resume)
+
         print("Total Parameters:", sum([p.nelement() for p in self.model.parameters()]))
 
     def train(self, epoch):
 
         self.model.train()
 
-        train_losses = []
-        train_itm_loss = []
-        train_mlm_loss = []
+        # sums on the device, synced every log_freq steps and at the end of the epoch
+        train_metrics = RunningMetrics(self.device)
 
-        train_data_iter = tqdm.tqdm(enumerate(self.train_data),
+        # resumed mid-epoch: the batches done before the checkpoint are skipped, not loaded
+        start = self.start_step if epoch == self.start_epoch else 0
+        if start:
+            self.train_data.batch_sampler.skip(start)
+        batches = iter(self.train_data)
+        if self.resume_rng is not None:
+            set_rng_state(self.resume_rng)  # after iter(), which draws the worker seeds of the epoch
+            self.resume_rng = None
+
+        train_data_iter = tqdm.tqdm(enumerate(self.telemetry.batches(batches), start),
                                     desc=f'EP_:{epoch}',
                                     total=len(self.train_data),
-                                    bar_format='{l_bar}{r_bar}')
-        total_correct = 0
-        total_element = 0
-        total_mlm_correct = 0
-        total_mlm_element = 0
-
-        total_valid_correct = 0
-        total_valid_element = 0
-        total_mlm_valid_correct = 0
-        total_mlm_valid_element = 0
+                                    initial=start,
+                                    bar_format='{l_bar}{r_bar}',
+                                    disable=not is_main_process())
 
         for i, data in train_data_iter:
 
-
             cls_tok, input_ids, txt_labels, attn_masks, img, segment, is_aligned, sep_tok, itm_prob = data
 
-            cls_tok = cls_tok.to(self.device)
-            input_ids = input_ids.to(self.device)
-            txt_labels = txt_labels.to(self.device)
-            attn_masks = attn_masks.to(self.device)
-            img = img.to(self.device)
-            segment = segment.to(self.device)
-            is_aligned = is_aligned.to(self.device)
-            sep_tok = sep_tok.to(self.device)
-
-            mlm_output, itm_output = self.model(cls_tok, input_ids, attn_masks, segment, img, sep_tok)
-
-            if self.args.mlm_task and self.args.itm_task == False:
-                mlm_loss = self.mlm_criterion(mlm_output.transpose(1, 2), txt_labels)
-                loss = mlm_loss
-                print('only mlm_loss')
-
-            if self.args.itm_task and self.args.mlm_task == False:
-                itm_loss = self.itm_criterion(itm_output, is_aligned)
-                loss = itm_loss
-                print('only itm_loss')
-
-            if self.args.mlm_task and self.args.itm_task:
-
-                mlm_loss = self.mlm_criterion(mlm_output.transpose(1, 2), txt_labels)
-                train_mlm_loss.append(mlm_loss.item())
-
-                itm_loss = self.itm_criterion(itm_output, is_aligned)
-                train_itm_loss.append(itm_loss.item())
-
-                loss = itm_loss + mlm_loss
-
-            train_losses.append(loss.item())
-            self.optimizer.zero_grad()  # above
-            loss.backward()
-            self.optimizer.step()
-
-            if self.args.itm_task:
-                correct = itm_output.argmax(dim=-1).eq(is_aligned).sum().item()
-                total_correct += correct
-                total_element += is_aligned.nelement()
-
-            if self.args.mlm_task:
-                eq = (mlm_output.argmax(dim=-1).eq(txt_labels)).cpu().numpy()
-                txt_labels_np = txt_labels.cpu().numpy()
-                for bs, label in enumerate(txt_labels_np):
-                    index = np.where(label == -100)[0]
-                    f_label = np.delete(label, index)
-                    f_eq = np.delete(eq[bs], index)
-                    total_mlm_correct += f_eq.sum()
-                    total_mlm_element += len(f_label)
-
-        print("avg loss per epoch", np.mean(train_losses))
-        print("avg itm acc per epoch", round(total_correct / total_element * 100, 3))
-        if self.args.mlm_task and self.args.itm_task:
-            wandb.log({
-                "avg_loss": np.mean(train_losses),
-                "avg_mlm_loss": np.mean(train_mlm_loss),
-                "avg_itm_loss": np.mean(train_itm_loss),
-                "itm_acc": total_correct / total_element * 100,
-                "mlm_acc": total_mlm_correct / total_mlm_element * 100
-            }, step=epoch)
-
-        if self.args.itm_task and self.args.mlm_task == False:
-            wandb.log({
-                "avg_loss": np.mean(train_losses),
-                "itm_epoch_acc": total_correct / total_element * 100
-            }, step=epoch)
-
-        if self.args.mlm_task and self.args.itm_task == False:
-            wandb.log({
-                "avg_loss": np.mean(train_losses),
-                "mlm_epoch_acc": total_mlm_correct / total_mlm_element * 100
-            }, step=epoch)
-
-        test_data_iter = tqdm.tqdm(enumerate(self.test_data),
-                                   desc=f'EP_:{epoch}',
-                                   total=len(self.test_data),
-                                   bar_format='{l_bar}{r_bar}')
-        self.model.eval()
-        with torch.no_grad():
-            eval_losses = []
-            eval_mlm_loss = []
-            eval_itm_loss = []
-            for i, data in test_data_iter:
-                cls_tok, input_ids, txt_labels, attn_masks, img, segment, is_aligned, sep_tok, itm_prob = data
-
+            with self.telemetry.phase('h2d'):
                 cls_tok = cls_tok.to(self.device)
                 input_ids = input_ids.to(self.device)
-                txt_labels = txt_labels.to(self.device)
+                input_ids, mlm_labels, masked_pos, masked_weights = self.train_masker(
+                    input_ids, step=epoch * len(self.train_data) + i)
                 attn_masks = attn_masks.to(self.device)
                 img = img.to(self.device)
+                if self.args.image_store or self.args.batch_transforms:
+                    img = normalize_batch(img, gray_input=self.args.gray_input, size=self.batch_resize)
                 segment = segment.to(self.device)
                 is_aligned = is_aligned.to(self.device)
                 sep_tok = sep_tok.to(self.device)
 
-                mlm_output, itm_output = self.model(cls_tok, input_ids, attn_masks, segment, img, sep_tok)
+            # MLM scores at the B x max_pred picked positions, the padded slots have the target -100 (ignore_index)
+            mlm_targets = mlm_labels.gather(1, masked_pos).masked_fill(masked_weights == 0, -100).flatten()
+            mlm_weights = masked_weights.flatten()
+            with self.telemetry.phase('forward'), self.amp.autocast():
+                mlm_output, itm_output = self.model(cls_tok, input_ids, None, segment, img, sep_tok,
+                                                    masked_pos=masked_pos, attn_desc=attn_masks)
+                mlm_output = mlm_output.flatten(0, 1)  # B * max_pred x vocab_size
 
                 if self.args.mlm_task and self.args.itm_task == False:
-                    valid_mlm_loss = self.mlm_criterion(mlm_output.transpose(1, 2), txt_labels)
-                    valid_loss = valid_mlm_loss
-                    print('only valid mlm loss')
+                    mlm_loss = self.mlm_criterion(mlm_output, mlm_targets)
+                    loss = mlm_loss
+                    print('only mlm_loss')
 
                 if self.args.itm_task and self.args.mlm_task == False:
-                    valid_itm_loss = self.itm_criterion(itm_output, is_aligned)
-                    valid_loss = valid_itm_loss
-                    print('only valid itm loss')
+                    itm_loss = self.itm_criterion(itm_output, is_aligned)
+                    loss = itm_loss
+                    print('only itm_loss')
 
                 if self.args.mlm_task and self.args.itm_task:
-                    # TODO: weight each loss, mlm > itm
-                    valid_mlm_loss = self.mlm_criterion(mlm_output.transpose(1, 2), txt_labels)
-                    valid_itm_loss = self.itm_criterion(itm_output, is_aligned)
-                    eval_mlm_loss.append(valid_mlm_loss.item())
-                    eval_itm_loss.append(valid_itm_loss.item())
 
-                    valid_loss = valid_itm_loss + valid_mlm_loss
+                    mlm_loss = self.mlm_criterion(mlm_output, mlm_targets)
+                    train_metrics.add('mlm_loss', mlm_loss)
 
-                eval_losses.append(valid_loss.item())
+                    itm_loss = self.itm_criterion(itm_output, is_aligned)
+                    train_metrics.add('itm_loss', itm_loss)
 
-                if self.args.itm_task:
-                    valid_correct = itm_output.argmax(dim=-1).eq(is_aligned).sum().item()
-                    total_valid_correct += valid_correct
-                    total_valid_element += is_aligned.nelement()
+                    loss = itm_loss + mlm_loss
 
-                if self.args.mlm_task:
-                    eq = (mlm_output.argmax(dim=-1).eq(txt_labels)).cpu().numpy()
-                    txt_labels_np = txt_labels.cpu().numpy()
-                    for bs, label in enumerate(txt_labels_np):
-                        index = np.where(label == -100)[0]
-                        f_label = np.delete(label, index)
-                        f_eq = np.delete(eq[bs], index)
-                        total_mlm_valid_correct += f_eq.sum()
-                        total_mlm_valid_element += len(f_label)
+            train_metrics.add('loss', loss)
+            with self.telemetry.phase('backward'):
+                self.optimizer.zero_grad()  # above
+                self.amp.backward(loss)
+            with self.telemetry.phase('optimizer'):
+                self.amp.step(self.optimizer)
 
-            print("avg loss in testset", np.mean(eval_losses))
-            print("avg itm acc in testset", round(total_valid_correct / total_valid_element * 100, 3))
+            if self.args.itm_task:
+                train_metrics.add('itm_acc', itm_output.argmax(dim=-1).eq(is_aligned).sum(), is_aligned.nelement())
 
+            if self.args.mlm_task:
+                # weighted sum: the padded slots count neither as hits nor as targets
+                train_metrics.add('mlm_acc', (mlm_output.argmax(dim=-1).eq(mlm_targets) * mlm_weights).sum(),
+                                  mlm_weights.sum())
+
+            self.step_cnt += 1
+            self.telemetry.record(self.step_cnt, samples=input_ids.size(0), tokens=input_ids.numel(), epoch=epoch)
+            if self.checkpoints.should_save(self.step_cnt):
+                self.checkpoint(epoch, i + 1)
+            if self.log_freq > 0 and (i + 1) % self.log_freq == 0:
+                train_data_iter.set_postfix({k: round(v, 4) for k, v in train_metrics.compute().items()})
+
+        train_result = train_metrics.compute()
+        self.telemetry.end_epoch(wandb_step=epoch)
+        # empty when resumed from a checkpoint after the last batch of the epoch, only its evaluation is left
+        if train_result:
+            print("avg loss per epoch", train_result['loss'])
+            if self.args.itm_task:
+                print("avg itm acc per epoch", round(train_result['itm_acc'] * 100, 3))
             if self.args.mlm_task and self.args.itm_task:
-                wandb.log({
-                    "eval_avg_loss": np.mean(eval_losses),
-                    "eval_mlm_loss": np.mean(eval_mlm_loss),
-                    "eval_itm_loss": np.mean(eval_itm_loss),
-                    "eval_itm_acc": total_valid_correct / total_valid_element * 100,
-                    "eval_mlm_acc": total_mlm_valid_correct / total_mlm_valid_element * 100
+                self.telemetry.log({
+                    "avg_loss": train_result['loss'],
+                    "avg_mlm_loss": train_result['mlm_loss'],
+                    "avg_itm_loss": train_result['itm_loss'],
+                    "itm_acc": train_result['itm_acc'] * 100,
+                    "mlm_acc": train_result['mlm_acc'] * 100
                 }, step=epoch)
 
             if self.args.itm_task and self.args.mlm_task == False:
-                wandb.log({
-                    "eval_avg_loss": np.mean(eval_losses),
-                    "eval_itm_epoch_acc": total_valid_correct / total_valid_element * 100
+                self.telemetry.log({
+                    "avg_loss": train_result['loss'],
+                    "itm_epoch_acc": train_result['itm_acc'] * 100
                 }, step=epoch)
 
             if self.args.mlm_task and self.args.itm_task == False:
-                wandb.log({
-                    "eval_avg_loss": np.mean(eval_losses),
-                    "eval_mlm_epoch_acc": total_mlm_valid_correct / total_mlm_valid_element * 100
+                self.telemetry.log({
+                    "avg_loss": train_result['loss'],
+                    "mlm_epoch_acc": train_result['mlm_acc'] * 100
                 }, step=epoch)
 
+        if self.args.async_eval:
+            # scored by the evaluation worker (main_origin.py --eval_worker), training does not wait for it
+            if not self.checkpoints.should_save(self.step_cnt):
+                self.checkpoint(epoch, len(self.train_data))
+            return
+
+        eval_result = evaluate(self.model, self.test_data, self.test_masker, self.args, self.device, self.amp,
+                               desc=f'EP_:{epoch}')
+        print("avg loss in testset", eval_result['loss'])
+        if self.args.itm_task:
+            print("avg itm acc in testset", round(eval_result['itm_acc'] * 100, 3))
+
+        if self.args.mlm_task and self.args.itm_task:
+            self.telemetry.log({
+                "eval_avg_loss": eval_result['loss'],
+                "eval_mlm_loss": eval_result['mlm_loss'],
+                "eval_itm_loss": eval_result['itm_loss'],
+                "eval_itm_acc": eval_result['itm_acc'] * 100,
+                "eval_mlm_acc": eval_result['mlm_acc'] * 100
+            }, step=epoch)
+
+        if self.args.itm_task and self.args.mlm_task == False:
+            self.telemetry.log({
+                "eval_avg_loss": eval_result['loss'],
+                "eval_itm_epoch_acc": eval_result['itm_acc'] * 100
+            }, step=epoch)
+
+        if self.args.mlm_task and self.args.itm_task == False:
+            self.telemetry.log({
+                "eval_avg_loss": eval_result['loss'],
+                "eval_mlm_epoch_acc": eval_result['mlm_acc'] * 100
+            }, step=epoch)
+
+    def checkpoint(self, epoch, step):
+        """training state after `step` batches of `epoch`, every rank calls it"""
+        model = self.model.module if hasattr(self.model, 'module') else self.model
+        self.checkpoints.save(self.step_cnt, {
+            'epoch': epoch,
+            'step': step,
+            'final': epoch == self.args.epochs - 1 and step == len(self.train_data),  # the evaluation worker stops
+            'model': model.state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'amp': self.amp.state_dict(),
+            'mlm_masker': self.train_masker.state_dict(),
+        })
+
+    def resume(self, path):
+        state = self.checkpoints.load(path)
+        model = self.model.module if hasattr(self.model, 'module') else self.model
+        model.load_state_dict(state['model'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        self.amp.load_state_dict(state['amp'])
+        self.train_masker.load_state_dict(state['mlm_masker'])
+        self.step_cnt = state['global_step']
+        self.start_epoch, self.start_step = state['epoch'], state['step']
+        self.resume_rng = state['rng']
+
     def save(self, epoch, file_path):
+        if not is_main_process():
+            return
         save_path_per_ep = os.path.join(file_path, str(epoch))
         if not os.path.exists(save_path_per_ep):
             os.mkdir(save_path_per_ep)
             os.chmod(save_path_per_ep, 0o777)
 
-        if torch.cuda.device_count() > 1:
+        if hasattr(self.model, 'module'):
             self.model.module.save_pretrained(save_path_per_ep)
             print(f'Multi_EP: {epoch} Model saved on {save_path_per_ep}')
         else:
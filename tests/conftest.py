@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the tests import the packages of the repository root (models, utils, data) as the training scripts run from it do
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
@@ -0,0 +1,83 @@
+"""
+[user-015] self-attention backends of the sc BertEncoder (config.attn_impl, finetune.py --attn_impl): the fused-QKV
+scaled_dot_product_attention path against the eager per-projection path, same weights, dropout off, on every mask
+mode of pytorch_pretrained_bert/attn_mask.py; outputs and parameter gradients, and the history_states path of the
+decoder.
+"""
+import os
+import sys
+import copy
+
+import pytest
+import torch
+
+SC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      'Downstream_task', 'report_generation_and_vqa', 'sc')
+if SC_DIR not in sys.path:
+    sys.path.insert(0, SC_DIR)
+
+from pytorch_pretrained_bert.model import BertConfig, BertEncoder, BertSelfAttention
+from pytorch_pretrained_bert.attn_mask import attn_desc, build_attn_mask, FULL, S2S, BAR, DISTURBING
+
+BATCH_SIZE, LEN_VIS_INPUT, SEQ_LEN = 3, 7, 24
+HIDDEN_SIZE, NUM_HEADS, NUM_LAYERS = 32, 4, 2
+
+
+def extended_mask(desc, total_len):
+    # same as get_extended_attention_mask of the models
+    mask = build_attn_mask(desc, total_len).unsqueeze(1).float()
+    return (1.0 - mask) * -10000.0
+
+
+def random_desc(mode):
+    vis_len = LEN_VIS_INPUT + 2
+    descs = []
+    for _ in range(BATCH_SIZE):
+        # padded text in the modes bounded by txt_end, text up to the end in the causal ones
+        txt_end = int(torch.randint(vis_len + 1, SEQ_LEN + 1, (1,))) if mode in (FULL, DISTURBING) else SEQ_LEN
+        descs.append(attn_desc(vis_len, vis_len, txt_end, mode))
+    return torch.stack(descs)
+
+
+@pytest.fixture
+def encoders():
+    torch.manual_seed(0)
+    config = BertConfig(30522, hidden_size=HIDDEN_SIZE, num_hidden_layers=NUM_LAYERS, num_attention_heads=NUM_HEADS,
+                        intermediate_size=HIDDEN_SIZE * 4, hidden_dropout_prob=0.0, attention_probs_dropout_prob=0.0)
+    eager = BertEncoder(config).eval()
+    sdpa = copy.deepcopy(eager)
+    for module in sdpa.modules():
+        if isinstance(module, BertSelfAttention):
+            module.sdpa = True
+    return eager, sdpa
+
+
+@pytest.mark.parametrize('mode', [FULL, S2S, BAR, DISTURBING], ids=['FULL', 'S2S', 'BAR', 'DISTURBING'])
+def test_sdpa_matches_eager(encoders, mode):
+    hidden = torch.randn(BATCH_SIZE, SEQ_LEN, HIDDEN_SIZE)
+    mask = extended_mask(random_desc(mode), SEQ_LEN)
+    probe = torch.randn_like(hidden)  # random projection as loss, a norm of the LayerNorm'd output has ~0 gradients
+    outputs, grads = [], []
+    for model in encoders:
+        model.zero_grad()
+        out = model(hidden, mask, output_all_encoded_layers=False)[-1]
+        (out * probe).sum().backward()
+        outputs.append(out)
+        grads.append([p.grad for p in model.parameters()])
+
+    torch.testing.assert_close(outputs[1], outputs[0], atol=1e-4, rtol=1e-4)
+    # relative to the largest gradient of the model, the key bias has a 0 gradient (softmax shift invariance)
+    grad_scale = max(g.abs().max().item() for g in grads[0])
+    for eager_grad, sdpa_grad in zip(*grads):
+        assert (sdpa_grad - eager_grad).abs().max().item() <= 1e-3 * grad_scale
+
+
+def test_sdpa_matches_eager_with_history(encoders):
+    # incremental decoding: queries of the new positions, keys / values of history + new positions
+    attn_eager, attn_sdpa = [model.layer[0].attention.self for model in encoders]
+    history = torch.randn(BATCH_SIZE, SEQ_LEN - 2, HIDDEN_SIZE)
+    hidden = torch.randn(BATCH_SIZE, 2, HIDDEN_SIZE)
+    mask = extended_mask(random_desc(S2S), SEQ_LEN)[:, :, -2:]
+    with torch.no_grad():
+        torch.testing.assert_close(attn_sdpa(hidden, mask, history_states=history),
+                                   attn_eager(hidden, mask, history_states=history), atol=1e-4, rtol=1e-4)
@@ -0,0 +1,118 @@
+"""
+[user-004] attention masks built from descriptors (models/attn_mask.py) against the dense per-sample masks of the
+baseline CXRDataset and sc Preprocess4Seq2seq / Preprocess4Seq2seqDecoder
+"""
+import random
+
+import pytest
+import torch
+
+from models.attn_mask import attn_desc, build_attn_mask, FULL, S2S, BAR, DISTURBING
+
+
+def tril(n):
+    return torch.tril(torch.ones((n, n), dtype=torch.long))
+
+
+def baseline_cxr_mask(num_image_embeds, seq_len, txt_len, mode):
+    """the mask of CXRDataset.__getitem__ before the descriptors, txt_len: text + [SEP] without padding"""
+    total_len = seq_len + num_image_embeds + 3
+    vis_len = num_image_embeds + 2
+    attn_masks_t = [1] * txt_len + [0] * (seq_len + 1 - txt_len)
+    full_attn = torch.tensor([1] * vis_len + attn_masks_t, dtype=torch.long).unsqueeze(0) \
+        .expand(total_len, total_len).clone()
+    extended_attn_masks = torch.zeros(total_len, total_len, dtype=torch.long)
+    second_st, second_end = vis_len, vis_len + seq_len + 1  # input_ids were padded already
+    extended_attn_masks[:, :vis_len].fill_(1)
+    extended_attn_masks[second_st:second_end, second_st:second_end].copy_(tril(second_end - second_st))
+    if mode == FULL:
+        return full_attn
+    if mode == S2S:
+        return extended_attn_masks
+    if mode == BAR:
+        extended_attn_masks[:vis_len, :].fill_(1)
+        return extended_attn_masks
+    baseline_attn = torch.zeros(total_len, total_len, dtype=torch.long)
+    baseline_attn[:vis_len, :vis_len].fill_(1)
+    baseline_attn[vis_len:, vis_len:].fill_(1)
+    return baseline_attn
+
+
+def cxr_desc(num_image_embeds, seq_len, txt_len, mode):
+    # as CXRDataset.__getitem__
+    vis_len = num_image_embeds + 2
+    txt_end = vis_len + txt_len if mode == FULL else seq_len + num_image_embeds + 3
+    return attn_desc(vis_len, vis_len, txt_end, mode)
+
+
+def baseline_seq2seq_mask(len_a, len_b, max_len, mode):
+    """the mask of sc Preprocess4Seq2seq.__call__ before the descriptors, mode: BAR, S2S or FULL ('bi')"""
+    n_tokens = len_a + len_b + 3
+    input_mask = torch.zeros(max_len, max_len, dtype=torch.long)
+    second_st, second_end = len_a + 2, len_a + len_b + 3
+    if mode == FULL:
+        return torch.tensor([1] * n_tokens + [0] * (max_len - n_tokens), dtype=torch.long).unsqueeze(0) \
+            .expand(max_len, max_len).clone()
+    input_mask[:, :len_a + 2].fill_(1)
+    if mode == BAR:
+        input_mask[:len_a + 2, :].fill_(1)
+    input_mask[second_st:second_end, second_st:second_end].copy_(tril(second_end - second_st))
+    return input_mask
+
+
+def seq2seq_desc(len_a, len_b, mode):
+    # as Preprocess4Seq2seq.__call__
+    second_st, second_end = len_a + 2, len_a + len_b + 3
+    return attn_desc(len_a + 2, second_st, len_a + len_b + 3 if mode == FULL else second_end, mode)
+
+
+def baseline_decoder_mask(len_a, max_a_len, max_len_in_batch):
+    """the mask of sc Preprocess4Seq2seqDecoder.__call__ before the descriptors"""
+    input_mask = torch.zeros(max_len_in_batch, max_len_in_batch, dtype=torch.long)
+    input_mask[:, :len_a + 2].fill_(1)
+    second_st, second_end = max_a_len + 2, max_len_in_batch
+    input_mask[second_st:second_end, second_st:second_end].copy_(tril(second_end - second_st))
+    return input_mask
+
+
+@pytest.mark.parametrize('mode', [FULL, S2S, BAR, DISTURBING], ids=['FULL', 'S2S', 'BAR', 'DISTURBING'])
+def test_cxr_dataset_masks(mode):
+    num_image_embeds, seq_len = 5, 12
+    rng = random.Random(mode)
+    txt_lens = [1, seq_len + 1] + [rng.randint(1, seq_len + 1) for _ in range(6)]
+    desc = torch.stack([cxr_desc(num_image_embeds, seq_len, n, mode) for n in txt_lens])
+    expected = torch.stack([baseline_cxr_mask(num_image_embeds, seq_len, n, mode) for n in txt_lens])
+    assert torch.equal(build_attn_mask(desc, seq_len + num_image_embeds + 3), expected)
+
+
+def test_seq2seq_masks_mixed_batch():
+    # one batch mixing the modes, as descriptors of different samples are stacked by the collate function
+    len_a, max_len_b = 6, 10
+    max_len = len_a + max_len_b + 3
+    rng = random.Random(0)
+    samples = [(rng.randint(0, max_len_b), mode) for mode in (FULL, S2S, BAR) for _ in range(4)]
+    desc = torch.stack([seq2seq_desc(len_a, len_b, mode) for len_b, mode in samples])
+    expected = torch.stack([baseline_seq2seq_mask(len_a, len_b, max_len, mode) for len_b, mode in samples])
+    assert torch.equal(build_attn_mask(desc, max_len), expected)
+
+
+def test_decoder_masks():
+    max_a_len, max_len_in_batch = 8, 20
+    len_as = [3, 5, 8]
+    # as Preprocess4Seq2seqDecoder.__call__: the text block starts after the padded visual tokens
+    desc = torch.stack([attn_desc(len_a + 2, max_a_len + 2, max_len_in_batch, S2S) for len_a in len_as])
+    expected = torch.stack([baseline_decoder_mask(len_a, max_a_len, max_len_in_batch) for len_a in len_as])
+    assert torch.equal(build_attn_mask(desc, max_len_in_batch), expected)
+
+
+def test_key_padding_mask_is_not_a_descriptor():
+    from models.cxrbert_origin import CXRBertEncoder
+
+    # a key padding mask of 4 tokens has the shape of a batch of descriptors, only attn_desc is read as one
+    key_padding = torch.tensor([[1, 1, 1, 0], [1, 1, 0, 0]])
+    desc = torch.stack([attn_desc(2, 2, 4, S2S), attn_desc(2, 2, 3, FULL)])
+    encoder = torch.nn.Linear(1, 1)  # stands in for CXRBertEncoder, only the dtype of its parameters is read
+    extended = CXRBertEncoder.get_extended_attn_mask(encoder, key_padding, 4)
+    assert torch.equal(extended, (1.0 - key_padding[:, None, None].float()) * -10000.0)
+    extended = CXRBertEncoder.get_extended_attn_mask(encoder, None, 4, attn_desc=desc)
+    assert torch.equal(extended, (1.0 - build_attn_mask(desc, 4)[:, None].float()) * -10000.0)
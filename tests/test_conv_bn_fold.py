@@ -0,0 +1,107 @@
+"""[user-020] folded trunk of models/conv_bn_fold.py against the trunk with BatchNorm, and its cache lifecycle"""
+import pytest
+import torch
+import torch.nn as nn
+import torchvision
+
+from models.conv_bn_fold import FoldedBackbone, FoldedEncoder, fold_conv_bn, use_folded
+from models.gray_input import fold_gray_input
+
+
+def make_trunk(seed=0):
+    """ResNet-50 without avgpool / fc, random weights and BatchNorm statistics far from the identity"""
+    torch.manual_seed(seed)
+    trunk = nn.Sequential(*list(torchvision.models.resnet50(weights=None).children())[:-2])
+    with torch.no_grad():
+        for m in trunk.modules():
+            if isinstance(m, nn.BatchNorm2d):
+                m.running_mean.normal_(0, 0.1)
+                m.running_var.uniform_(0.5, 1.5)
+                m.weight.uniform_(0.5, 1.5)
+                m.bias.normal_(0, 0.1)
+    return trunk.eval()
+
+
+class Encoder(FoldedEncoder):
+    def __init__(self, seed=0):
+        super(Encoder, self).__init__()
+        self.model = make_trunk(seed)
+        self.folded = FoldedBackbone()
+
+    def forward(self, x):
+        return self.folded(self.model, x) if use_folded(self) else self.model(x)
+
+
+def assert_close(out, ref, rtol=1e-4):
+    assert out.shape == ref.shape
+    assert (out - ref).abs().max().item() <= rtol * ref.abs().max().item()
+
+
+@pytest.mark.parametrize('channels_last', [True, False])
+@pytest.mark.parametrize('input_layout', [torch.contiguous_format, torch.channels_last])
+def test_folded_matches_batchnorm(channels_last, input_layout):
+    trunk = make_trunk()
+    x = torch.rand(2, 3, 64, 64).contiguous(memory_format=input_layout)
+    with torch.no_grad():
+        ref = trunk(x)
+        out = FoldedBackbone(channels_last)(trunk, x)
+    assert not any(isinstance(m, nn.BatchNorm2d) for m in fold_conv_bn(trunk, channels_last).modules())
+    assert_close(out, ref)
+
+
+def test_folded_gray_input():
+    trunk = fold_gray_input(make_trunk())
+    x = torch.rand(2, 1, 64, 64)
+    with torch.no_grad():
+        assert_close(FoldedBackbone()(trunk, x), trunk(x))
+
+
+def test_folded_once_until_train_or_load_state_dict():
+    encoder = Encoder().eval()
+    x = torch.rand(2, 3, 64, 64)
+    with torch.no_grad():
+        encoder(x)
+        folded = encoder.folded.cache[x.device]
+        encoder(x)
+        assert encoder.folded.cache[x.device] is folded  # no refold while the trunk is unchanged
+
+        encoder.train()
+        assert not encoder.folded.cache
+        encoder.eval()
+        encoder(x)
+        assert encoder.folded.cache[x.device] is not folded
+
+        other = Encoder(seed=1).eval()
+        encoder.load_state_dict(other.state_dict())
+        assert not encoder.folded.cache
+        assert_close(encoder(x), other.model(x))
+
+
+def test_folded_kept_by_a_noop_move():
+    encoder = Encoder().eval()
+    model = nn.Sequential(encoder)
+    x = torch.rand(2, 3, 64, 64)
+    with torch.no_grad():
+        encoder(x)
+        folded = encoder.folded.cache[x.device]
+        # mmbt model_forward moved the whole model to its device before every batch
+        model.to(x.device)
+        model.float()
+        encoder(x)
+        assert encoder.folded.cache[x.device] is folded
+
+        model.double()  # the trunk changes: folded again
+        assert not encoder.folded.cache
+        model.float()
+        assert_close(encoder(x), encoder.model(x))
+
+
+def test_train_mode_and_grad_use_the_trunk():
+    encoder = Encoder()
+    x = torch.rand(2, 3, 64, 64)
+    encoder(x)
+    with torch.no_grad():
+        encoder(x)
+    encoder.eval()
+    encoder(x)
+    assert not encoder.folded.cache
@@ -0,0 +1,42 @@
+"""[user-024] evaluation worker: stops on the final checkpoint, unscored checkpoints are not pruned"""
+import os
+
+import torch
+
+from utils.checkpoint import CheckpointManager
+from utils.eval_worker import EvalWorker
+
+
+def save(checkpoints, step, epoch, final=False):
+    checkpoints.save(step, {'epoch': epoch, 'step': step, 'final': final, 'model': {'w': torch.full((2,), step)}})
+    checkpoints.wait()
+
+
+def names(dirname):
+    return sorted(n for n in os.listdir(dirname) if n.endswith('.pt'))
+
+
+def test_unscored_checkpoints_are_kept(tmp_path):
+    dirname = str(tmp_path)
+    worker = EvalWorker(dirname)
+    checkpoints = CheckpointManager(dirname, every=1, keep=1, scored=worker.scored)
+    for step in (1, 2, 3):
+        save(checkpoints, step, epoch=0)
+    assert len(names(dirname)) == 3  # none scored yet
+
+    worker.append({'checkpoint': os.path.basename(checkpoints.path(1))})
+    save(checkpoints, 4, epoch=1)
+    assert names(dirname) == [os.path.basename(checkpoints.path(s)) for s in (2, 3, 4)]
+
+
+def test_worker_stops_on_the_final_checkpoint(tmp_path):
+    dirname = str(tmp_path)
+    checkpoints = CheckpointManager(dirname, every=1, keep=0)
+    # the last epoch has a mid-epoch checkpoint before its final one
+    save(checkpoints, 2, epoch=0)
+    save(checkpoints, 3, epoch=1)
+    save(checkpoints, 4, epoch=1, final=True)
+    scored = []
+    EvalWorker(dirname, poll=0).run(lambda state: scored.append(state['global_step']) or {})
+    assert scored == [2, 3, 4]
+    assert len(EvalWorker(dirname).scored()) == 3
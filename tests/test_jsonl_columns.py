@@ -0,0 +1,84 @@
+"""
+[user-007] columnar jsonl rows (data/jsonl_columns.py): load_jsonl against the list of dicts the datasets loaded
+before, [json.loads(l) for l in open(data_path)], fresh, from the memory-mapped files, after the jsonl changed
+"""
+import os
+import json
+
+import numpy as np
+import pytest
+
+from data import jsonl_columns
+from data.jsonl_columns import JsonlColumns, load_jsonl
+
+ROWS = [
+    {'id': 'p10/s1.jpg', 'label': ['Cardiomegaly', 'Edema'], 'text': 'heart size is enlarged. no effusion.',
+     'img': 'files/p10/s1.jpg'},
+    {'id': 'p11/s2.jpg', 'label': [], 'text': '', 'img': 'files/p11/s2.jpg'},
+    {'id': 'p12/s3.jpg', 'label': ['No Finding'], 'text': 'lungs clear — no acute process, 2×3 cm.\n',
+     'img': 'files/p12/s3.jpg'},
+    {'id': 'p13/s4.jpg', 'label': None, 'text': 'unchanged "since" prior \\ study', 'img': 'files/p13/s4.jpg'},
+]
+
+
+def write_jsonl(path, rows):
+    with open(path, 'w') as f:
+        for row in rows:
+            f.write(json.dumps(row) + '\n')
+    return str(path)
+
+
+def baseline(data_path):
+    return [json.loads(l) for l in open(data_path)]
+
+
+def assert_same_rows(data, expected):
+    assert len(data) == len(expected)
+    assert list(data) == expected
+    for idx, row in enumerate(expected):
+        assert data[idx] == row
+        assert list(data[idx].keys()) == list(row.keys())  # the datasets unpack keys() in order
+        assert data[idx - len(expected)] == row
+
+
+def test_load_jsonl_matches_the_list(tmp_path):
+    data_path = write_jsonl(tmp_path / 'Train.jsonl', ROWS)
+    fresh = load_jsonl(data_path)
+    assert isinstance(fresh, JsonlColumns)
+    assert_same_rows(fresh, baseline(data_path))
+    with pytest.raises(IndexError):
+        fresh[len(ROWS)]
+
+    # the second load maps the saved columns
+    assert os.path.exists(str(tmp_path / 'Train.cols.meta.json'))
+    mapped = load_jsonl(data_path)
+    assert any(isinstance(b, np.memmap) for b in mapped.buffers.values())
+    assert_same_rows(mapped, baseline(data_path))
+    assert mapped.column('text') == [row['text'] for row in ROWS]
+
+
+def test_changed_jsonl_is_rebuilt(tmp_path):
+    data_path = write_jsonl(tmp_path / 'Train.jsonl', ROWS)
+    load_jsonl(data_path)
+    rows = ROWS[::-1] + [dict(ROWS[0], id='p14/s5.jpg', text='new report')]
+    write_jsonl(data_path, rows)
+    assert_same_rows(load_jsonl(data_path), baseline(data_path))
+
+
+def test_fallbacks(tmp_path, monkeypatch):
+    # rows with different keys stay the list of dicts
+    data_path = write_jsonl(tmp_path / 'Mixed.jsonl', [ROWS[0], {'id': 'p15', 'text': 'no label'}])
+    assert load_jsonl(data_path) == baseline(data_path)
+
+    # empty split
+    data_path = write_jsonl(tmp_path / 'Empty.jsonl', [])
+    assert list(load_jsonl(data_path)) == baseline(data_path) == []
+
+    # read-only data directory: the columns are kept in memory
+    def read_only(*args):
+        raise PermissionError('read-only file system')
+
+    monkeypatch.setattr(jsonl_columns, 'save_jsonl_columns', read_only)
+    data_path = write_jsonl(tmp_path / 'Valid.jsonl', ROWS)
+    assert_same_rows(load_jsonl(data_path), baseline(data_path))
+    assert not os.path.exists(str(tmp_path / 'Valid.cols.meta.json'))
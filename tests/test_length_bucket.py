@@ -0,0 +1,133 @@
+"""
+[user-006] length bucketing (data/length_bucket.py): LengthBucketBatchSampler against the shuffled batches of the
+baseline DataLoader, and the text padding cut by cxr_collate_fn / trim_text_padding against the full seq_len padding
+of the baseline collate
+"""
+import collections
+
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+from torch.utils.data.dataloader import default_collate
+
+from data.length_bucket import LengthBucketBatchSampler, cxr_collate_fn, trim_text_padding
+from models.attn_mask import attn_desc, build_attn_mask, FULL, S2S, BAR, DISTURBING
+
+PAD, CLS, SEP = 0, 101, 102
+NUM_IMAGE_EMBEDS, SEQ_LEN = 3, 20
+VIS_LEN = NUM_IMAGE_EMBEDS + 2
+TOTAL_LEN = VIS_LEN + SEQ_LEN + 1
+
+
+def cxr_item(n, mode, g):
+    """one CXRDataset.__getitem__ output for a report of n word-pieces, padded to seq_len + 1 like the baseline"""
+    input_ids = torch.randint(1000, 30000, (n,), generator=g).tolist() + [SEP] + [PAD] * (SEQ_LEN - n)
+    txt_labels = [-100] * VIS_LEN + [-100 if torch.rand(1, generator=g) < 0.85 else i for i in input_ids[:n]] \
+        + [-100] * (SEQ_LEN + 1 - n)
+    txt_end = VIS_LEN + n + 1 if mode == FULL else TOTAL_LEN
+    return (torch.tensor([CLS]), torch.tensor(input_ids), torch.tensor(txt_labels),
+            attn_desc(VIS_LEN, VIS_LEN, txt_end, mode), torch.rand(1, 8, 8, generator=g),
+            torch.ones(SEQ_LEN + 1, dtype=torch.long), torch.tensor(1), torch.tensor([SEP]), 0.7)
+
+
+@pytest.mark.parametrize('mode', [FULL, S2S, BAR, DISTURBING])
+def test_cxr_collate_fn_trims_padding(mode):
+    g = torch.Generator().manual_seed(0)
+    lengths = [3, 11, 7, 11]
+    batch = [cxr_item(n, mode, g) for n in lengths]
+
+    full = default_collate(batch)
+    trimmed = cxr_collate_fn(batch, pad_id=PAD)
+    txt_len = max(lengths) + 1  # text + [SEP]
+    assert trimmed[1].size(1) == txt_len
+    assert torch.equal(trimmed[1], full[1][:, :txt_len])
+    assert (full[1][:, txt_len:] == PAD).all()
+    assert torch.equal(trimmed[5], full[5][:, :txt_len])
+    # labels: image positions + text, the cut positions held no label
+    assert torch.equal(trimmed[2], full[2][:, :VIS_LEN + txt_len])
+    assert (full[2][:, VIS_LEN + txt_len:] == -100).all()
+    for i in (0, 4, 6, 7, 8):
+        assert torch.equal(torch.as_tensor(trimmed[i]), torch.as_tensor(full[i]))
+
+    # the mask of the trimmed batch is the block of the full-length mask the kept positions see
+    total_len = VIS_LEN + txt_len
+    full_mask = build_attn_mask(full[3], TOTAL_LEN)
+    trimmed_mask = build_attn_mask(trimmed[3], total_len)
+    assert torch.equal(trimmed_mask, full_mask[:, :total_len, :total_len])
+
+    if mode in (FULL, S2S):
+        # no kept position attends to the cut padding: the attention over the kept positions is unchanged
+        assert not full_mask[:, :total_len, total_len:].any()
+        q, k, v = torch.randn(3, len(lengths), TOTAL_LEN, 4, generator=g)
+        out_full = F.scaled_dot_product_attention(q, k, v, attn_mask=full_mask.bool())
+        out_trimmed = F.scaled_dot_product_attention(q[:, :total_len], k[:, :total_len], v[:, :total_len],
+                                                     attn_mask=trimmed_mask.bool())
+        torch.testing.assert_close(out_trimmed, out_full[:, :total_len])
+    else:
+        # BAR image rows / DISTURBING text rows of the full-length mask attend to the padding too
+        assert full_mask[:, :total_len, total_len:].any()
+
+
+def test_trim_text_padding():
+    input_ids = torch.tensor([[5, 6, 7, PAD, PAD], [5, 6, PAD, PAD, PAD]])
+    segment = torch.ones_like(input_ids)
+    attn_masks = torch.cat([torch.ones(2, VIS_LEN, dtype=torch.long), (input_ids != PAD).long()], 1)
+
+    ids, seg, mask = trim_text_padding(input_ids, segment, attn_masks, vis_len=VIS_LEN, pad_id=PAD)
+    assert ids.tolist() == [[5, 6, 7], [5, 6, PAD]]
+    assert seg.size(1) == 3 and torch.equal(mask, attn_masks[:, :VIS_LEN + 3])
+
+    # retrieval: positive and negative pairs cut to the same length
+    ids, seg, mask = trim_text_padding(input_ids, segment, attn_masks, vis_len=VIS_LEN, txt_len=4)
+    assert ids.size(1) == 4 and seg.size(1) == 4 and mask.size(1) == VIS_LEN + 4
+
+
+def bucket_lengths(n=1000):
+    return np.random.RandomState(0).randint(1, 120, size=n).tolist()
+
+
+@pytest.mark.parametrize('drop_last', [False, True])
+def test_sampler_covers_the_baseline_epoch(drop_last):
+    lengths, batch_size = bucket_lengths(), 32
+    sampler = LengthBucketBatchSampler(lengths, batch_size, bucket_size=8, drop_last=drop_last, seed=3)
+    baseline = DataLoader(range(len(lengths)), batch_size=batch_size, shuffle=True, drop_last=drop_last)
+
+    batches = list(sampler)
+    assert len(batches) == len(sampler) == len(baseline)
+    indices = [i for b in batches for i in b]
+    assert len(indices) == len(set(indices)) == sum(len(b) for b in baseline)
+    if not drop_last:
+        assert sorted(indices) == list(range(len(lengths)))
+    assert all(len(b) == batch_size for b in batches) if drop_last else \
+        sorted(len(b) for b in batches)[1:] == [batch_size] * (len(batches) - 1)
+
+
+def test_sampler_pads_less_than_random_batches():
+    lengths, batch_size = bucket_lengths(), 32
+    sampler = LengthBucketBatchSampler(lengths, batch_size, bucket_size=8, seed=3)
+    baseline = DataLoader(range(len(lengths)), batch_size=batch_size, shuffle=True,
+                          generator=torch.Generator().manual_seed(3))
+
+    def padded(batches):
+        return sum(len(b) * max(lengths[i] for i in b) for b in batches)
+
+    assert padded(list(sampler)) < 0.7 * padded([b.tolist() for b in baseline])
+
+
+def test_sampler_epochs_and_ranks():
+    lengths, batch_size = bucket_lengths(203), 8
+    sampler = LengthBucketBatchSampler(lengths, batch_size, bucket_size=4, seed=3)
+    first = list(sampler)
+    assert list(sampler) == first
+    sampler.set_epoch(1)
+    assert list(sampler) != first
+
+    # every rank the same number of batches, the ranks together cover all the rows
+    ranks = [LengthBucketBatchSampler(lengths, batch_size, bucket_size=4, seed=3, num_replicas=3, rank=r)
+             for r in range(3)]
+    per_rank = [list(s) for s in ranks]
+    assert len({len(b) for b in per_rank}) == 1 and all(len(b) == len(s) for b, s in zip(per_rank, ranks))
+    counts = collections.Counter(i for batches in per_rank for b in batches for i in b)
+    assert sorted(counts) == list(range(len(lengths)))
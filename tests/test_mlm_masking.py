@@ -0,0 +1,253 @@
+"""
+[user-005] batched MLM masking (data/mlm_masking.py, sc mlm_masking.py) against the per-sample masking of the baseline
+CXRDataset.random_word and sc Preprocess4Seq2seq, and the (seed, step) replay of --mlm_replay
+"""
+import os
+import sys
+import copy
+
+import pytest
+import torch
+
+from data.mlm_masking import MLMMasker
+
+SC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      'Downstream_task', 'report_generation_and_vqa', 'sc')
+if SC_DIR not in sys.path:
+    sys.path.insert(0, SC_DIR)
+
+from mlm_masking import Seq2seqMLMMasker
+
+PAD, CLS, SEP, MASK, UNK = 0, 101, 102, 103, 100
+VOCAB_LEN = 30522
+SEED = 7
+
+
+def baseline_random_word(tokens, random, mask_id, vocab_len):
+    """CXRDataset.random_word before the batched masking, random: the module it drew from"""
+    output_label = []
+
+    for i, token in enumerate(tokens):
+        prob = random.random()
+        if prob < 0.15:
+            prob /= 0.15
+
+            # 80% randomly change token to mask token
+            if prob < 0.8:
+                tokens[i] = mask_id
+
+            # 10% randomly change token to random token
+            elif prob < 0.9:
+                tokens[i] = random.randrange(vocab_len)
+
+            output_label.append(token)
+        else:
+            tokens[i] = token
+            output_label.append(-100)  # 0
+
+    if all(o == -100 for o in output_label):  # 0
+        # at least one mask
+        output_label[0] = tokens[0]
+        tokens[0] = mask_id
+
+    return tokens, output_label
+
+
+class DrawnRandom():
+    """stands in for the random module of one report: the uniform and random id the masker drew at each position"""
+    def __init__(self, prob, random_ids):
+        self.prob = prob.tolist()
+        self.random_ids = random_ids.tolist()
+        self.i = -1
+
+    def random(self):
+        self.i += 1
+        return self.prob[self.i]
+
+    def randrange(self, n):
+        return self.random_ids[self.i]
+
+
+def cxr_batch(lengths, seq_len):
+    """text ids of CXRDataset: report + [SEP] + [PAD] up to seq_len + 1"""
+    g = torch.Generator().manual_seed(0)
+    rows = []
+    for n in lengths:
+        report = torch.randint(1000, VOCAB_LEN, (n,), generator=g).tolist()
+        rows.append(report + [SEP] + [PAD] * (seq_len - n))
+    return torch.tensor(rows)
+
+
+def test_mlm_masker_matches_random_word():
+    lengths = [1, 2, 5, 17, 40, 40, 3, 28]
+    input_ids = cxr_batch(lengths, seq_len=40)
+    masker = MLMMasker(MASK, VOCAB_LEN, [SEP, PAD], seed=SEED)
+    masked, labels, masked_pos, masked_weights = masker(input_ids.clone())
+
+    # the same draws, in the order the masker takes them from a generator seeded the same way
+    g = torch.Generator().manual_seed(SEED)
+    prob = torch.rand(input_ids.shape, generator=g)
+    random_ids = torch.randint(VOCAB_LEN, input_ids.shape, generator=g)
+
+    for b, n in enumerate(lengths):
+        tokens, output_label = baseline_random_word(input_ids[b, :n].tolist(), DrawnRandom(prob[b], random_ids[b]),
+                                                    MASK, VOCAB_LEN)
+        assert masked[b, :n].tolist() == tokens
+        assert labels[b, :n].tolist() == output_label
+        # [SEP] and padding are never masked
+        assert torch.equal(masked[b, n:], input_ids[b, n:])
+        assert (labels[b, n:] == -100).all()
+        # the labelled positions in order, padded to the batch length without max_pred
+        pos = (labels[b] != -100).nonzero().flatten().tolist()
+        assert masked_pos[b].tolist() == pos + [0] * (input_ids.size(1) - len(pos))
+        assert masked_weights[b].tolist() == [1] * len(pos) + [0] * (input_ids.size(1) - len(pos))
+
+
+def test_mlm_masker_at_least_one_mask():
+    input_ids = cxr_batch([1, 3, 6], seq_len=8)
+    masker = MLMMasker(MASK, VOCAB_LEN, [SEP, PAD], mask_prob=1e-9, seed=SEED)
+    masked, labels, _, _ = masker(input_ids.clone())
+    assert (masked[:, 0] == MASK).all()
+    assert torch.equal(labels[:, 0], input_ids[:, 0])
+    assert (labels[:, 1:] == -100).all()
+
+
+def test_mlm_masker_rates():
+    input_ids = cxr_batch([60] * 256, seq_len=60)
+    masked, labels, _, _ = MLMMasker(MASK, VOCAB_LEN, [SEP, PAD], seed=SEED)(input_ids.clone())
+    picked = labels[:, :60] != -100
+    assert abs(picked.float().mean().item() - 0.15) < 0.01
+    n = picked.sum().item()
+    as_mask = (masked[:, :60][picked] == MASK).sum().item()
+    unchanged = (masked[:, :60][picked] == input_ids[:, :60][picked]).sum().item()
+    assert abs(as_mask / n - 0.8) < 0.03
+    assert abs(unchanged / n - 0.1) < 0.03
+
+
+def test_mlm_masker_max_pred():
+    lengths, max_pred = [3, 60, 60, 20], 6
+    input_ids = cxr_batch(lengths, seq_len=60)
+    masked, labels, _, _ = MLMMasker(MASK, VOCAB_LEN, [SEP, PAD], seed=SEED)(input_ids.clone())
+    capped = MLMMasker(MASK, VOCAB_LEN, [SEP, PAD], max_pred=max_pred, seed=SEED)(input_ids.clone())
+
+    # the same draws: the first max_pred picks of a report are kept, the ones after stay unmasked and unlabelled
+    for b in range(len(lengths)):
+        pos = (labels[b] != -100).nonzero().flatten()
+        kept, cut = pos[:max_pred], pos[max_pred:]
+        assert torch.equal(capped[1][b, kept], labels[b, kept]) and (capped[1][b, cut] == -100).all()
+        assert torch.equal(capped[0][b, kept], masked[b, kept]) and torch.equal(capped[0][b, cut], input_ids[b, cut])
+        assert capped[2][b].tolist() == kept.tolist() + [0] * (max_pred - len(kept))
+        assert capped[3][b].tolist() == [1] * len(kept) + [0] * (max_pred - len(kept))
+    assert capped[2].shape == capped[3].shape == (len(lengths), max_pred)
+    assert (capped[3].sum(1) == max_pred).any()
+
+    # positions padded to max_pred when the batch is shorter
+    short = MLMMasker(MASK, VOCAB_LEN, [SEP, PAD], max_pred=8, seed=SEED)(cxr_batch([2, 4], seq_len=4))
+    assert short[2].shape == short[3].shape == (2, 8)
+
+
+def gather_masked_scores(scores, masked_pos):
+    """CXRBERT.forward: the rows of masked_pos, B x max_pred x vocab_size"""
+    return torch.gather(scores, 1, masked_pos.unsqueeze(2).expand(-1, -1, scores.size(-1)))
+
+
+def test_masked_pos_gather_matches_the_labelled_rows():
+    input_ids = cxr_batch([1, 7, 30, 12], seq_len=30)
+    _, labels, masked_pos, masked_weights = MLMMasker(MASK, VOCAB_LEN, [SEP, PAD], max_pred=12, seed=SEED)(input_ids)
+    scores = torch.randn(*input_ids.shape, VOCAB_LEN)
+    rows, cols = (labels != -100).nonzero(as_tuple=True)
+    scores[rows[::2], cols[::2], labels[rows[::2], cols[::2]]] = 100.  # every other target predicted
+    # the weighted slots of the fixed-size gather are the rows the boolean selection took, in the same order
+    gathered = gather_masked_scores(scores, masked_pos)
+    assert torch.equal(gathered[masked_weights.bool()], scores[labels != -100])
+
+
+    # train_origin.py: targets gathered with -100 at the padded slots, loss and accuracy equal the selected ones
+    targets = labels.gather(1, masked_pos).masked_fill(masked_weights == 0, -100).flatten()
+    weights = masked_weights.flatten()
+    selected_scores, selected_targets = scores[labels != -100], labels[labels != -100]
+    criterion = torch.nn.CrossEntropyLoss(ignore_index=-100)
+    torch.testing.assert_close(criterion(gathered.flatten(0, 1), targets), criterion(selected_scores, selected_targets))
+    hits = (gathered.flatten(0, 1).argmax(dim=-1).eq(targets) * weights).sum()
+    assert hits == selected_scores.argmax(dim=-1).eq(selected_targets).sum() == len(rows[::2])
+    assert weights.sum() == selected_targets.nelement()
+
+
+def seq2seq_batch(lengths, len_vis_input, max_len):
+    """input_ids of Preprocess4Seq2seq: [CLS] + visual [UNK]s + [SEP] + report + [SEP], padded to max_len"""
+    g = torch.Generator().manual_seed(0)
+    rows = []
+    for n in lengths:
+        tokens = [CLS] + [UNK] * len_vis_input + [SEP] + torch.randint(1000, VOCAB_LEN, (n,), generator=g).tolist() \
+            + [SEP]
+        rows.append(tokens + [PAD] * (max_len - len(tokens)))
+    return torch.tensor(rows)
+
+
+def baseline_n_pred(effective_length, max_pred, mask_prob):
+    return min(max_pred, max(1, int(round(effective_length * mask_prob))))
+
+
+@pytest.mark.parametrize('mask_last_sep', [False, True])
+def test_seq2seq_masker_matches_baseline(mask_last_sep):
+    len_vis_input, max_pred, mask_prob = 4, 10, 0.15
+    lengths = [1, 2, 9, 20, 40, 120, 33]
+    max_len = len_vis_input + 3 + max(lengths)
+    input_ids = seq2seq_batch(lengths, len_vis_input, max_len)
+    masker = Seq2seqMLMMasker(MASK, max_pred, mask_prob, len_vis_input + 2, pad_id=PAD,
+                              mask_last_sep=mask_last_sep, seed=SEED)
+
+    with_sep = [0] * len(lengths)
+    for _ in range(200):
+        masked, masked_ids, masked_pos, masked_weights = masker(input_ids)
+        for b, n in enumerate(lengths):
+            n_pred = baseline_n_pred(n, max_pred, mask_prob)
+            pos = masked_pos[b, :n_pred].tolist()
+            # candidates of the baseline: report tokens and the last [SEP], each at most once
+            assert len(set(pos)) == n_pred
+            assert all(len_vis_input + 2 <= p <= len_vis_input + 2 + n for p in pos)
+            assert masked_ids[b, :n_pred].tolist() == input_ids[b, pos].tolist()
+            assert (masked[b, pos] == MASK).all()
+            keep = torch.ones(max_len, dtype=torch.bool)
+            keep[pos] = False
+            assert torch.equal(masked[b, keep], input_ids[b, keep])
+            # zero padded to max_pred, only the n_pred positions count in the loss
+            assert masked_weights[b].tolist() == [1] * n_pred + [0] * (max_pred - n_pred)
+            assert (masked_pos[b, n_pred:] == 0).all() and (masked_ids[b, n_pred:] == 0).all()
+            with_sep[b] += len_vis_input + 2 + n in pos
+
+    for b, n in enumerate(lengths):
+        # the last [SEP] is one of n + 1 candidates, mask_last_sep adds it in half of the reports
+        rate = baseline_n_pred(n, max_pred, mask_prob) / (n + 1)
+        if mask_last_sep:
+            rate = 0.5 + 0.5 * rate
+        assert abs(with_sep[b] / 200 - rate) < 0.12
+
+
+@pytest.mark.parametrize('make_masker, make_batch', [
+    (lambda replay: MLMMasker(MASK, VOCAB_LEN, [SEP, PAD], seed=SEED, replay=replay),
+     lambda: cxr_batch([5, 30, 12], seq_len=30)),
+    (lambda replay: Seq2seqMLMMasker(MASK, 10, 0.15, 6, pad_id=PAD, seed=SEED, replay=replay),
+     lambda: seq2seq_batch([5, 30, 12], 4, 37)),
+])
+def test_replay_and_resume(make_masker, make_batch):
+    input_ids = make_batch()
+
+    # replay: the masks of a step do not depend on the batches masked before
+    replayed = make_masker(True)
+    first = replayed(input_ids, step=3)
+    for step in range(5):
+        replayed(input_ids, step=step)
+    again = replayed(input_ids, step=3)
+    assert all(torch.equal(a, b) for a, b in zip(first, again))
+    other = replayed(input_ids, step=4)
+    assert not all(torch.equal(a, b) for a, b in zip(first, other))
+
+    # without replay, a resumed masker continues the stream of the checkpointed one
+    masker = make_masker(False)
+    masker(input_ids)
+    state = copy.deepcopy(masker.state_dict())
+    expected = masker(input_ids)
+    resumed = make_masker(False)
+    resumed.load_state_dict(state)
+    assert all(torch.equal(a, b) for a, b in zip(expected, resumed(input_ids)))
@@ -0,0 +1,29 @@
+"""[user-025] epoch metrics of StepTelemetry.log, wandb only imported by the wandb sink"""
+import sys
+import json
+
+import numpy as np
+
+from utils.telemetry import StepTelemetry, init_wandb, watch_wandb
+
+
+def test_log_writes_metrics_without_wandb(tmp_path, monkeypatch):
+    monkeypatch.setitem(sys.modules, 'wandb', None)  # import wandb fails
+    assert init_wandb('jsonl', {}) is None
+    watch_wandb('csv', None)
+    telemetry = StepTelemetry('csv', str(tmp_path))
+    telemetry.record(1, samples=2, tokens=8, epoch=0)
+    telemetry.end_epoch(wandb_step=0)
+    telemetry.log({'avg_loss': np.float32(0.5), 'class accuracy': {'A': 1.0}}, step=0)
+    telemetry.log({'test_loss': 0.25})
+    telemetry.close()
+    lines = [json.loads(line) for line in open(tmp_path / 'metrics.jsonl')]
+    assert lines == [{'step': 0, 'avg_loss': 0.5, 'class accuracy': {'A': 1.0}}, {'test_loss': 0.25}]
+    assert (tmp_path / 'telemetry.csv').exists()
+
+
+def test_none_sink_writes_nothing(tmp_path):
+    telemetry = StepTelemetry('none', str(tmp_path))
+    telemetry.log({'avg_loss': 0.5}, step=0)
+    telemetry.close()
+    assert not list(tmp_path.iterdir())
@@ -0,0 +1,66 @@
+"""
+[user-001] pre-tokenized report store (data/token_store.py): the ids read back against the tokenizer, the checks of
+load_token_store, and the single copy the mmbt and report_generation_and_vqa pipelines import as data.token_store
+"""
+import os
+import sys
+import json
+import subprocess
+
+import pytest
+
+from conftest import ROOT
+from data.token_store import build_token_store, load_token_store, vqa_rad_question
+
+VOCAB = ["[PAD]", "[UNK]", "heart", "size", "is", "normal", "no", "effusion", "lungs", "clear", "x-ray"]
+STOI = {w: i for i, w in enumerate(VOCAB)}
+ROWS = ["heart size is normal", "no effusion", "", "lungs clear pneumothorax"]
+
+
+def write_jsonl(path, texts):
+    with open(path, 'w') as f:
+        for txt in texts:
+            f.write(json.dumps({'text': txt}) + '\n')
+    return str(path)
+
+
+def test_store_matches_the_tokenizer(tmp_path):
+    data_path = write_jsonl(tmp_path / 'Train.jsonl', ROWS)
+    build_token_store(data_path, str.split, STOI, meta={'bert_model': 'bert-base-uncased'})
+    store = load_token_store(data_path, len(ROWS), 'bert-base-uncased')
+    assert [store.get(i) for i in range(len(ROWS))] == \
+        [[STOI.get(w, STOI["[UNK]"]) for w in txt.split()] for txt in ROWS]
+    assert store.get(0, max_len=2) == [STOI["heart"], STOI["size"]]
+
+
+def test_load_token_store_checks(tmp_path):
+    data_path = write_jsonl(tmp_path / 'Train.jsonl', ROWS)
+    build_token_store(data_path, str.split, STOI, meta={'bert_model': 'bert-base-uncased'})
+    with pytest.raises(AssertionError, match='rows in token store'):
+        load_token_store(data_path, len(ROWS) + 1)
+    with pytest.raises(AssertionError, match='was built for bert-base-uncased'):
+        load_token_store(data_path, len(ROWS), 'bert-base-scratch')
+    # reports are not cleaned as VQA-RAD questions, and the other way round
+    with pytest.raises(AssertionError, match='--preprocess None, not vqa_rad'):
+        load_token_store(data_path, len(ROWS), preprocess='vqa_rad')
+
+    question_path = str(tmp_path / 'trainset.json')
+    with open(question_path, 'w') as f:
+        json.dump([{'question': 'Is the X ray normal? -yes/no'}], f)
+    build_token_store(question_path, str.split, STOI, txt_key='question', preprocess='vqa_rad')
+    store = load_token_store(question_path, 1, preprocess='vqa_rad')
+    question = vqa_rad_question('Is the X ray normal? -yes/no')
+    assert store.get(0) == [STOI.get(w, STOI["[UNK]"]) for w in question.split()]
+    assert store[0].tolist() == store.get(0)
+    with pytest.raises(AssertionError, match='--preprocess vqa_rad, not None'):
+        load_token_store(question_path, 1)
+
+
+@pytest.mark.parametrize('pipeline', [os.path.join('Classification', 'mmbt'),
+                                      os.path.join('report_generation_and_vqa', 'sc')])
+def test_pipelines_import_the_root_modules(pipeline):
+    # run from the pipeline directory like its scripts: data.* and utils.* are the files of the repository root
+    code = "import data.token_store, utils.amp; print(data.token_store.__file__); print(utils.amp.__file__)"
+    out = subprocess.run([sys.executable, '-c', code], cwd=os.path.join(ROOT, 'Downstream_task', pipeline),
+                         check=True, capture_output=True, text=True).stdout.split()
+    assert out == [os.path.join(ROOT, 'data', 'token_store.py'), os.path.join(ROOT, 'utils', 'amp.py')]
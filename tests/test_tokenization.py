@@ -0,0 +1,139 @@
+"""
+[user-008] sc BertTokenizer (pytorch_pretrained_bert/tokenization.py): the trie WordPiece, the cached BasicTokenizer
+and BertTokenizer.encode against the per-substring vocab probing and full-text cleaning of the baseline tokenizer
+"""
+import os
+import sys
+import pickle
+import random
+
+import pytest
+
+SC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      'Downstream_task', 'report_generation_and_vqa', 'sc')
+if SC_DIR not in sys.path:
+    sys.path.insert(0, SC_DIR)
+
+from pytorch_pretrained_bert.tokenization import BertTokenizer, LRUCache, whitespace_tokenize
+
+VOCAB = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", "[X_SEP]",
+         "the", "heart", "size", "is", "normal", "no", "pleural", "effusion", "pneumo", "##thorax", "##thor", "##ax",
+         "card", "##io", "##med", "##ia", "##stinal", "##al", "silhouette", "silh", "##ou", "##ette", "lung", "##s",
+         "clear", "un", "##changed", "##chang", "##ed", "from", "prior", "cm", "x", "2", "3", "##2", ".", ",", "-",
+         "(", ")", "'", "e", "##e", "a", "##a", "##b", "b", "cafe", "中", "a" * 5, "##" + "a" * 3]
+TEXTS = [
+    "The heart size is normal. No pleural effusion or pneumothorax.",
+    "Cardiomediastinal silhouette unchanged from prior (2 x 3 cm), lungs clear.",
+    "  \tNo\npneumothorax\r\n ",
+    "[CLS] heart [SEP] [MASK] lungs [X_SEP] [PAD]",
+    "CAFÉ café Café naïve",
+    "heart中size 中中",
+    "lung\x00s\x07 clear\x7f",
+    "unknownword heartx xheart pneumothoraxes",
+    "a" * 99 + " " + "a" * 100 + " " + "a" * 101 + " " + "a" * 13,
+    "",
+    "   ",
+]
+
+
+def baseline_basic_tokenize(basic, text):
+    """BasicTokenizer.tokenize before the ascii fast path and the per-token cache"""
+    text = basic._clean_text(text)
+    text = basic._tokenize_chinese_chars(text)
+    orig_tokens = whitespace_tokenize(text)
+    split_tokens = []
+    for token in orig_tokens:
+        if basic.do_lower_case and token not in basic.never_split:
+            token = token.lower()
+            token = basic._run_strip_accents(token)
+        split_tokens.extend(basic._run_split_on_punc(token))
+
+    output_tokens = whitespace_tokenize(" ".join(split_tokens))
+    return output_tokens
+
+
+def baseline_wordpiece_tokenize(wordpiece, text):
+    """WordpieceTokenizer.tokenize before the tries: longest substring probed in the vocab"""
+    output_tokens = []
+    for token in whitespace_tokenize(text):
+        chars = list(token)
+        if len(chars) > wordpiece.max_input_chars_per_word:
+            output_tokens.append(wordpiece.unk_token)
+            continue
+
+        is_bad = False
+        start = 0
+        sub_tokens = []
+        while start < len(chars):
+            end = len(chars)
+            cur_substr = None
+            while start < end:
+                substr = "".join(chars[start:end])
+                if start > 0:
+                    substr = "##" + substr
+                if substr in wordpiece.vocab:
+                    cur_substr = substr
+                    break
+                end -= 1
+            if cur_substr is None:
+                is_bad = True
+                break
+            sub_tokens.append(cur_substr)
+            start = end
+
+        if is_bad:
+            output_tokens.append(wordpiece.unk_token)
+        else:
+            output_tokens.extend(sub_tokens)
+    return output_tokens
+
+
+def baseline_tokenize(tokenizer, text):
+    return [sub_token for token in baseline_basic_tokenize(tokenizer.basic_tokenizer, text)
+            for sub_token in baseline_wordpiece_tokenize(tokenizer.wordpiece_tokenizer, token)]
+
+
+def random_texts(n=300, seed=0):
+    """words glued from vocab pieces and stray chars, so that the longest match has to back off"""
+    rng = random.Random(seed)
+    pieces = [t.lstrip("#") for t in VOCAB if not t.startswith("[")] + ["q", "É", "é", "́", "!", "\t", "中"]
+    return [" ".join("".join(rng.choice(pieces) for _ in range(rng.randint(1, 5))) for _ in range(rng.randint(1, 12)))
+            for _ in range(n)]
+
+
+@pytest.fixture(params=[True, False], ids=['uncased', 'cased'])
+def tokenizer(request, tmp_path):
+    vocab_file = tmp_path / 'vocab.txt'
+    vocab_file.write_text("\n".join(VOCAB) + "\n", encoding='utf-8')
+    return BertTokenizer(str(vocab_file), do_lower_case=request.param)
+
+
+def test_tokenize_matches_baseline(tokenizer):
+    for text in TEXTS + random_texts():
+        expected = baseline_tokenize(tokenizer, text)
+        assert tokenizer.basic_tokenizer.tokenize(text) == baseline_basic_tokenize(tokenizer.basic_tokenizer, text)
+        for _ in range(2):  # cold and cached
+            assert tokenizer.tokenize(text) == expected
+            assert tokenizer.encode(text) == tokenizer.convert_tokens_to_ids(expected)
+
+
+def test_wordpiece_matches_baseline(tokenizer):
+    wordpiece = tokenizer.wordpiece_tokenizer
+    words = [w for text in TEXTS + random_texts(seed=1) for w in tokenizer.basic_tokenizer.tokenize(text)]
+    words += ["pneumothor", "pneumothoraxax", "##thorax", "aaaaaa", "aaaaaaaa", "ab", "ba", "x2", "xx"]
+    for word in words:
+        assert wordpiece.tokenize(word) == baseline_wordpiece_tokenize(wordpiece, word)
+
+
+def test_caches_are_bounded_and_picklable(tokenizer):
+    cache = LRUCache(maxsize=2)
+    cache.put('a', (1,))
+    cache.put('b', (2,))
+    cache.get('a')
+    cache.put('c', (3,))
+    assert cache.get('b') is None and cache.get('a') == (1,) and cache.get('c') == (3,)
+
+    texts = TEXTS + random_texts(50)
+    expected = [tokenizer.encode(text) for text in texts]
+    copied = pickle.loads(pickle.dumps(tokenizer))  # DataLoader workers
+    assert [copied.encode(text) for text in texts] == expected
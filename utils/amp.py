@@ -0,0 +1,72 @@
+"""
+automatic mixed precision for the training loops
+
+--mixed_precision fp16 | bf16 runs the forward and the losses under torch.autocast, the weights and the optimizer
+stay fp32. fp16 needs cuda and a GradScaler (dynamic loss scaling, steps with inf / nan gradients are skipped);
+bf16 has the fp32 exponent range and runs unscaled, on cuda and cpu. "none" is plain fp32, every call below is
+then a no-op.
+
+    amp = MixedPrecision(args.mixed_precision, device)
+    with amp.autocast():
+        loss = criterion(model(*inputs), target)
+    amp.backward(loss)
+    amp.step(optimizer)
+
+The additive attention masks are built in compute_dtype(model), so that they are not promoted against the
+fp16 / bf16 attention scores.
+"""
+import torch
+
+MIXED_PRECISION_DTYPES = {'none': None, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+def autocast_dtype(device_type):
+    """dtype of the enclosing torch.autocast on device_type, None outside of it"""
+    try:
+        enabled = torch.is_autocast_enabled(device_type)
+        return torch.get_autocast_dtype(device_type) if enabled else None
+    except (TypeError, AttributeError):  # torch < 2.4
+        if device_type == 'cuda':
+            return torch.get_autocast_gpu_dtype() if torch.is_autocast_enabled() else None
+        return torch.get_autocast_cpu_dtype() if torch.is_autocast_cpu_enabled() else None
+
+
+def compute_dtype(module):
+    """dtype the activations of module are computed in: the autocast dtype inside torch.autocast, its parameter dtype otherwise"""
+    param = next(module.parameters())
+    dtype = autocast_dtype(param.device.type)
+    return dtype if dtype is not None else param.dtype
+
+
+class MixedPrecision():
+    def __init__(self, mode, device):
+        assert mode in MIXED_PRECISION_DTYPES, mode
+        self.device_type = torch.device(device).type
+        self.dtype = MIXED_PRECISION_DTYPES[mode]
+        self.enabled = self.dtype is not None
+        if self.dtype == torch.float16 and self.device_type != 'cuda':
+            raise ValueError('--mixed_precision fp16 needs cuda, use bf16 on {}'.format(self.device_type))
+        scale = self.dtype == torch.float16
+        if hasattr(torch.amp, 'GradScaler'):
+            self.scaler = torch.amp.GradScaler('cuda', enabled=scale)
+        else:
+            self.scaler = torch.cuda.amp.GradScaler(enabled=scale)
+
+    def autocast(self):
+        return torch.autocast(self.device_type, dtype=self.dtype, enabled=self.enabled)
+
+    def backward(self, loss):
+        self.scaler.scale(loss).backward()
+
+    def step(self, optimizer):
+        # unscale first, clipping inside optimizer.step() then sees the true gradients
+        if self.scaler.is_enabled():
+            self.scaler.unscale_(optimizer)
+        self.scaler.step(optimizer)
+        self.scaler.update()
+
+    def state_dict(self):
+        return self.scaler.state_dict()
+
+    def load_state_dict(self, state_dict):
+        self.scaler.load_state_dict(state_dict)
@@ -0,0 +1,210 @@
+"""
+full-state, mid-epoch resumable training checkpoints, written in the background
+
+save_pretrained per epoch keeps only the weights: a restart loses the optimizer moments, the loss scale, the RNG
+streams and the position in the epoch. CheckpointManager.save(step, state) takes the state_dicts of all of them
+every `every` optimizer steps:
+    - a cpu copy of every tensor is taken in the training thread (pinned memory and one synchronize on cuda),
+      nothing is copied on the gpu
+    - torch.save, fsync and the rename into place run in a background thread while training goes on; a save
+      first waits for the previous one, so at most one snapshot is held in host memory
+    - checkpoint-<step>.pt only appears once it is complete, the newest `keep` of them are kept; with an
+      evaluation worker (utils/eval_worker.py) the older ones are only removed once it has scored them
+Under DDP every rank calls save(): the RNG states of all the ranks are gathered, rank 0 writes.
+
+ResumableBatchSampler (the batch_sampler of the training DataLoader) orders an epoch by (seed, epoch) only, so a
+resumed run skips the batches of the epoch it had done without loading them and continues with the same order:
+
+    loader = DataLoader(dset, batch_sampler=ResumableBatchSampler(BatchSampler(RandomSampler(dset), 36, False)))
+    state = checkpoints.load(args.resume)     # file, or the directory for the newest one
+    model.load_state_dict(state['model']); ...; loader.batch_sampler.skip(state['step'])
+    batches = iter(loader)
+    set_rng_state(state['rng'])               # after iter(), which draws the worker seeds of the epoch
+
+The RNG streams of the DataLoader workers are seeded per epoch and not restored: with num_workers > 0 the
+random augmentations of the resumed batches differ from the interrupted run.
+"""
+import os
+import glob
+import random
+import threading
+import numpy as np
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import Sampler, RandomSampler
+
+from utils.distributed import is_distributed, is_main_process, get_rank, get_world_size
+
+
+def rng_state():
+    """python, numpy, torch cpu and cuda RNG states of this process"""
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available() and len(state['cuda']) == torch.cuda.device_count():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def to_cpu(obj, memo=None):
+    """
+    copy of obj (nested dicts / lists / tuples of tensors, the state_dicts) with every tensor copied to the cpu
+    now. Tensors shared by several entries (tied weights) stay shared.
+    """
+    memo = {} if memo is None else memo
+    if torch.is_tensor(obj):
+        if id(obj) not in memo:
+            src = obj.detach()
+            if src.device.type == 'cpu':
+                memo[id(obj)] = src.clone()
+            else:
+                dst = torch.empty(src.shape, dtype=src.dtype, pin_memory=True)
+                memo[id(obj)] = dst.copy_(src, non_blocking=True)
+        return memo[id(obj)]
+    if isinstance(obj, dict):
+        out = type(obj)((k, to_cpu(v, memo)) for k, v in obj.items())
+        if hasattr(obj, '_metadata'):
+            out._metadata = obj._metadata  # state_dict versions, read by load_state_dict
+        return out
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v, memo) for v in obj)
+    return obj
+
+
+def load_file(path):
+    """a checkpoint file written by CheckpointManager, on the cpu"""
+    try:
+        return torch.load(path, map_location='cpu', weights_only=False)  # RNG states are numpy / python objects
+    except TypeError:  # torch < 1.13
+        return torch.load(path, map_location='cpu')
+
+
+class CheckpointManager():
+    def __init__(self, dirname, every=0, keep=2, scored=None):
+        """
+        every: optimizer steps between two checkpoints, 0: off. keep: newest checkpoints kept, 0: all.
+        scored: () -> file names of the checkpoints scored by the evaluation worker (EvalWorker.scored), a
+        checkpoint beyond keep is only removed once in it
+        """
+        self.dirname = dirname
+        self.every = every
+        self.keep = keep
+        self.scored = scored
+        self.thread = None
+        self.error = None
+
+    def should_save(self, step):
+        return self.every > 0 and step % self.every == 0
+
+    def path(self, step):
+        return os.path.join(self.dirname, 'checkpoint-{:09d}.pt'.format(step))
+
+    def latest(self):
+        paths = sorted(glob.glob(os.path.join(self.dirname, 'checkpoint-*.pt')))
+        return paths[-1] if paths else None
+
+    def save(self, step, state):
+        """state: dict of state_dicts and python values at optimizer step `step`, called by every rank"""
+        rngs = [rng_state()]
+        if is_distributed():
+            rngs = [None] * get_world_size()
+            dist.all_gather_object(rngs, rng_state())
+        if is_main_process():
+            self.save_file(self.path(step), dict(state, global_step=step, rng=rngs), prune=True)
+
+    def save_file(self, path, state, prune=False):
+        """cpu snapshot of state now, torch.save(state, path) in the background"""
+        self.wait()
+        snapshot = to_cpu(state)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()  # the non_blocking copies into pinned memory
+        self.thread = threading.Thread(target=self._write, args=(path, snapshot, prune), name='checkpoint-writer')
+        self.thread.start()
+
+    def _write(self, path, snapshot, prune):
+        try:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            tmp = path + '.tmp'
+            with open(tmp, 'wb') as f:
+                torch.save(snapshot, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+            dir_fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)  # the rename
+            finally:
+                os.close(dir_fd)
+            if prune and self.keep > 0:
+                scored = self.scored() if self.scored is not None else None
+                for old in sorted(glob.glob(os.path.join(self.dirname, 'checkpoint-*.pt')))[:-self.keep]:
+                    if scored is None or os.path.basename(old) in scored:
+                        os.remove(old)
+        except BaseException as e:
+            self.error = e
+
+    def wait(self):
+        """block until the checkpoint being written is on disk, re-raise an error of its writer"""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('writing the checkpoint failed') from error
+
+    def load(self, path):
+        """
+        state saved by save(), path: checkpoint file or a directory of them (the newest one).
+        state['rng'] is the RNG state of this rank (rank 0's if the world size changed).
+        """
+        if os.path.isdir(path):
+            path = CheckpointManager(path).latest()
+            assert path is not None, 'no checkpoint-*.pt in the directory'
+        state = load_file(path)
+        rngs = state['rng']
+        state['rng'] = rngs[get_rank()] if len(rngs) == get_world_size() else rngs[0]
+        print(f'Resume from {path}, step {state["global_step"]}')
+        return state
+
+
+class ResumableBatchSampler(Sampler):
+    """
+    batch_sampler of a training DataLoader that starts the next epoch at a given batch (skip()).
+    A BatchSampler over a RandomSampler draws its order from a generator seeded with (seed, epoch) instead of the
+    global torch RNG; DistributedSampler and LengthBucketBatchSampler are ordered by set_epoch already.
+    """
+    def __init__(self, batch_sampler, seed=0):
+        self.batch_sampler = batch_sampler
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        sampler = getattr(self.batch_sampler, 'sampler', None)
+        if isinstance(sampler, RandomSampler):
+            sampler.generator = torch.Generator().manual_seed(self.seed + epoch)
+        for s in (self.batch_sampler, sampler):
+            if hasattr(s, 'set_epoch'):
+                s.set_epoch(epoch)
+
+    def skip(self, start):
+        """the next iteration starts at batch `start` of the epoch"""
+        self.start = start
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def __iter__(self):
+        start, self.start = self.start, 0
+        for i, batch in enumerate(self.batch_sampler):
+            if i >= start:
+                yield batch
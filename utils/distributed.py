@@ -0,0 +1,142 @@
+"""
+multi-process DistributedDataParallel training, one process per gpu (or per cpu worker), launched by torchrun
+
+    $ torchrun --nproc_per_node 4 main_origin.py ...
+    $ torchrun --nproc_per_node 2 main_origin.py --with_cuda False ...    # cpu, gloo
+    $ torchrun --nproc_per_node 2 main.py --device cpu ...                 # Classification/mmbt
+    $ torchrun --nproc_per_node 2 finetune.py --no_cuda ...                # report_generation_and_vqa/sc
+
+torchrun sets RANK, LOCAL_RANK, WORLD_SIZE, MASTER_ADDR and MASTER_PORT; started without it the entry points run
+in one process as before (nn.DataParallel over the visible gpus, DataParallelImbalance in sc). Every rank reads its
+DistributedSampler shard and DDP all-reduces the gradients in buckets during backward, instead of nn.DataParallel
+replicating the model and scattering the inputs every step. Only rank 0 prints, logs the metrics and saves.
+
+--dist_backend auto is nccl on cuda and gloo on cpu. The models are wrapped with static_graph: parameters used in the
+forward but left out of the loss inside it (the pooler of the sc model, ...) are the same every step, DDP records
+them in the first backward instead of walking the autograd graph every step (find_unused_parameters). A head whose
+output is returned but not in the loss (the ITM head with --itm_task False) still needs find_unused_parameters.
+"""
+import os
+import builtins
+import contextlib
+
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
+
+DIST_BACKENDS = ['auto', 'nccl', 'gloo']
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def _setup_print(is_main):
+    # the other ranks print only with print(..., force=True)
+    builtin_print = builtins.print
+
+    def print(*args, force=False, **kwargs):
+        if is_main or force:
+            builtin_print(*args, **kwargs)
+    builtins.print = print
+
+
+def init_distributed(backend='auto', with_cuda=True):
+    """
+    Launched by torchrun: init_process_group from its environment and return the device of this rank,
+    cuda:LOCAL_RANK with with_cuda and visible gpus, cpu otherwise. Plain launch: None, nothing is initialized.
+    """
+    if 'RANK' not in os.environ or 'WORLD_SIZE' not in os.environ:
+        return None
+    assert backend in DIST_BACKENDS, backend
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if with_cuda and torch.cuda.is_available():
+        device = torch.device('cuda', local_rank)
+        torch.cuda.set_device(device)
+    else:
+        device = torch.device('cpu')
+    if backend == 'auto':
+        backend = 'nccl' if device.type == 'cuda' else 'gloo'
+    if not is_distributed():
+        dist.init_process_group(backend=backend)
+    _setup_print(is_main_process())
+    return device
+
+
+def wrap_ddp(model, device, find_unused_parameters=False):
+    device_ids = [device.index] if device.type == 'cuda' else None
+    return DistributedDataParallel(model, device_ids=device_ids, find_unused_parameters=find_unused_parameters,
+                                   static_graph=not find_unused_parameters)
+
+
+def unwrap_ddp(model):
+    """the module itself, e.g. for the evaluation on rank 0 only (no collectives in its forward)"""
+    return model.module if isinstance(model, DistributedDataParallel) else model
+
+
+@contextlib.contextmanager
+def accumulate(model, sync):
+    """
+    forward + backward of a micro-batch of gradient accumulation, sync: last one before the optimizer step.
+    The others skip the all-reduce (DDP.no_sync); static_graph records the graph in the first backward,
+    which therefore always syncs.
+    """
+    if isinstance(model, DistributedDataParallel) and not sync and getattr(model, 'graph_recorded', False):
+        with model.no_sync():
+            yield
+    else:
+        yield
+        if isinstance(model, DistributedDataParallel):
+            model.graph_recorded = True
+
+
+def get_train_sampler(dataset, seed=0):
+    """shuffling DistributedSampler under torchrun (set_epoch every epoch), None otherwise"""
+    return DistributedSampler(dataset, shuffle=True, seed=seed) if is_distributed() else None
+
+
+def get_eval_sampler(dataset):
+    """
+    in-order shard of this rank under torchrun, None otherwise. The first rows are repeated up to a multiple of the
+    world size, so sums reduced over the ranks count them twice.
+    """
+    return DistributedSampler(dataset, shuffle=False) if is_distributed() else None
+
+
+def set_epoch(loader, epoch):
+    """reshuffle the DistributedSampler / LengthBucketBatchSampler of loader for epoch"""
+    for sampler in (loader.sampler, loader.batch_sampler):
+        if hasattr(sampler, 'set_epoch'):
+            sampler.set_epoch(epoch)
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def broadcast_object(obj, src=0):
+    """obj of rank src on every rank, e.g. the validation metrics computed on rank 0"""
+    if not is_distributed():
+        return obj
+    objs = [obj]
+    dist.broadcast_object_list(objs, src=src)
+    return objs[0]
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
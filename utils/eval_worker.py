@@ -0,0 +1,78 @@
+"""
+evaluation side-process: scores the checkpoints of a training run as they are written
+
+With --async_eval the training entry points skip the evaluation at the end of the epoch and write a checkpoint
+(utils/checkpoint.py) instead. A second process started on the same flags with --eval_worker <checkpoints dir>
+loads every new checkpoint-*.pt into its own copy of the model, evaluates it and appends one json line per
+checkpoint to --eval_metrics_file, until it has scored the last checkpoint of the run (state['final']):
+
+    $ python main_origin.py --async_eval True --checkpoint_every 2000 ...
+    $ python main_origin.py --eval_worker output/<run>/checkpoints --eval_device cuda:1 --eval_subsample 2000 ...
+
+Checkpoints only appear once complete (atomic rename). With --async_eval the training run prunes a checkpoint
+beyond --checkpoint_keep only once it is in the metrics file, so none is lost while the worker lags behind; the
+checkpoints pile up if the worker is not running. Checkpoints already in the metrics file are not scored again after
+a restart of the worker. --eval_subsample scores a fixed random subset of the evaluation set, the same one for every
+checkpoint.
+"""
+import os
+import glob
+import json
+import time
+import random
+
+from utils.checkpoint import load_file
+
+
+def subsample_indices(n, k, seed=0):
+    """k sorted indices of range(n) drawn with seed, all of them for k <= 0"""
+    if k <= 0 or k >= n:
+        return list(range(n))
+    return sorted(random.Random(seed).sample(range(n), k))
+
+
+class EvalWorker():
+    def __init__(self, dirname, metrics_file=None, poll=30):
+        self.dirname = dirname
+        self.metrics_file = metrics_file or os.path.join(dirname, 'eval_metrics.jsonl')
+        self.poll = poll
+
+    def scored(self):
+        if not os.path.exists(self.metrics_file):
+            return set()
+        with open(self.metrics_file) as f:
+            return {json.loads(line)['checkpoint'] for line in f if line.strip()}
+
+    def pending(self):
+        scored = self.scored()
+        return [p for p in sorted(glob.glob(os.path.join(self.dirname, 'checkpoint-*.pt')))
+                if os.path.basename(p) not in scored]
+
+    def append(self, record):
+        with open(self.metrics_file, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def run(self, evaluate):
+        """
+        evaluate(state) -> {metric: float} for the state of every new checkpoint, until the one written at the end
+        of the training (state['final']) is scored or the process is stopped
+        """
+        print(f'Watching {self.dirname}, metrics to {self.metrics_file}')
+        while True:
+            for path in self.pending():
+                try:
+                    state = load_file(path)
+                except FileNotFoundError:  # removed by hand, or pruned by a run without --async_eval
+                    continue
+                st = time.time()
+                record = {'checkpoint': os.path.basename(path), 'epoch': state['epoch'], 'step': state['step'],
+                          'global_step': state['global_step']}
+                record.update(evaluate(state))
+                record['eval_sec'] = round(time.time() - st, 1)
+                self.append(record)
+                print(record)
+                if state.get('final'):
+                    return
+            time.sleep(self.poll)
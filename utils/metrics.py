@@ -0,0 +1,46 @@
+"""
+running means of the training / evaluation metrics, accumulated on the device
+
+loss.item() and .sum().item() per step wait for the step to finish on the gpu and copy to the host. The sums
+(and the element counts of the accuracies) here stay 0-dim device tensors; compute() syncs once for all of
+them, every log_freq steps and at the end of the epoch. Under DDP (utils/distributed.py) compute() sums over
+all the ranks, so every rank must call it at the same steps.
+
+    metrics = RunningMetrics(device)
+    metrics.add('loss', loss)                                      # mean over steps
+    metrics.add('itm_acc', pred.eq(target).sum(), target.numel())  # mean over elements
+    if step % log_freq == 0:
+        print(metrics.compute())
+"""
+import torch
+import torch.distributed as dist
+
+
+class RunningMetrics():
+    def __init__(self, device):
+        self.device = torch.device(device)
+        self.reset()
+
+    def reset(self):
+        self.sums = {}
+        self.counts = {}
+
+    def add(self, name, value, count=1):
+        """value: tensor summed over count elements, count: python number or tensor"""
+        value = value.detach().float()
+        if name not in self.sums:
+            self.sums[name] = torch.zeros((), device=self.device)
+            self.counts[name] = torch.zeros((), device=self.device)
+        self.sums[name] += value
+        self.counts[name] += count
+
+    def compute(self):
+        """{name: sum / count} as python floats, one device sync (+ one all-reduce under DDP)"""
+        if not self.sums:
+            return {}
+        names = list(self.sums)
+        totals = torch.stack([self.sums[n] for n in names] + [self.counts[n] for n in names])
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(totals)
+        sums, counts = totals[:len(names)], totals[len(names):].clamp(min=1)
+        return dict(zip(names, (sums / counts).tolist()))
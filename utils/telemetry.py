@@ -0,0 +1,271 @@
+"""
+per-step timing and the epoch metrics of the training loops, written to a local file
+
+tqdm and print show the losses, not where the time of a step goes. StepTelemetry records every training
+step (micro-batch) as
+    data_ms                           waiting for the DataLoader
+    h2d_ms                            copy of the batch to the device and its preparation there (masking, ...)
+    forward_ms, backward_ms, optimizer_ms
+    step_ms                           wall time since the previous step, samples_per_sec and tokens_per_sec from it
+    peak_mem_mib                      peak cuda memory allocated during the step, peak RSS of the process on cpu
+and appends them to <output dir>/telemetry.jsonl, or telemetry.csv with --telemetry csv; one file per rank under
+torchrun (telemetry.rank<r>.jsonl). Neither needs a network or a login. The losses and evaluation scores of every
+epoch go through log() to <output dir>/metrics.jsonl, written by rank 0.
+
+--telemetry wandb writes the same files and also logs the metrics, and the step means of every epoch under
+telemetry/, to a wandb run. Only this sink imports wandb: init_wandb / watch_wandb start the run and hook the model,
+they do nothing with the other sinks, so wandb is an optional dependency.
+
+    telemetry = StepTelemetry(args.telemetry, output_dir, device, every=args.telemetry_every)
+    for batch in telemetry.batches(loader):
+        with telemetry.phase('h2d'):
+            ...
+        with telemetry.phase('forward'):
+            ...
+        telemetry.record(step, samples=batch_size, tokens=input_ids.numel(), epoch=epoch)
+    telemetry.end_epoch()
+    telemetry.log({'avg_loss': ..., 'eval_loss': ...}, step=epoch)
+
+On cuda the phases are timed with cuda events, nothing waits for the gpu during a step: the records are buffered and
+resolved with one synchronize every `every` steps and at the end of the epoch. The phase times are gpu times then,
+data_ms and step_ms host times. Time not in a phase (logging, checkpoints) is the rest of step_ms.
+
+    $ python -m utils.telemetry output/<run>/telemetry.jsonl    # mean per phase and its share of the step
+"""
+import os
+import sys
+import csv
+import json
+import time
+import contextlib
+
+import torch
+
+try:
+    import resource
+except ImportError:  # not on windows
+    resource = None
+
+from utils.distributed import get_rank
+
+TELEMETRY_SINKS = ['none', 'jsonl', 'csv', 'wandb']
+PHASES = ['data', 'h2d', 'forward', 'backward', 'optimizer']
+FIELDS = ['epoch', 'step'] + [p + '_ms' for p in PHASES] + \
+         ['step_ms', 'samples', 'tokens', 'samples_per_sec', 'tokens_per_sec', 'peak_mem_mib']
+
+
+def init_wandb(sink, config, **kwargs):
+    """wandb.init(config=config, **kwargs) on rank 0 with the wandb sink, the wandb run or None"""
+    if sink != 'wandb' or get_rank() != 0:
+        return None
+    import wandb  # only this sink needs it
+    return wandb.init(config=config, **kwargs)
+
+
+def watch_wandb(sink, model):
+    """wandb.watch: gradient histograms, hooks on every parameter. Needs the run of init_wandb"""
+    if sink == 'wandb' and get_rank() == 0:
+        import wandb
+        wandb.watch(model)
+
+
+class StepTelemetry():
+    def __init__(self, sink='jsonl', dirname='.', device='cpu', every=50):
+        """sink: one of TELEMETRY_SINKS, 'none' records nothing. every: steps buffered between two writes"""
+        assert sink in TELEMETRY_SINKS, sink
+        self.sink = sink
+        self.enabled = sink != 'none'
+        self.wandb = sink == 'wandb' and get_rank() == 0
+        self.device = torch.device(device)
+        self.cuda = self.device.type == 'cuda'
+        self.every = max(every, 1)
+        ext = 'csv' if sink == 'csv' else 'jsonl'
+        rank = get_rank()
+        name = f'telemetry.{ext}' if rank == 0 else f'telemetry.rank{rank}.{ext}'
+        self.path = os.path.join(dirname, name)
+        self.metrics_path = os.path.join(dirname, 'metrics.jsonl')
+        self.file = None
+        self.writer = None
+        self.current = {}
+        self.pending = []
+        self.last = None
+        self.epoch_records = []
+
+    def batches(self, loader):
+        """iterate over loader, timing the wait for every batch"""
+        return self._timed(loader) if self.enabled else loader
+
+    def _timed(self, loader):
+        self.last = time.perf_counter()
+        batches = iter(loader)
+        while True:
+            st = time.perf_counter()
+            try:
+                batch = next(batches)
+            except StopIteration:
+                return
+            self.current['data_ms'] = (time.perf_counter() - st) * 1000
+            yield batch
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+        elif self.cuda:
+            stream = torch.cuda.current_stream(self.device)
+            start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+            start.record(stream)
+            yield
+            end.record(stream)
+            self.current.setdefault('events', []).append((name, start, end))
+        else:
+            st = time.perf_counter()
+            yield
+            key = name + '_ms'
+            self.current[key] = self.current.get(key, 0.) + (time.perf_counter() - st) * 1000
+
+    def record(self, step, samples, tokens=0, **fields):
+        """end of a step: samples and tokens (sequence positions) of its batch, fields: e.g. epoch"""
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        rec, self.current = self.current, {}
+        rec.update(fields, step=step, samples=samples, tokens=tokens,
+                   step_ms=(now - self.last) * 1000 if self.last is not None else None)
+        rec['peak_mem_mib'] = self.peak_memory()
+        self.last = now
+        self.pending.append(rec)
+        if len(self.pending) >= self.every:
+            self.flush()
+
+    def peak_memory(self):
+        """MiB, peak allocated on the cuda device since the previous call, peak RSS of the process on cpu"""
+        if self.cuda:
+            peak = torch.cuda.max_memory_allocated(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            return peak / 2 ** 20
+        if resource is not None:
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10  # KiB on linux
+        return None
+
+    def flush(self):
+        """resolve the buffered steps (one synchronize on cuda) and append them to the file"""
+        if not self.pending:
+            return
+        if self.cuda:
+            torch.cuda.synchronize(self.device)
+        records = []
+        for rec in self.pending:
+            for name, start, end in rec.pop('events', []):
+                key = name + '_ms'
+                rec[key] = rec.get(key, 0.) + start.elapsed_time(end)
+            sec = rec['step_ms'] / 1000 if rec['step_ms'] else None
+            rec['samples_per_sec'] = rec['samples'] / sec if sec else None
+            rec['tokens_per_sec'] = rec['tokens'] / sec if sec else None
+            ordered = {k: rec[k] for k in FIELDS if k in rec}
+            ordered.update((k, v) for k, v in rec.items() if k not in ordered)
+            records.append({k: round(v, 3) if isinstance(v, float) else v for k, v in ordered.items()})
+        self.pending = []
+        self.epoch_records.extend(records)
+        self._write(records)
+
+    def _write(self, records):
+        if self.file is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self.file = open(self.path, 'a', newline='')  # a resumed run appends
+            if self.sink == 'csv':
+                self.writer = csv.DictWriter(self.file, FIELDS, restval='', extrasaction='ignore')
+                if self.file.tell() == 0:
+                    self.writer.writeheader()
+        for rec in records:
+            if self.writer is not None:
+                self.writer.writerow(rec)
+            else:
+                self.file.write(json.dumps(rec) + '\n')
+        self.file.flush()
+
+    def end_epoch(self, wandb_step=None):
+        """
+        flush, the means over the steps of the epoch; the wait for the first batch of the next one is timed from its
+        iter(). wandb sink: logged at wandb_step, None: committed with the next wandb.log of the run
+        """
+        if not self.enabled:
+            return {}
+        self.flush()
+        self.last = None
+        means, self.epoch_records = summarize_records(self.epoch_records), []
+        if self.wandb and means:
+            import wandb
+            logged = {'telemetry/' + k: v for k, v in means.items()}
+            if wandb_step is None:
+                wandb.log(logged, commit=False)
+            else:
+                wandb.log(logged, step=wandb_step)
+        return means
+
+    def log(self, metrics, step=None):
+        """metrics of the epoch / evaluation ({name: number}) at step, appended to metrics.jsonl by rank 0"""
+        if not self.enabled or get_rank() != 0:
+            return
+        os.makedirs(os.path.dirname(self.metrics_path) or '.', exist_ok=True)
+        with open(self.metrics_path, 'a') as f:
+            f.write(json.dumps(dict({'step': step} if step is not None else {}, **metrics), default=float) + '\n')
+        if self.wandb:
+            import wandb
+            if step is None:
+                wandb.log(metrics)
+            else:
+                wandb.log(metrics, step=step)
+
+    def close(self):
+        self.end_epoch()
+        if self.file is not None:
+            self.file.close()
+            self.file = self.writer = None
+
+
+def summarize_records(records):
+    """mean ms per phase and per step, throughput over all the steps and the peak memory of records"""
+    summary = {}
+    if not records:
+        return summary
+    for key in [p + '_ms' for p in PHASES] + ['step_ms']:
+        values = [r[key] for r in records if r.get(key) not in (None, '')]
+        if values:
+            summary[key] = round(sum(map(float, values)) / len(records), 3)
+    timed = [r for r in records if r.get('step_ms') not in (None, '')]
+    sec = sum(float(r['step_ms']) for r in timed) / 1000
+    if sec > 0:
+        summary['samples_per_sec'] = round(sum(float(r['samples']) for r in timed) / sec, 3)
+        summary['tokens_per_sec'] = round(sum(float(r['tokens']) for r in timed) / sec, 3)
+    peaks = [float(r['peak_mem_mib']) for r in records if r.get('peak_mem_mib') not in (None, '')]
+    if peaks:
+        summary['peak_mem_mib'] = max(peaks)
+    summary['steps'] = len(records)
+    return summary
+
+
+def summarize(path):
+    """summarize_records of a telemetry.jsonl / .csv file"""
+    with open(path, newline='') as f:
+        if path.endswith('.csv'):
+            records = list(csv.DictReader(f))
+        else:
+            records = [json.loads(line) for line in f if line.strip()]
+    return summarize_records(records)
+
+
+if __name__ == '__main__':
+    for path in sys.argv[1:]:
+        summary = summarize(path)
+        print(f"{path}: {summary.get('steps', 0)} steps, {summary.get('samples_per_sec')} samples/sec, "
+              f"{summary.get('tokens_per_sec')} tokens/sec, peak memory {summary.get('peak_mem_mib')} MiB")
+        step_ms = summary.get('step_ms')
+        for key in [p + '_ms' for p in PHASES]:
+            if key in summary:
+                share = f'{100 * summary[key] / step_ms:5.1f} %' if step_ms else ''
+                print(f'    {key:<14}{summary[key]:10.3f} ms  {share}')
+        if step_ms:
+            rest = step_ms - sum(summary.get(p + '_ms', 0.) for p in PHASES)
+            print(f"    {'other':<14}{rest:10.3f} ms  {100 * rest / step_ms:5.1f} %")
+            print(f"    {'step_ms':<14}{step_ms:10.3f} ms")